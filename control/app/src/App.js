@@ -10,11 +10,15 @@ const App = () =>{
 
   const endpoint_url = process.env.REACT_APP_ENDPOINT_URL;
 
+  // Build the state WebSocket URL if the adapter streaming server port is configured
+  const stream_port = process.env.REACT_APP_STREAM_PORT;
+  const socket_url = stream_port ? `ws://${window.location.hostname}:${stream_port}/ws` : null;
+
   return (
     <div className="hxtleak">
       <HxtleakErrorBoundary>
         <HxtleakErrorContext>
-          <HxtleakApp endpoint_url={endpoint_url} />
+          <HxtleakApp endpoint_url={endpoint_url} socket_url={socket_url} />
         </HxtleakErrorContext>
       </HxtleakErrorBoundary>
     </div>
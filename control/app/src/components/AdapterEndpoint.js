@@ -63,6 +63,20 @@ export const useAdapterEndpoint = (
         return result;
     }, [base_url, handleError]);
 
+    const query = useCallback(async (path, params) => {
+        const url = `${base_url}/${path}`;
+        let result = null;
+        try {
+            const response = await axios.get(url, { params });
+            result = response.data;
+        }
+        catch (err) {
+            handleError(err);
+        }
+
+        return result;
+    }, [base_url, handleError]);
+
     useEffect(() => {
         let timer_id = null;
         if (interval) {
@@ -76,6 +90,6 @@ export const useAdapterEndpoint = (
         }
     }, [base_url, interval, get]);
 
-    return { data, error, loading, get, put };
+    return { data, error, loading, get, put, query };
 
 }
@@ -4,6 +4,7 @@ import Row from 'react-bootstrap/Row';
 import Col from 'react-bootstrap/Col';
 
 import { useAdapterEndpoint } from './AdapterEndpoint';
+import { useStateSocket } from './StateSocket';
 
 import { HxtleakErrorOutlet, useErrorOutlet } from './HxtleakErrorContext';
 import HxtleakNavbar from './HxtleakNavbar';
@@ -15,12 +16,17 @@ import HxtleakEventLog from './HxtleakEventLog';
 
 const HxtleakApp = (props) => {
 
-  const { endpoint_url } = props;
+  const { endpoint_url, socket_url } = props;
 
-  const system_endpoint = useAdapterEndpoint("hxtleak/system", endpoint_url, {interval: 500});
+  // Receive state updates pushed over the WebSocket if connected, otherwise poll the adapter
+  const socket = useStateSocket(socket_url);
+  const system_endpoint = useAdapterEndpoint(
+    "hxtleak/system", endpoint_url, {interval: socket.connected ? null : 500}
+  );
   const event_endpoint = useAdapterEndpoint("hxtleak/event_log", endpoint_url, {});
 
-  const state = system_endpoint.data ? system_endpoint.data.system : null;
+  const system_data = socket.connected ? socket.system : system_endpoint.data;
+  const state = system_data ? system_data.system : null;
 
   const setError = useErrorOutlet();
   useEffect(() => {
@@ -34,7 +40,7 @@ const HxtleakApp = (props) => {
       <Container fluid>
         <Row>
           <Col>
-            <HxtleakControl endpoint={system_endpoint} />
+            <HxtleakControl endpoint={system_endpoint} state={state} />
           </Col>
           <Col>
             <HxtleakSystemStatus state={state} />
@@ -50,7 +56,7 @@ const HxtleakApp = (props) => {
         </Row>
         <Row>
           <Col>
-            <HxtleakEventLog endpoint={event_endpoint} />
+            <HxtleakEventLog endpoint={event_endpoint} socket={socket} />
           </Col>
         </Row>
       </Container>
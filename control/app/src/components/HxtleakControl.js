@@ -6,9 +6,7 @@ import Col from 'react-bootstrap/Col';
 import StatusCard from './StatusCard';
 import StateControlSwitch from './StateControlSwitch';
 
-const HxtleakControl = ({ endpoint }) => {
-
-  const state = endpoint.data ? endpoint.data.system : null;
+const HxtleakControl = ({ endpoint, state }) => {
 
   const chiller_outlet_disabled = state ? !state.outlets.chiller.enabled : true;
   const chiller_outlet_state = state ? state.outlets.chiller.state : false;
@@ -2,37 +2,37 @@ import { useState, useEffect, useCallback, useRef } from 'react';
 
 import StatusCard from './StatusCard';
 
-const HxtleakEventLog = ({ endpoint }) => {
+const HxtleakEventLog = ({ endpoint, socket }) => {
 
-  const interval = 1000;
+  // Poll for events only if they are not being pushed over the WebSocket
+  const interval = socket.connected ? null : 1000;
 
-  const [events, setEvents] = useState(
-    endpoint.data ? endpoint.data.event_log.events : []
-  );
+  const [polled_events, setEvents] = useState([]);
+  const events = socket.connected ? socket.events : polled_events;
 
-  const [events_since, setEventsSince] = useState(
-    endpoint.data ? endpoint.data.event_log.events_since : ''
-  );
-
-  const [last_timestamp, setLastTimestamp] = useState(
-    endpoint.data ? endpoint.data.event_log.last_timestamp : ""
-  );
+  const [cursor, setCursor] = useState(0);
 
   const updateEvents = useCallback(() => {
 
-    endpoint.put({"events_since" : last_timestamp})
+    endpoint.query("query", {"after" : cursor})
     .then(result => {
-        setLastTimestamp(result.event_log.last_timestamp);
-        setEventsSince(result.event_log.events_since);
-        if (result.event_log.events.length) {
-            setEvents(old_events => [...old_events, ...result.event_log.events]);
+        if (!result) {
+            return;
+        }
+        // If the adapter has restarted, all the events it holds are returned, replacing those
+        // already received
+        if (result.reset) {
+            setEvents(result.events);
+        } else if (result.events.length) {
+            setEvents(old_events => [...old_events, ...result.events]);
         }
+        setCursor(result.cursor);
     })
     .catch(error => {
         console.log(error.message);
     })
 
-  }, [events_since, last_timestamp, events]); // eslint-disable-line react-hooks/exhaustive-deps
+  }, [cursor]); // eslint-disable-line react-hooks/exhaustive-deps
 
   useEffect(() => {
     let timer_id = null;
@@ -61,7 +61,7 @@ const HxtleakEventLog = ({ endpoint }) => {
     const event_level_class = "log-" + event.level.toLowerCase();
 
     return (
-        <div key={event.timestamp} className={event_level_class}>
+        <div key={event.seq} className={event_level_class}>
             {event.timestamp} : {event.level} : {event.message}<br/>
         </div>
     )
@@ -0,0 +1,65 @@
+import { useState, useEffect } from 'react';
+
+const RECONNECT_INTERVAL = 5000;
+
+export const useStateSocket = (socket_url) => {
+
+    const [connected, setConnected] = useState(false);
+    const [system, setSystem] = useState(null);
+    const [events, setEvents] = useState([]);
+
+    useEffect(() => {
+        if (!socket_url) {
+            return;
+        }
+
+        let socket = null;
+        let reconnect_id = null;
+        let closing = false;
+
+        const connect = () => {
+            socket = new WebSocket(socket_url);
+
+            // Clear the events on connection, since the adapter sends all the events it holds
+            socket.onopen = () => {
+                setEvents([]);
+                setConnected(true);
+            };
+
+            socket.onmessage = (msg) => {
+                const message = JSON.parse(msg.data);
+                if (message.type === "system") {
+                    setSystem(message.data);
+                }
+                else if (message.type === "events") {
+                    // Append events beyond the last received, since events pushed as the socket
+                    // opened may also be included in the initial event log
+                    setEvents(old_events => {
+                        const last_seq = old_events.length ? old_events[old_events.length - 1].seq : 0;
+                        const new_events = message.data.events.filter(event => event.seq > last_seq);
+                        return new_events.length ? [...old_events, ...new_events] : old_events;
+                    });
+                }
+            };
+
+            socket.onclose = () => {
+                setConnected(false);
+                if (!closing) {
+                    reconnect_id = setTimeout(connect, RECONNECT_INTERVAL);
+                }
+            };
+        };
+
+        connect();
+
+        return () => {
+            closing = true;
+            if (reconnect_id) {
+                clearTimeout(reconnect_id);
+            }
+            socket.close();
+        };
+    }, [socket_url]);
+
+    return { connected, system, events };
+}
@@ -0,0 +1,227 @@
+"""Microbenchmarks for the Hxtleak adapter hot paths.
+
+This script measures the throughput and allocation behaviour of the packet decoder, checksum,
+framer, history and event logger operations on the packet receive and client request paths, and of
+retrieving the system subtree of the controller parameter tree. Results are written to a JSON
+file so that they can be compared between commits, e.g.:
+
+    python benchmark/bench_hxtleak.py -o before.json
+    python benchmark/bench_hxtleak.py -o after.json --compare before.json
+
+Throughput is reported in operations per second. Allocations are reported as the number of
+memory blocks and bytes allocated per operation and retained by its result, as traced by
+tracemalloc.
+
+Tim Nicholls, STFC Detector Systems Software Group
+"""
+import argparse
+import json
+import logging
+import platform
+import sys
+import tempfile
+import timeit
+import tracemalloc
+from datetime import datetime
+
+import hxtleak
+from hxtleak.emulator import HxtleakEmulator
+from hxtleak.event_logger import HxtleakEventLogger
+from hxtleak.framer import HxtleakPacketFramer
+from hxtleak.history import HxtleakHistory
+from hxtleak.packet_decoder import HxtleakPacketDecoder
+
+# Number of packets in a batch for batch operations
+BATCH_SIZE = 100
+
+
+class Benchmark():
+    """Benchmark container class."""
+
+    def __init__(self, name, func, ops=1):
+        """Initialise the benchmark.
+
+        :param name: benchmark name
+        :param func: callable performing the benchmarked operation
+        :param ops: number of operations performed by each call
+        """
+        self.name = name
+        self.func = func
+        self.ops = ops
+
+    def run(self, min_time=0.2, repeat=5):
+        """Run the benchmark.
+
+        :param min_time: minimum time for each timing repeat in seconds
+        :param repeat: number of timing repeats, of which the fastest is reported
+        :return: dict of benchmark results
+        """
+        timer = timeit.Timer(self.func)
+
+        # Determine the number of calls needed to run for at least the minimum time
+        number = 1
+        while timer.timeit(number) < min_time:
+            number *= 2
+
+        best = min(timer.repeat(repeat=repeat, number=number))
+        time_per_op = best / (number * self.ops)
+
+        # Trace allocations made by calls whose results are retained
+        calls = min(number, 1000)
+        results = [None] * calls
+        func = self.func
+        tracemalloc.start()
+        start_blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('lineno'))
+        start_size, _ = tracemalloc.get_traced_memory()
+        for idx in range(calls):
+            results[idx] = func()
+        end_size, _ = tracemalloc.get_traced_memory()
+        end_blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('lineno'))
+        tracemalloc.stop()
+
+        return {
+            'ops_per_sec': 1.0 / time_per_op,
+            'usec_per_op': time_per_op * 1e6,
+            'alloc_blocks_per_op': max(end_blocks - start_blocks, 0) / (calls * self.ops),
+            'alloc_bytes_per_op': max(end_size - start_size, 0) / (calls * self.ops),
+        }
+
+
+def decoder_benchmarks():
+    """Return benchmarks of packet decoding, checksum and framing operations."""
+    emulator = HxtleakEmulator(seed=1)
+    decoder = HxtleakPacketDecoder()
+    packet = bytearray(emulator.scenario_packet())
+    batch = bytearray(b''.join(emulator.scenario_packet() for _ in range(BATCH_SIZE)))
+    decoded = decoder.decode(packet)
+
+    framer = HxtleakPacketFramer(decoder.size, decoder.EOP_BYTES)
+    history = HxtleakHistory()
+
+    def frame_and_decode():
+        offsets, _ = framer.feed(batch)
+        return [decoder.decode(framer.buffer, offset) for offset in offsets]
+
+    return [
+        Benchmark('decoder.decode', lambda: decoder.decode(packet)),
+        Benchmark('decoder.unpack_from', lambda: decoder.unpack_from(packet)),
+        Benchmark('decoder.verify_checksum', lambda: decoder.verify_checksum(packet)),
+        Benchmark(
+            'decoder.verify_checksums', lambda: decoder.verify_checksums(batch), BATCH_SIZE
+        ),
+        Benchmark('decoder.packet_complete', lambda: decoder.packet_complete(packet)),
+        Benchmark('packet.as_dict', decoded.as_dict),
+        Benchmark('framer.feed', lambda: framer.feed(batch), BATCH_SIZE),
+        Benchmark('framer.feed+decode', frame_and_decode, BATCH_SIZE),
+        Benchmark('history.append', lambda: history.append(0.0, decoded)),
+    ]
+
+
+def event_logger_benchmarks():
+    """Return benchmarks of event logger operations with a full event queue."""
+    logger = logging.getLogger('hxtleak_benchmark')
+    logger.propagate = False
+    logger.addHandler(logging.NullHandler())
+    logger.setLevel(logging.INFO)
+
+    event_logger = HxtleakEventLogger(logger)
+    for idx in range(event_logger.maxlen):
+        event_logger.warning("Received packet with bad checksum 0x%X", idx & 0xff)
+
+    last_timestamp = event_logger.last_timestamp()
+
+    return [
+        Benchmark('event_logger.log', lambda: event_logger.warning("Benchmark event %d", 1)),
+        Benchmark('event_logger.set_events_since(all)', event_logger.set_events_since),
+        Benchmark(
+            'event_logger.set_events_since(last)',
+            lambda: event_logger.set_events_since(last_timestamp)
+        ),
+        Benchmark(
+            'event_logger.events(all)',
+            lambda: (event_logger.set_events_since(), event_logger.events())
+        ),
+    ]
+
+
+def param_tree_benchmarks():
+    """Return benchmarks of controller parameter tree operations.
+
+    The controller requires the GPIO hardware to be present, so these benchmarks are skipped
+    if it cannot be created.
+    """
+    try:
+        from hxtleak.controller import HxtleakController
+        controller = HxtleakController('', replay_path=tempfile.mkdtemp())
+    except (ImportError, ValueError, RuntimeError) as e:
+        logging.warning("Skipping parameter tree benchmarks: %s", e)
+        return []
+
+    emulator = HxtleakEmulator(seed=1)
+    controller.process_input(emulator.scenario_packet())
+    controller.cleanup()
+
+    return [
+        Benchmark('param_tree.get(system)', lambda: controller.get('system')),
+        Benchmark('param_tree.get(event_log)', lambda: controller.get('event_log')),
+    ]
+
+
+def main():
+    """Run the benchmarks from the command line."""
+    parser = argparse.ArgumentParser(description="Hxtleak adapter microbenchmarks")
+    parser.add_argument(
+        '-o', '--output', default='bench_hxtleak.json',
+        help="JSON file to write results to (default: %(default)s)"
+    )
+    parser.add_argument('-c', '--compare', help="JSON results file to compare against")
+    parser.add_argument('-f', '--filter', default='', help="only run benchmarks matching this")
+    parser.add_argument(
+        '--min-time', type=float, default=0.2,
+        help="minimum time for each timing repeat in seconds (default: %(default)s)"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+
+    benchmarks = decoder_benchmarks() + event_logger_benchmarks() + param_tree_benchmarks()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as compare_file:
+            baseline = json.load(compare_file)['results']
+
+    results = {}
+    for benchmark in benchmarks:
+        if args.filter not in benchmark.name:
+            continue
+
+        result = benchmark.run(min_time=args.min_time)
+        results[benchmark.name] = result
+
+        compare = ''
+        if benchmark.name in baseline:
+            compare = " ({:+.1f}%)".format(
+                100.0 * (result['ops_per_sec'] / baseline[benchmark.name]['ops_per_sec'] - 1.0)
+            )
+        print("{:40s} {:12.0f} ops/s{:10s} {:6.2f} blocks/op {:8.1f} bytes/op".format(
+            benchmark.name, result['ops_per_sec'], compare,
+            result['alloc_blocks_per_op'], result['alloc_bytes_per_op']
+        ))
+
+    output = {
+        'version': hxtleak.__version__,
+        'timestamp': datetime.now().isoformat(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+    with open(args.output, 'w') as output_file:
+        json.dump(output, output_file, indent=2)
+
+    print("Results written to {}".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,26 @@
 """odin-control adapter for the HEXITEC leak detector system.
 
-This class initialises the adapter which sets the port name and creates
+This class initialises the adapter which sets the port name, or capture replay, and creates
 the controller object, and handles HTTP requests to the adapter.
 
 James Foster, STFC Detector Systems Software Group
 """
+import json
 import logging
 
-from odin.adapters.adapter import ApiAdapter, ApiAdapterResponse, request_types, response_types
+from odin.adapters.adapter import ApiAdapterResponse, request_types, response_types
+from odin.adapters.async_adapter import AsyncApiAdapter
 from odin.adapters.parameter_tree import ParameterTreeError
 from odin.util import decode_request_body
+from tornado.ioloop import IOLoop
 
 from hxtleak.controller import HxtleakController
+from hxtleak.export import HxtleakBinaryEncoder
+from hxtleak.stream import HxtleakStreamServer
 from hxtleak.util import HxtleakError
 
 
-class HxtleakAdapter(ApiAdapter):
+class HxtleakAdapter(AsyncApiAdapter):
     """Main adapter class for the Hxtleak adapter."""
 
     def __init__(self, **kwargs):
@@ -29,36 +34,160 @@ class HxtleakAdapter(ApiAdapter):
 
         # Parse options
         port_name = str(self.options.get('port_name', '/dev/ttyACM0'))
+        capture_path = self.options.get('capture_path', None)
+        capture_file_size = int(self.options.get('capture_file_size', 16)) * 1024 * 1024
+        capture_max_files = int(self.options.get('capture_max_files', 16))
+        replay_path = self.options.get('replay_path', None)
+        replay_speed = float(self.options.get('replay_speed', 1.0))
+        history_size = int(self.options.get('history_size', 172800))
+        store_path = self.options.get('store_path', None)
+        store_segment_records = int(self.options.get('store_segment_records', 43200))
+        store_retention = float(self.options.get('store_retention_days', 30)) * 24 * 3600
+        cold_path = self.options.get('cold_path', None)
+        cold_retention = float(self.options.get('cold_retention_days', 365)) * 24 * 3600
+        event_log_size = int(self.options.get('event_log_size', 250))
+        stream_port = self.options.get('stream_port', None)
+        stream_address = str(self.options.get('stream_address', ''))
+
+        self.controller = HxtleakController(
+            port_name, capture_path=capture_path, capture_file_size=capture_file_size,
+            capture_max_files=capture_max_files, replay_path=replay_path, replay_speed=replay_speed,
+            history_size=history_size, store_path=store_path,
+            store_segment_records=store_segment_records, store_retention=store_retention,
+            cold_path=cold_path, cold_retention=cold_retention, event_log_size=event_log_size
+        )
+
+        # Start the streaming server if a port is configured
+        self.stream_server = None
+        if stream_port is not None:
+            self.stream_server = HxtleakStreamServer(
+                self.controller, int(stream_port), stream_address
+            )
 
-        self.controller = HxtleakController(port_name)
+        # Cache of the JSON-encoded responses to GET requests of versioned parameter subtrees,
+        # keyed by path and holding the subtree version each was encoded at
+        self.response_cache = {}
 
         logging.debug("HxtleakAdapter loaded")
 
-    @response_types('application/json', default='application/json')
-    def get(self, path, request):
+    @response_types('application/json', 'application/octet-stream', default='application/json')
+    async def get(self, path, request):
         """Handle an HTTP GET request.
 
-        This method handles an HTTP GET request, returning a JSON response.
+        This method handles an HTTP GET request, returning a JSON response. Query paths, e.g.
+        history/query, are resolved with the arguments in the request URI query string, and
+        their results returned as a binary payload if the request accepts application/octet-stream
+        in preference to JSON. Queries whose cost grows with the range queried are resolved and
+        encoded in an executor thread, so that they do not block packet reception and the other
+        clients served by the IOLoop.
+
+        The system subtree is served from the snapshot encoded by the controller each time the
+        system state changes. Responses for paths within other versioned subtrees of the parameter
+        tree are encoded once for each version of the subtree and served from the cache until it
+        changes.
+        The content of an unchanged response is therefore identical, so the ETag computed from it
+        by the HTTP handler is too, and requests with a matching If-None-Match header are answered
+        with 304 Not Modified.
 
         :param path: URI path of request
         :param request: HTTP request object
         :return: an ApiAdapterResponse object containing the appropriate response
         """
+        content_type = 'application/json'
+
         try:
-            response = self.controller.get(path)
+            if self.controller.has_query(path):
+                args = self._query_args(request)
+                binary = (
+                    path.strip('/') in self.controller.binary_queries
+                    and self._accepts_binary(request)
+                )
+                if path.strip('/') in self.controller.background_queries:
+                    response = await IOLoop.current().run_in_executor(
+                        None, self._query, path, args, binary
+                    )
+                else:
+                    response = self._query(path, args, binary)
+                if binary:
+                    content_type = 'application/octet-stream'
+            else:
+                response = self._get_versioned(path)
             status_code = 200
         except (ParameterTreeError, HxtleakError) as e:
             response = {'error': str(e)}
             status_code = 400
 
-        content_type = 'application/json'
-
         return ApiAdapterResponse(response, content_type=content_type,
                                   status_code=status_code)
 
+    def _query(self, path, args, binary):
+        """Resolve a query path, encoding the result as binary records if requested.
+
+        :param path: URI path of request
+        :param args: dict of query argument strings
+        :param binary: True if the result is to be encoded as binary records
+        :return: query result, encoded as binary records if requested
+        """
+        response = self.controller.query(path, args)
+        if binary:
+            response = HxtleakBinaryEncoder.encode(response)
+        return response
+
+    def _get_versioned(self, path):
+        """Get a path from the parameter tree, serving versioned subtrees as encoded JSON.
+
+        The system subtree is served from the snapshot encoded by the controller, and paths within
+        other versioned subtrees from the response cache.
+
+        :param path: URI path of request
+        :return: JSON-encoded string of the parameters if versioned, otherwise a dict
+        """
+        path = path.strip('/')
+        if path == 'system':
+            return self.controller.system_json()
+
+        version = self.controller.version(path)
+        if version is None:
+            return self.controller.get(path)
+
+        cached = self.response_cache.get(path)
+        if cached and cached[0] == version:
+            return cached[1]
+
+        # The version is read before the parameters are retrieved, so that any change while they
+        # are retrieved is encoded again on the next request
+        response = json.dumps(self.controller.get(path))
+        self.response_cache[path] = (version, response)
+        return response
+
+    @staticmethod
+    def _accepts_binary(request):
+        """Determine if a request accepts a binary response in preference to JSON.
+
+        :param request: HTTP request object
+        :return: True if application/octet-stream is the first of the types accepted
+        """
+        for accept_type in request.headers.get('Accept', '').split(','):
+            accept_type = accept_type.split(';')[0].strip()
+            if accept_type in ('application/json', 'application/octet-stream'):
+                return accept_type == 'application/octet-stream'
+        return False
+
+    @staticmethod
+    def _query_args(request):
+        """Extract the query arguments from a request.
+
+        :param request: HTTP request object
+        :return: dict of query argument strings, taking the last value of repeated arguments
+        """
+        query_arguments = getattr(request, 'query_arguments', None)
+        if not isinstance(query_arguments, dict):
+            return {}
+        return {name: values[-1].decode() for (name, values) in query_arguments.items()}
+
     @request_types('application/json', 'application/vnd.odin-native')
     @response_types('application/json', default='application/json')
-    def put(self, path, request):
+    async def put(self, path, request):
         """Handle an HTTP PUT request.
 
         This method handles an HTTP PUT request, decoding the request and attempting to set values
@@ -81,11 +210,13 @@ class HxtleakAdapter(ApiAdapter):
             response, content_type=content_type, status_code=status_code
         )
 
-    def cleanup(self):
+    async def cleanup(self):
         """Clean up the adapter.
 
         This method stops the background tasks, allowing the adapter state to be cleaned up
         correctly.
         """
         logging.debug("Cleanup called")
+        if self.stream_server:
+            self.stream_server.stop()
         self.controller.cleanup()
@@ -0,0 +1,235 @@
+"""Raw serial capture recording for the Hxtleak adapter.
+
+This module implements a recorder which captures the raw byte stream received on the serial port
+to rotating, append-only binary files, allowing the packet stream to be reconstructed when
+investigating incidents. Received data chunks are queued with a monotonic receive timestamp and
+written to disk by a background writer thread, so that recording never blocks packet reception.
+
+Each capture file starts with a header containing a magic identifier and the wall-clock and
+monotonic times at which the file was opened, followed by a sequence of chunk records, each
+comprising a header with the monotonic receive timestamp and length, followed by the chunk data.
+
+Tim Nicholls, STFC Detector Systems Software Group
+"""
+import logging
+import os
+import struct
+import threading
+import time
+from collections import deque
+
+from .util import HxtleakError
+
+
+class HxtleakCaptureFormat():
+    """Capture file format definitions."""
+
+    MAGIC = b'HXTCAP01'
+    FILE_HEADER = struct.Struct('<8sqQ')
+    CHUNK_HEADER = struct.Struct('<QI')
+    FILE_PREFIX = 'hxtleak_capture_'
+    FILE_SUFFIX = '.bin'
+
+
+class HxtleakCaptureRecorder():
+    """Raw serial capture recorder class."""
+
+    def __init__(
+        self, path, max_file_size=16*1024*1024, max_files=16, flush_interval=1.0, logger=None
+    ):
+        """Initialise the capture recorder.
+
+        :param path: directory in which to write capture files
+        :param max_file_size: size in bytes at which capture files are rotated
+        :param max_files: maximum number of capture files retained, oldest are deleted first
+        :param flush_interval: interval in seconds at which queued data is written and flushed
+        :param logger: logger instance to use, defaults to the root logger
+        """
+        self.path = path
+        self.max_file_size = max_file_size
+        self.max_files = max_files
+        self.flush_interval = flush_interval
+        self.logger = logger if logger else logging.getLogger()
+
+        try:
+            os.makedirs(self.path, exist_ok=True)
+        except OSError as e:
+            raise HxtleakError("Failed to create capture directory {}: {}".format(self.path, e))
+
+        self.enabled = False
+        self.file_name = None
+        self.bytes_written = 0
+        self.chunks_written = 0
+
+        self._chunks = deque()
+        self._file = None
+        self._file_size = 0
+        self._file_index = 0
+        self._wakeup = threading.Event()
+        self._writer = None
+
+    def record(self, data):
+        """Record a chunk of received data.
+
+        This method queues a chunk of received data, along with its monotonic receive timestamp,
+        for writing by the background writer. It is safe to call from any thread and never blocks.
+
+        :param data: bytes object containing received data
+        """
+        if self.enabled:
+            self._chunks.append((time.monotonic_ns(), data))
+
+    def set_enabled(self, enable):
+        """Enable or disable capture recording.
+
+        Enabling recording starts the background writer, which opens a new capture file.
+        Disabling recording stops the writer once all queued data has been written.
+
+        :param enable: capture enable state (True or False)
+        """
+        enable = bool(enable)
+        if enable == self.enabled:
+            return
+
+        if enable:
+            self.enabled = True
+            self._writer = threading.Thread(target=self._write_loop, daemon=True)
+            self._writer.start()
+            self.logger.info("Capture recording started in %s", self.path)
+        else:
+            self.enabled = False
+            self._wakeup.set()
+            self._writer.join()
+            self._writer = None
+            self.logger.info("Capture recording stopped")
+
+    def tree(self):
+        """Return a dict-like tree of capture recorder parameters.
+
+        :return dict-like tree of capture parameter accessors
+        """
+        return {
+            'enabled': (lambda: self.enabled, self.set_enabled),
+            'path': (lambda: self.path, None),
+            'file_name': (lambda: self.file_name, None),
+            'bytes_written': (lambda: self.bytes_written, None),
+            'chunks_written': (lambda: self.chunks_written, None),
+        }
+
+    def _write_loop(self):
+        """Run the background capture writer.
+
+        This method runs in the writer thread, periodically writing all queued chunks to the
+        current capture file and flushing it. Writing stops if an error occurs.
+        """
+        try:
+            self._open_file()
+            while self.enabled:
+                self._wakeup.wait(self.flush_interval)
+                self._wakeup.clear()
+                self._write_chunks()
+            self._write_chunks()
+        except OSError as e:
+            self.enabled = False
+            self.logger.error("Capture recording failed: %s", e)
+        finally:
+            self._close_file()
+
+    def _write_chunks(self):
+        """Write all queued chunks to the capture file and flush it, rotating files as needed."""
+        pack_header = HxtleakCaptureFormat.CHUNK_HEADER.pack
+        header_size = HxtleakCaptureFormat.CHUNK_HEADER.size
+
+        written = 0
+        while self._chunks:
+            (timestamp, data) = self._chunks.popleft()
+            chunk_size = header_size + len(data)
+
+            # Rotate to a new file if this chunk would exceed the maximum size of a non-empty file
+            if (self._file_size + chunk_size > self.max_file_size
+                    and self._file_size > HxtleakCaptureFormat.FILE_HEADER.size):
+                self._close_file()
+                self._open_file()
+
+            self._file.write(pack_header(timestamp, len(data)))
+            self._file.write(data)
+            self._file_size += chunk_size
+            self.bytes_written += len(data)
+            self.chunks_written += 1
+            written += 1
+
+        if written:
+            self._file.flush()
+
+    def _open_file(self):
+        """Open a new capture file, deleting the oldest files beyond the retention limit."""
+        self._file_index += 1
+        self.file_name = os.path.join(self.path, "{}{}_{:04d}{}".format(
+            HxtleakCaptureFormat.FILE_PREFIX, time.strftime("%Y%m%d-%H%M%S"),
+            self._file_index, HxtleakCaptureFormat.FILE_SUFFIX
+        ))
+
+        self._file = open(self.file_name, 'ab')
+        self._file.write(HxtleakCaptureFormat.FILE_HEADER.pack(
+            HxtleakCaptureFormat.MAGIC, time.time_ns(), time.monotonic_ns()
+        ))
+        self._file_size = HxtleakCaptureFormat.FILE_HEADER.size
+
+        for file_name in capture_files(self.path)[:-self.max_files]:
+            os.remove(file_name)
+
+    def _close_file(self):
+        """Close the current capture file."""
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+def capture_files(path):
+    """Return the capture files in a directory.
+
+    :param path: directory containing capture files
+    :return: list of capture file paths, sorted from oldest to newest
+    """
+    return sorted(
+        os.path.join(path, file_name) for file_name in os.listdir(path)
+        if file_name.startswith(HxtleakCaptureFormat.FILE_PREFIX)
+        and file_name.endswith(HxtleakCaptureFormat.FILE_SUFFIX)
+    )
+
+
+def read_capture(path):
+    """Read the chunks recorded in capture files.
+
+    This generator reads the chunks recorded in a capture file, or all capture files in a
+    directory in order, yielding each chunk with its receive timestamp converted to wall-clock
+    time using the file header.
+
+    :param path: capture file or directory containing capture files
+    :return: generator yielding tuples of receive time in nanoseconds since the epoch and data
+    """
+    file_names = capture_files(path) if os.path.isdir(path) else [path]
+    file_header = HxtleakCaptureFormat.FILE_HEADER
+    chunk_header = HxtleakCaptureFormat.CHUNK_HEADER
+
+    for file_name in file_names:
+        with open(file_name, 'rb') as capture_file:
+
+            header = capture_file.read(file_header.size)
+            if len(header) < file_header.size:
+                continue
+
+            (magic, wall_time, mono_time) = file_header.unpack(header)
+            if magic != HxtleakCaptureFormat.MAGIC:
+                raise HxtleakError("File {} is not a valid capture file".format(file_name))
+            time_offset = wall_time - mono_time
+
+            while True:
+                header = capture_file.read(chunk_header.size)
+                if len(header) < chunk_header.size:
+                    break
+                (timestamp, length) = chunk_header.unpack(header)
+                data = capture_file.read(length)
+                if len(data) < length:
+                    break
+                yield (timestamp + time_offset, data)
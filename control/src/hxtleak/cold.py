@@ -0,0 +1,935 @@
+"""Compressed cold history tier for the Hxtleak adapter.
+
+This module implements a compressed, full-resolution history tier intended for long retention on
+limited storage. Samples are compressed as they are received into blocks, using the Gorilla time
+series encodings: timestamps are stored as delta-of-deltas, and each float channel as the XOR of
+successive values, so that the slowly changing sensor values take a few bits per sample and the
+almost constant thresholds a single bit. The flag and status byte channels are stored as one bit
+if unchanged, otherwise as the full byte.
+
+Each channel is compressed into a separate bit stream, allowing queries to decode only the
+channels requested. When a block reaches its sample capacity it is sealed and appended to the
+current cold tier file, with a header holding the time range, sample count and the minimum,
+maximum and sum of each float channel. The block headers form an index, allowing queries to skip
+blocks outside the requested time range and to answer coarse queries from the block summaries
+without decoding the blocks at all.
+
+Sealed blocks are encoded and written to file by a background writer thread, so that sealing never
+blocks the caller. The writer also periodically checkpoints the current unsealed block to a separate
+file, which is recovered as a sealed block when the cold tier is reopened, bounding the samples lost
+if the adapter is stopped without the block being sealed.
+
+Tim Nicholls, STFC Detector Systems Software Group
+"""
+import logging
+import os
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+
+from .history import HxtleakHistory, bucket_bounds
+from .util import HxtleakError
+
+
+class HxtleakColdFormat():
+    """Cold tier block and file format definitions."""
+
+    MAGIC = b'HXGB'
+    FILE_PREFIX = 'hxtleak_cold_'
+    FILE_SUFFIX = '.gor'
+    CHECKPOINT_NAME = 'hxtleak_cold_open.chk'
+
+    # Float channels in the order in which they appear in the raw packet, followed by the byte
+    # channels. The float channels are unpacked from the raw packet as their 32-bit patterns.
+    FLOAT_FIELDS = (
+        'board_temp_threshold', 'board_humidity_threshold', 'probe_temp_1_threshold',
+        'probe_temp_2_threshold', 'board_temp', 'board_humidity', 'probe_temp_1', 'probe_temp_2',
+    )
+    BYTE_FIELDS = ('flags', 'sensor_status')
+    RAW_CHANNELS = struct.Struct('<8I4?B')
+
+    # Block header: magic, sample count, first and last timestamps, the minimum, maximum and sum
+    # of each float channel, the bitwise OR of each byte channel and the length of each stream
+    HEADER = struct.Struct('<4sIdd8f8f8d2B11I')
+
+
+class _BitWriter():
+    """Bit stream writer, accumulating bits into a bytearray."""
+
+    def __init__(self):
+        """Initialise the bit writer."""
+        self.buffer = bytearray()
+        self.bits = 0
+        self._acc = 0
+        self._acc_bits = 0
+
+    def write(self, value, num_bits):
+        """Write the least significant bits of a value to the stream.
+
+        :param value: non-negative integer value to write
+        :param num_bits: number of bits of the value to write
+        """
+        self._acc = (self._acc << num_bits) | value
+        self._acc_bits += num_bits
+        self.bits += num_bits
+
+        # Move whole bytes from the accumulator to the buffer once it holds enough bits, keeping
+        # the accumulator small so that writes are O(1)
+        if self._acc_bits >= 32:
+            num_bytes = self._acc_bits >> 3
+            shift = self._acc_bits & 7
+            self.buffer += (self._acc >> shift).to_bytes(num_bytes, 'big')
+            self._acc &= (1 << shift) - 1
+            self._acc_bits = shift
+
+    def getvalue(self):
+        """Return the stream contents, padded with zero bits to a whole number of bytes."""
+        pad = -self._acc_bits & 7
+        tail = (self._acc << pad).to_bytes((self._acc_bits + pad) >> 3, 'big')
+        return bytes(self.buffer) + tail
+
+
+class _BitReader():
+    """Bit stream reader."""
+
+    def __init__(self, data):
+        """Initialise the bit reader.
+
+        :param data: bytes-like object containing the stream
+        """
+        self.data = bytes(data) + bytes(9)
+        self.pos = 0
+
+    def read(self, num_bits):
+        """Read bits from the stream.
+
+        :param num_bits: number of bits to read, at most 64
+        :return: integer value of the bits read
+        """
+        (byte_pos, bit_pos) = divmod(self.pos, 8)
+        window = int.from_bytes(self.data[byte_pos:byte_pos + 9], 'big')
+        self.pos += num_bits
+        return (window >> (72 - bit_pos - num_bits)) & ((1 << num_bits) - 1)
+
+
+class _TimestampEncoder():
+    """Delta-of-delta timestamp encoder, operating on integer millisecond timestamps."""
+
+    # Delta-of-delta ranges as (prefix value, prefix bits, value bits), tried in order
+    RANGES = ((0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12), (0b1111, 4, 32))
+
+    def __init__(self, writer):
+        """Initialise the encoder."""
+        self.writer = writer
+        self.count = 0
+        self.prev = 0
+        self.prev_delta = 0
+
+    def encode(self, value):
+        """Encode a timestamp in milliseconds."""
+        writer = self.writer
+        if self.count == 0:
+            writer.write(value & 0xFFFFFFFFFFFFFFFF, 64)
+        elif self.count == 1:
+            self.prev_delta = value - self.prev
+            writer.write(self.prev_delta & 0xFFFFFFFF, 32)
+        else:
+            delta = value - self.prev
+            dod = delta - self.prev_delta
+            self.prev_delta = delta
+            if dod == 0:
+                writer.write(0, 1)
+            else:
+                for (prefix, prefix_bits, value_bits) in self.RANGES:
+                    limit = 1 << (value_bits - 1)
+                    if -limit <= dod < limit or value_bits == 32:
+                        writer.write(prefix, prefix_bits)
+                        writer.write(dod & ((1 << value_bits) - 1), value_bits)
+                        break
+        self.prev = value
+        self.count += 1
+
+    @classmethod
+    def decode(cls, reader, count):
+        """Decode timestamps in milliseconds from a stream.
+
+        :param reader: bit stream reader
+        :param count: number of timestamps to decode
+        :return: list of timestamps
+        """
+        values = []
+        if count == 0:
+            return values
+
+        value = _signed(reader.read(64), 64)
+        values.append(value)
+        if count > 1:
+            delta = _signed(reader.read(32), 32)
+            value += delta
+            values.append(value)
+
+        for _ in range(count - 2):
+            if reader.read(1):
+                if not reader.read(1):
+                    value_bits = 7
+                elif not reader.read(1):
+                    value_bits = 9
+                elif not reader.read(1):
+                    value_bits = 12
+                else:
+                    value_bits = 32
+                delta += _signed(reader.read(value_bits), value_bits)
+            value += delta
+            values.append(value)
+
+        return values
+
+
+class _FloatEncoder():
+    """XOR encoder for the 32-bit patterns of float values."""
+
+    def __init__(self, writer):
+        """Initialise the encoder."""
+        self.writer = writer
+        self.count = 0
+        self.prev = 0
+        self.leading = 33
+        self.trailing = 0
+
+    def encode(self, value):
+        """Encode the 32-bit pattern of a float value."""
+        writer = self.writer
+        if self.count == 0:
+            writer.write(value, 32)
+        else:
+            xor = value ^ self.prev
+            if xor == 0:
+                writer.write(0, 1)
+            else:
+                leading = 32 - xor.bit_length()
+                trailing = (xor & -xor).bit_length() - 1
+
+                # Reuse the previous meaningful bit window if the value fits within it, otherwise
+                # write a new window
+                if leading >= self.leading and trailing >= self.trailing:
+                    writer.write(0b10, 2)
+                    writer.write(xor >> self.trailing, 32 - self.leading - self.trailing)
+                else:
+                    length = 32 - leading - trailing
+                    writer.write(0b11, 2)
+                    writer.write(leading, 5)
+                    writer.write(length - 1, 5)
+                    writer.write(xor >> trailing, length)
+                    self.leading = leading
+                    self.trailing = trailing
+        self.prev = value
+        self.count += 1
+
+    @staticmethod
+    def decode(reader, count):
+        """Decode the 32-bit patterns of float values from a stream.
+
+        :param reader: bit stream reader
+        :param count: number of values to decode
+        :return: array of float values
+        """
+        values = array('I')
+        if count == 0:
+            return array('f')
+
+        value = reader.read(32)
+        values.append(value)
+        (leading, trailing) = (0, 0)
+
+        for _ in range(count - 1):
+            if reader.read(1):
+                if reader.read(1):
+                    leading = reader.read(5)
+                    length = reader.read(5) + 1
+                    trailing = 32 - leading - length
+                value ^= reader.read(32 - leading - trailing) << trailing
+            values.append(value)
+
+        return array('f', values.tobytes())
+
+
+class _ByteEncoder():
+    """Encoder for byte values, storing unchanged values as a single bit."""
+
+    def __init__(self, writer):
+        """Initialise the encoder."""
+        self.writer = writer
+        self.count = 0
+        self.prev = None
+
+    def encode(self, value):
+        """Encode a byte value."""
+        if self.count == 0:
+            self.writer.write(value, 8)
+        elif value == self.prev:
+            self.writer.write(0, 1)
+        else:
+            self.writer.write(0x100 | value, 9)
+        self.prev = value
+        self.count += 1
+
+    @staticmethod
+    def decode(reader, count):
+        """Decode byte values from a stream.
+
+        :param reader: bit stream reader
+        :param count: number of values to decode
+        :return: array of byte values
+        """
+        values = array('B')
+        if count == 0:
+            return values
+
+        value = reader.read(8)
+        values.append(value)
+        for _ in range(count - 1):
+            if reader.read(1):
+                value = reader.read(8)
+            values.append(value)
+
+        return values
+
+
+def _signed(value, num_bits):
+    """Convert an unsigned integer of the specified width to a signed value."""
+    return value - (1 << num_bits) if value >> (num_bits - 1) else value
+
+
+class HxtleakColdBlock():
+    """Cold tier block class, compressing samples into per-channel bit streams."""
+
+    STREAMS = ('timestamp',) + HxtleakColdFormat.FLOAT_FIELDS + HxtleakColdFormat.BYTE_FIELDS
+
+    def __init__(self):
+        """Initialise an empty block."""
+        self.writers = [_BitWriter() for _ in self.STREAMS]
+        self.encoders = (
+            [_TimestampEncoder(self.writers[0])]
+            + [_FloatEncoder(writer) for writer in self.writers[1:9]]
+            + [_ByteEncoder(writer) for writer in self.writers[9:]]
+        )
+
+        self.count = 0
+        self.first = None
+        self.last = None
+        self.mins = [float('inf')] * 8
+        self.maxs = [float('-inf')] * 8
+        self.sums = [0.0] * 8
+        self.bits_or = [0, 0]
+
+    def append(self, timestamp, packet):
+        """Append a sample to the block.
+
+        :param timestamp: wall-clock receive time of the packet in seconds since the epoch
+        :param packet: decoded packet snapshot
+        """
+        (*float_bits, leak, cont, fault, warning, status) = (
+            HxtleakColdFormat.RAW_CHANNELS.unpack_from(packet.raw)
+        )
+        flags = leak | cont << 1 | fault << 2 | warning << 3
+
+        encoders = self.encoders
+        encoders[0].encode(int(timestamp * 1000))
+        for (encoder, value) in zip(encoders[1:9], float_bits):
+            encoder.encode(value)
+        encoders[9].encode(flags)
+        encoders[10].encode(status)
+
+        values = packet[:8]
+        for idx in range(8):
+            value = values[idx]
+            if value < self.mins[idx]:
+                self.mins[idx] = value
+            if value > self.maxs[idx]:
+                self.maxs[idx] = value
+            self.sums[idx] += value
+        self.bits_or[0] |= flags
+        self.bits_or[1] |= status
+
+        if self.first is None:
+            self.first = timestamp
+        self.last = timestamp
+        self.count += 1
+
+    def encoded_size(self):
+        """Return the current encoded size of the block in bytes."""
+        return HxtleakColdFormat.HEADER.size + sum(
+            (writer.bits + 7) >> 3 for writer in self.writers
+        )
+
+    def seal(self):
+        """Seal the block, returning its encoded header and streams.
+
+        :return: bytes object containing the encoded block
+        """
+        streams = [writer.getvalue() for writer in self.writers]
+        header = HxtleakColdFormat.HEADER.pack(
+            HxtleakColdFormat.MAGIC, self.count, self.first, self.last,
+            *self.mins, *self.maxs, *self.sums, *self.bits_or,
+            *(len(stream) for stream in streams)
+        )
+        return header + b''.join(streams)
+
+
+class HxtleakColdBlockIndex():
+    """Cold tier block index entry class, holding the location and summary of a sealed block."""
+
+    def __init__(self, file_name, offset, header, data=None):
+        """Initialise the index entry from a block header.
+
+        :param file_name: path of the file containing the block
+        :param offset: offset of the block in the file
+        :param header: tuple of unpacked block header values
+        :param data: encoded block streams, if the block is held in memory rather than in a file
+        """
+        self.file_name = file_name
+        self.offset = offset
+        self.data = data
+        (_, self.count, self.first, self.last) = header[:4]
+        self.mins = header[4:12]
+        self.maxs = header[12:20]
+        self.sums = header[20:28]
+        self.bits_or = header[28:30]
+        self.stream_sizes = header[30:]
+        self.size = HxtleakColdFormat.HEADER.size + sum(self.stream_sizes)
+
+    def decode(self, fields):
+        """Decode channels of the block.
+
+        :param fields: iterable of channel names to decode, in addition to the timestamps
+        :return: dict of arrays of channel values keyed by channel name
+        """
+        data = self.data
+        if data is None:
+            # The file may be deleted by the background writer once the block has expired
+            try:
+                with open(self.file_name, 'rb') as cold_file:
+                    cold_file.seek(self.offset + HxtleakColdFormat.HEADER.size)
+                    data = cold_file.read(self.size - HxtleakColdFormat.HEADER.size)
+            except OSError as e:
+                raise HxtleakError(
+                    "Failed to read cold tier file {}: {}".format(self.file_name, e)
+                )
+
+        offsets = [0]
+        for size in self.stream_sizes:
+            offsets.append(offsets[-1] + size)
+
+        columns = {}
+        for (idx, name) in enumerate(HxtleakColdBlock.STREAMS):
+            if name != 'timestamp' and name not in fields:
+                continue
+            reader = _BitReader(data[offsets[idx]:offsets[idx + 1]])
+            if name == 'timestamp':
+                columns[name] = array(
+                    'd', (value / 1000 for value in _TimestampEncoder.decode(reader, self.count))
+                )
+            elif name in HxtleakColdFormat.BYTE_FIELDS:
+                columns[name] = _ByteEncoder.decode(reader, self.count)
+            else:
+                columns[name] = _FloatEncoder.decode(reader, self.count)
+
+        return columns
+
+
+class HxtleakColdTier():
+    """Compressed cold history tier class."""
+
+    # Maximum step in seconds between successive timestamps in a block
+    MAX_TIMESTAMP_STEP = 24 * 3600
+
+    def __init__(
+        self, path, block_samples=7200, blocks_per_file=24, retention=365*24*3600,
+        max_query_records=345600, checkpoint_interval=60.0, logger=None
+    ):
+        """Initialise the cold tier.
+
+        :param path: directory in which to store cold tier files
+        :param block_samples: number of samples compressed into each block
+        :param blocks_per_file: number of blocks stored in each file before rotation
+        :param retention: time in seconds for which blocks are retained
+        :param max_query_records: maximum number of samples decoded by a single query
+        :param checkpoint_interval: interval in seconds at which the unsealed block is checkpointed
+        :param logger: logger instance to use, defaults to the root logger
+        """
+        self.path = path
+        self.block_samples = block_samples
+        self.blocks_per_file = blocks_per_file
+        self.retention = retention
+        self.max_query_records = max_query_records
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_name = os.path.join(self.path, HxtleakColdFormat.CHECKPOINT_NAME)
+        self.logger = logger if logger else logging.getLogger()
+
+        try:
+            os.makedirs(self.path, exist_ok=True)
+        except OSError as e:
+            raise HxtleakError("Failed to create cold tier directory {}: {}".format(self.path, e))
+
+        # Build the block index from the existing cold tier files
+        self.blocks = []
+        self.file_name = None
+        self._file_blocks = 0
+        for file_name in cold_files(self.path):
+            self.blocks.extend(self._load_index(file_name))
+
+        self.block = HxtleakColdBlock()
+        self.samples_written = 0
+        self.bytes_written = 0
+
+        # The lock protects the current block, the queue of sealed blocks and the block index,
+        # which are accessed by both the caller and the background writer
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._written = threading.Condition(self._lock)
+        self._checkpoint_count = 0
+
+        # Recover the unsealed block checkpointed before the cold tier was last closed, unless its
+        # samples were sealed before the checkpoint was updated
+        self._recover_checkpoint()
+
+        # Start the background writer, which writes sealed blocks queued by the caller and
+        # checkpoints the current block
+        self._running = True
+        self._wakeup = threading.Event()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def _load_index(self, file_name):
+        """Load the index entries of the blocks in a cold tier file, stopping at any invalid block.
+
+        :param file_name: path of the cold tier file
+        :return: list of HxtleakColdBlockIndex entries
+        """
+        entries = []
+        header_size = HxtleakColdFormat.HEADER.size
+        with open(file_name, 'rb') as cold_file:
+            offset = 0
+            while True:
+                cold_file.seek(offset)
+                header = cold_file.read(header_size)
+                if len(header) < header_size:
+                    break
+                values = HxtleakColdFormat.HEADER.unpack(header)
+                if values[0] != HxtleakColdFormat.MAGIC:
+                    self.logger.warning("Invalid cold tier block in %s at %d", file_name, offset)
+                    break
+                entry = HxtleakColdBlockIndex(file_name, offset, values)
+                if offset + entry.size > os.fstat(cold_file.fileno()).st_size:
+                    break
+                entries.append(entry)
+                offset += entry.size
+        return entries
+
+    def append(self, timestamp, packet):
+        """Append a sample to the cold tier, sealing the current block when full.
+
+        :param timestamp: wall-clock receive time of the packet in seconds since the epoch
+        :param packet: decoded packet snapshot
+        """
+        # The current block is only accessed under the lock, since it is also read by the
+        # background writer when checkpointing and by queries
+        with self._lock:
+            # Seal the current block before a timestamp step, e.g. the wall clock being set at
+            # boot, which would exceed the range of the timestamp encoding
+            sealed = False
+            if (
+                self.block.count
+                and not 0 <= timestamp - self.block.last < self.MAX_TIMESTAMP_STEP
+            ):
+                sealed = self._queue_block()
+
+            self.block.append(timestamp, packet)
+            if self.block.count >= self.block_samples:
+                sealed = self._queue_block()
+
+        if sealed:
+            self._wakeup.set()
+
+    def seal(self):
+        """Seal the current block, queueing it to be written by the background writer.
+
+        The block remains queryable while queued, so that it is never missing from query results.
+        """
+        with self._lock:
+            sealed = self._queue_block()
+        if sealed:
+            self._wakeup.set()
+
+    def _queue_block(self):
+        """Queue the current block to be written, replacing it with an empty block.
+
+        This method must be called with the lock held.
+
+        :return: True if the current block held samples and was queued
+        """
+        if not self.block.count:
+            return False
+        self._pending.append(self.block)
+        self.block = HxtleakColdBlock()
+        return True
+
+    def flush(self, timeout=None):
+        """Wait until all sealed blocks have been written by the background writer.
+
+        :param timeout: maximum time in seconds to wait, or None to wait indefinitely
+        :return: True if all sealed blocks were written
+        """
+        with self._written:
+            return self._written.wait_for(lambda: not self._pending, timeout)
+
+    def close(self):
+        """Seal the current block and stop the background writer once all blocks are written."""
+        self.seal()
+        self._running = False
+        self._wakeup.set()
+        self._writer.join()
+
+    def _write_loop(self):
+        """Run the background writer.
+
+        This method runs in the writer thread, writing sealed blocks as they are queued and
+        checkpointing the current block at the checkpoint interval.
+        """
+        while self._running:
+            self._wakeup.wait(self.checkpoint_interval)
+            self._wakeup.clear()
+            self._write_blocks()
+            self._write_checkpoint()
+        self._write_blocks()
+        self._write_checkpoint()
+
+    def _write_blocks(self):
+        """Encode and write all queued sealed blocks, adding them to the block index."""
+        while self._pending:
+            block = self._pending[0]
+            data = block.seal()
+            entry = self._write_block(data)
+            with self._written:
+                self._pending.popleft()
+                if entry:
+                    self.blocks.append(entry)
+                self._written.notify_all()
+            if entry:
+                self.samples_written += block.count
+                self.bytes_written += len(data)
+
+    def _write_block(self, data):
+        """Append an encoded block to the current cold tier file, rotating files as needed.
+
+        :param data: bytes object containing the encoded block
+        :return: index entry of the written block, or None if the block could not be written
+        """
+        # Rotate to a new file once the current file holds the maximum number of blocks
+        header = HxtleakColdFormat.HEADER.unpack_from(data)
+        if self.file_name is None or self._file_blocks >= self.blocks_per_file:
+            self._open_file(header[2])
+
+        try:
+            with open(self.file_name, 'ab') as cold_file:
+                offset = cold_file.tell()
+                cold_file.write(data)
+        except OSError as e:
+            self.logger.error("Failed to write cold tier block: %s", e)
+            return None
+
+        self._file_blocks += 1
+        return HxtleakColdBlockIndex(self.file_name, offset, header)
+
+    def _write_checkpoint(self):
+        """Write the current unsealed block to the checkpoint file if it has changed.
+
+        The checkpoint is written to a temporary file which then replaces the checkpoint, so that
+        a valid checkpoint always exists. The checkpoint is removed once the block is empty.
+        """
+        with self._lock:
+            count = self.block.count
+            data = self.block.seal() if count else None
+        if count == self._checkpoint_count:
+            return
+
+        try:
+            if data:
+                temp_name = self.checkpoint_name + '.tmp'
+                with open(temp_name, 'wb') as checkpoint_file:
+                    checkpoint_file.write(data)
+                os.replace(temp_name, self.checkpoint_name)
+            else:
+                os.remove(self.checkpoint_name)
+            self._checkpoint_count = count
+        except OSError as e:
+            self.logger.error("Failed to write cold tier checkpoint: %s", e)
+
+    def _recover_checkpoint(self):
+        """Recover a checkpointed unsealed block, appending it to the cold tier as a block."""
+        try:
+            with open(self.checkpoint_name, 'rb') as checkpoint_file:
+                data = checkpoint_file.read()
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            self.logger.warning("Failed to read cold tier checkpoint: %s", e)
+            return
+
+        # Discard the checkpoint if it is invalid or holds samples which were sealed before it was
+        # updated
+        valid = False
+        if len(data) >= HxtleakColdFormat.HEADER.size:
+            entry = HxtleakColdBlockIndex(None, 0, HxtleakColdFormat.HEADER.unpack_from(data))
+            valid = (
+                data[:4] == HxtleakColdFormat.MAGIC and entry.size == len(data)
+                and (not self.blocks or entry.first > self.blocks[-1].last)
+            )
+
+        if valid:
+            entry = self._write_block(data)
+            if entry:
+                self.blocks.append(entry)
+                self.logger.info("Recovered %d samples from cold tier checkpoint", entry.count)
+        else:
+            self.logger.warning("Discarding cold tier checkpoint %s", self.checkpoint_name)
+
+        try:
+            os.remove(self.checkpoint_name)
+        except OSError as e:
+            self.logger.warning("Failed to remove cold tier checkpoint: %s", e)
+
+    def _open_file(self, timestamp):
+        """Start a new cold tier file, deleting files older than the retention period.
+
+        :param timestamp: timestamp of the first sample in the file, used to name the file
+        """
+        self.file_name = os.path.join(self.path, "{}{:018d}{}".format(
+            HxtleakColdFormat.FILE_PREFIX, int(timestamp * 1e6), HxtleakColdFormat.FILE_SUFFIX
+        ))
+        self._file_blocks = 0
+
+        # Delete files whose newest block is older than the retention period
+        cutoff = time.time() - self.retention
+        last_times = {}
+        for entry in self.blocks:
+            last_times[entry.file_name] = max(
+                last_times.get(entry.file_name, entry.last), entry.last
+            )
+        expired = {name for (name, last) in last_times.items() if last < cutoff}
+        if expired:
+            with self._lock:
+                self.blocks = [entry for entry in self.blocks if entry.file_name not in expired]
+            for file_name in expired:
+                try:
+                    os.remove(file_name)
+                    self.logger.info("Deleted expired cold tier file %s", file_name)
+                except OSError as e:
+                    self.logger.warning(
+                        "Failed to delete expired cold tier file %s: %s", file_name, e
+                    )
+
+    def first_timestamp(self):
+        """Return the timestamp of the oldest sample, or None if the cold tier is empty."""
+        with self._lock:
+            for blocks in (self.blocks, self._pending):
+                if blocks:
+                    return blocks[0].first
+            return self.block.first
+
+    def query(self, start=None, end=None, fields=None, points=1000, method='minmax'):
+        """Query the cold tier over a time range, reducing it to a target number of points.
+
+        Blocks outside the time range are skipped using the block index. If a minmax query is
+        requested at a point spacing coarser than the blocks overlapping the range, it is
+        answered from the block summaries without decoding. Otherwise, the requested channels of
+        the overlapping blocks, including the blocks not yet written and the current unsealed
+        block, are decoded into a temporary history which is queried as for the in-memory history.
+        If the range holds too many samples to decode, a reduced query is instead answered from
+        the block summaries, at the resolution of one block per point.
+
+        :param start: start of time range in seconds since the epoch, or None for the oldest
+        :param end: end of time range in seconds since the epoch, or None for the newest
+        :param fields: iterable of channel names to return, or None for all channels
+        :param points: target number of points to reduce the samples to
+        :param method: reduction method, one of HxtleakHistory.QUERY_METHODS
+        :return: dict of query results
+        """
+        fields = [
+            name for name in (HxtleakHistory.FIELD_NAMES if fields is None else fields)
+            if name != 'timestamp'
+        ]
+        for name in fields:
+            if name not in HxtleakColdBlock.STREAMS:
+                raise HxtleakError("Unknown history field {}".format(name))
+
+        # Select the blocks overlapping the time range, including unwritten and unsealed blocks
+        entries = self._entries(start, end)
+
+        if method == 'minmax' and entries and start is not None and end is not None:
+            spacing = (end - start) / max(points, 1)
+            if all(entry.last - entry.first <= spacing for entry in entries):
+                return self._query_summaries(start, end, fields, points, entries)
+
+        count = sum(entry.count for entry in entries)
+        if count > self.max_query_records:
+            if method != 'raw':
+                return self._query_summaries(
+                    entries[0].first if start is None else start,
+                    entries[-1].last if end is None else end,
+                    fields, points, entries
+                )
+            raise HxtleakError(
+                "History query range contains too many records ({} > {})".format(
+                    count, self.max_query_records
+                )
+            )
+
+        # Decode the requested channels of each block and concatenate them in the history
+        columns = {name: None for name in ['timestamp'] + fields}
+        for entry in entries:
+            for (name, column) in entry.decode(fields).items():
+                if columns[name] is None:
+                    columns[name] = column
+                else:
+                    columns[name].extend(column)
+
+        history = HxtleakHistory.from_columns({
+            name: array('d') if column is None else column for (name, column) in columns.items()
+        })
+        return history.query(start, end, fields, points, method)
+
+    def export(self, start=None, end=None, fields=None):
+        """Export the samples in a time range in chunks of one block.
+
+        The blocks overlapping the range, including the unwritten blocks and a snapshot of the
+        current unsealed block, are selected when called, and each block decoded only as the
+        returned generator is consumed.
+
+        :param start: start of time range in seconds since the epoch, or None for the oldest
+        :param end: end of time range in seconds since the epoch, or None for the newest
+        :param fields: iterable of channel names to export, or None for all channels
+        :return: generator yielding dicts of lists of channel values keyed by channel name
+        """
+        fields = HxtleakHistory.export_fields(fields)
+        return self._export_chunks(start, end, fields, self._entries(start, end))
+
+    @staticmethod
+    def _export_chunks(start, end, fields, entries):
+        """Generate chunks of exported samples decoded from the selected blocks."""
+        for entry in entries:
+            columns = entry.decode(fields[1:])
+            timestamps = columns['timestamp']
+            first = 0 if start is None else bisect_left(timestamps, start)
+            last = len(timestamps) if end is None else bisect_right(timestamps, end)
+            if last > first:
+                yield {name: columns[name][first:last].tolist() for name in fields}
+
+    def _entries(self, start, end):
+        """Return index entries for the blocks overlapping a time range.
+
+        The entries of the written blocks are followed by in-memory entries for the sealed blocks
+        not yet written and for the current unsealed block, if not empty.
+
+        :param start: start of time range in seconds since the epoch, or None for the oldest
+        :param end: end of time range in seconds since the epoch, or None for the newest
+        :return: list of HxtleakColdBlockIndex entries
+        """
+        header_size = HxtleakColdFormat.HEADER.size
+        with self._lock:
+            entries = list(self.blocks)
+            for block in list(self._pending) + [self.block]:
+                if block.count:
+                    data = block.seal()
+                    entries.append(HxtleakColdBlockIndex(
+                        None, 0, HxtleakColdFormat.HEADER.unpack_from(data), data[header_size:]
+                    ))
+
+        return [
+            entry for entry in entries
+            if (start is None or entry.last >= start) and (end is None or entry.first <= end)
+        ]
+
+    def _query_summaries(self, start, end, fields, points, entries):
+        """Answer a minmax query from the summaries of the blocks overlapping the time range."""
+        starts = [entry.first for entry in entries]
+        bounds = bucket_bounds(starts, points)
+
+        result = {
+            'start': start,
+            'end': end,
+            'count': sum(entry.count for entry in entries),
+            'method': 'minmax',
+            'tier': 'cold',
+            'timestamp': [t_bucket for (t_bucket, _, _) in bounds],
+            'fields': {},
+        }
+
+        for name in fields:
+            if name in HxtleakColdFormat.BYTE_FIELDS:
+                idx = HxtleakColdFormat.BYTE_FIELDS.index(name)
+                result['fields'][name] = [
+                    _or_all(entry.bits_or[idx] for entry in entries[lo:hi])
+                    for (_, lo, hi) in bounds
+                ]
+                continue
+
+            idx = HxtleakColdFormat.FLOAT_FIELDS.index(name)
+            (mins, maxs, means) = ([], [], [])
+            for (_, lo, hi) in bounds:
+                bucket = entries[lo:hi]
+                mins.append(min(entry.mins[idx] for entry in bucket))
+                maxs.append(max(entry.maxs[idx] for entry in bucket))
+                means.append(
+                    sum(entry.sums[idx] for entry in bucket) / sum(entry.count for entry in bucket)
+                )
+            result['fields'][name] = {'min': mins, 'max': maxs, 'mean': means}
+
+        return result
+
+    def pending_samples(self):
+        """Return the number of samples not yet written, including the current block."""
+        with self._lock:
+            return self.block.count + sum(block.count for block in self._pending)
+
+    def disk_size(self):
+        """Return the total size of the sealed blocks in bytes."""
+        return sum(entry.size for entry in self.blocks)
+
+    def tree(self):
+        """Return a dict-like tree of cold tier parameters.
+
+        :return dict-like tree of cold tier parameter accessors
+        """
+        return {
+            'path': (lambda: self.path, None),
+            'blocks': (lambda: len(self.blocks), None),
+            'samples': (lambda: sum(entry.count for entry in self.blocks), None),
+            'pending_samples': (self.pending_samples, None),
+            'first_timestamp': (self.first_timestamp, None),
+            'disk_size': (self.disk_size, None),
+        }
+
+
+def _or_all(values):
+    """Return the bitwise OR of an iterable of values."""
+    result = 0
+    for value in values:
+        result |= value
+    return result
+
+
+def cold_files(path):
+    """Return the cold tier files in a directory.
+
+    :param path: directory containing cold tier files
+    :return: list of cold tier file paths, sorted from oldest to newest
+    """
+    return sorted(
+        os.path.join(path, file_name) for file_name in os.listdir(path)
+        if file_name.startswith(HxtleakColdFormat.FILE_PREFIX)
+        and file_name.endswith(HxtleakColdFormat.FILE_SUFFIX)
+    )
@@ -1,26 +1,39 @@
 """Controller for the Hxtleak adapter.
 
-The controller handles the main background task which receives raw data packets
-through a serial port and handles them, and the parameter tree which displays
-information from the data packet after it has been decoded.
+The controller handles the reception of raw data packets through a serial port, driven by
+input events on the IOLoop, and the parameter tree which displays information from the data
+packet after it has been decoded.
 
 James Foster, STFC Detector Systems Software Group
 """
+import json
 import logging
+import os
 import serial
-from concurrent import futures
+import time
 from datetime import datetime
-from enum import Enum
+from enum import Enum, IntFlag
+from functools import partial
 from threading import Lock
 
-from tornado.concurrent import run_on_executor
+from tornado.ioloop import IOLoop
 
 from odin.adapters.parameter_tree import ParameterTree
 
-from hxtleak.packet_decoder import HxtleakPacketDecoder
+from hxtleak.packet_decoder import HxtleakPacketDecoder, HxtleakSensorStatus
+from hxtleak.framer import HxtleakPacketFramer
 from hxtleak.gpio import Gpio
+from hxtleak.history import HxtleakHistory
+from hxtleak.latency import HxtleakLatencyHistogram
 from hxtleak.outlet_relay import OutletRelay
+from hxtleak.push import HxtleakPushPublisher
 from hxtleak.event_logger import HxtleakEventLogger
+from hxtleak.capture import HxtleakCaptureRecorder
+from hxtleak.cold import HxtleakColdTier
+from hxtleak.replay import HxtleakCaptureReplay
+from hxtleak.rollup import HxtleakRollups
+from hxtleak.store import HxtleakHistoryStore
+from hxtleak.util import HxtleakError
 
 
 class PacketReceiveState(Enum):
@@ -38,46 +51,190 @@ class PacketReceiveState(Enum):
         return str(self.value)
 
 
+class SystemStateTrigger(IntFlag):
+    """Integer flag enumeration of conditions triggering system fault and warning states.
+
+    The sensor status conditions share the bit values of the packet sensor status, allowing
+    trigger bitmasks to be evaluated directly from it.
+    """
+
+    BOARD_TEMP = HxtleakSensorStatus.STATUS_BOARD_TEMPERATURE_WARNING
+    BOARD_HUMIDITY = HxtleakSensorStatus.STATUS_BOARD_HUMIDITY_WARNING
+    PROBE_1_TEMP = HxtleakSensorStatus.STATUS_PROBE_1_TEMPERATURE_FAULT
+    PROBE_2_TEMP = HxtleakSensorStatus.STATUS_PROBE_2_TEMPERATURE_FAULT
+    LEAK_DETECTED = 0x100
+    LEAK_CONTINUITY = 0x200
+
+
+# Bitmasks of trigger conditions for the fault and warning states and those in the sensor status
+FAULT_TRIGGERS = int(
+    SystemStateTrigger.LEAK_DETECTED | SystemStateTrigger.LEAK_CONTINUITY
+    | SystemStateTrigger.PROBE_1_TEMP | SystemStateTrigger.PROBE_2_TEMP
+)
+WARNING_TRIGGERS = int(SystemStateTrigger.BOARD_TEMP | SystemStateTrigger.BOARD_HUMIDITY)
+STATUS_TRIGGERS = int(
+    SystemStateTrigger.BOARD_TEMP | SystemStateTrigger.BOARD_HUMIDITY
+    | SystemStateTrigger.PROBE_1_TEMP | SystemStateTrigger.PROBE_2_TEMP
+)
+
+# Names of trigger conditions reported to the event log, in reporting order
+TRIGGER_NAMES = (
+    (SystemStateTrigger.LEAK_DETECTED, "Leak detected"),
+    (SystemStateTrigger.LEAK_CONTINUITY, "Leak continuity"),
+    (SystemStateTrigger.PROBE_1_TEMP, "Probe 1 temp"),
+    (SystemStateTrigger.PROBE_2_TEMP, "Probe 2 temp"),
+    (SystemStateTrigger.BOARD_TEMP, "Board temp"),
+    (SystemStateTrigger.BOARD_HUMIDITY, "Board humidity"),
+)
+
+
 class HxtleakController():
     """Main class for the controller object."""
 
-    # Thread executor used for background tasks
-    executor = futures.ThreadPoolExecutor(max_workers=1)
+    # Maximum number of bytes to read from the serial port when input is ready
+    SERIAL_READ_SIZE = 4096
+
+    # Parameter tree subtrees whose versions are tracked, most specific first
+    VERSIONED_SUBTREES = (
+        ('system/outlets', 'outlets'),
+        ('system', 'system'),
+        ('event_log', 'event_log'),
+    )
+
+    # Interval in seconds at which the rollup tiers are saved to the history store directory
+    ROLLUP_SAVE_INTERVAL = 3600.0
 
-    def __init__(self, port_name, packet_recv_timeout=5.0):
+    def __init__(
+        self, port_name, packet_recv_timeout=5.0, capture_path=None,
+        capture_file_size=16*1024*1024, capture_max_files=16, replay_path=None, replay_speed=1.0,
+        history_size=172800, store_path=None, store_segment_records=43200,
+        store_retention=30*24*3600, cold_path=None, cold_retention=365*24*3600,
+        event_log_size=250
+    ):
         """Initialise the controller object.
 
         This constructor initlialises the controller object, building a parameter tree and
-        launching a background task if enabled
+        starting packet reception on the IOLoop if enabled
+
+        :param port_name: name of the serial port to receive packets on
+        :param packet_recv_timeout: time in seconds after which packet reception times out
+        :param capture_path: directory to record raw serial data captures to, disabled if None
+        :param capture_file_size: size in bytes at which capture files are rotated
+        :param capture_max_files: maximum number of capture files retained
+        :param replay_path: capture file or directory to replay instead of the serial port
+        :param replay_speed: capture replay speed relative to real time, zero for maximum speed
+        :param history_size: number of samples held in the in-memory sensor history
+        :param store_path: directory of the persistent history store, disabled if None
+        :param store_segment_records: number of records in each history store segment file
+        :param store_retention: time in seconds for which the history store retains records
+        :param cold_path: directory of the compressed cold history tier, disabled if None
+        :param cold_retention: time in seconds for which the cold tier retains samples
+        :param event_log_size: number of events retained in the event log
         """
         self.port_name = port_name
         self.packet_recv_timeout = packet_recv_timeout
         self.receive_task_enable = True
 
+        # Packet reception is driven by serial input events on the IOLoop
+        self.ioloop = IOLoop.current()
+        self.recv_timeout_handle = None
+
         # Create a lock for checking and reporting system state across threads and previous
         # fault/warning conditions
         self.state_lock = Lock()
         self.last_fault_state = False
         self.last_warning_state = False
-        self.last_fault_triggers = None
-        self.last_warning_triggers = None
+        self.triggers = 0
+        self.last_triggers = 0
 
         # Create a logger for system events that can be retrieved by client requests
-        self.logger = HxtleakEventLogger(logging.getLogger())
+        self.logger = HxtleakEventLogger(logging.getLogger(), maxlen=event_log_size)
         self.logger.info("System starting up")
 
+        # Initialise the versions of the parameter subtrees, each bumped when a value under it
+        # changes, allowing clients to determine if a subtree has changed without retrieving it.
+        # Versions are bumped under a lock, since the event log version is bumped by events logged
+        # from any thread.
+        self.versions = {subtree: 0 for (_, subtree) in self.VERSIONED_SUBTREES}
+        self.versions_lock = Lock()
+
+        # Create publishers pushing updates to streaming clients as they change: system state and
+        # event log updates to WebSocket clients, and packet snapshots, event log updates and
+        # heartbeats to server-sent event clients. The publishers are notified of each event logged.
+        self.push = HxtleakPushPublisher(self.ioloop)
+        self.push.add_topic('system', self._system_message)
+        self.push.add_topic('events', partial(
+            self._events_update, self.push, self._events_message
+        ))
+        self.sse = HxtleakPushPublisher(self.ioloop)
+        self.sse.add_topic('packet', self._packet_sse)
+        self.sse.add_topic('events', partial(self._events_update, self.sse, self._events_sse))
+        self.sse.add_topic('heartbeat', lambda: ': heartbeat\n\n')
+        self.logger.add_listener(self._notify_events)
+
+        # Create a publisher answering long-poll clients waiting for the system state to change
+        self.long_poll = HxtleakPushPublisher(self.ioloop)
+        self.long_poll.add_topic('system', self._system_poll_response)
+
         # Initialise the values of the parameter tree and packet information
         self.status = PacketReceiveState.UNKNOWN
         self.time_received = datetime.now()
+        self.last_packet_time = time.monotonic()
 
         self.warning_state = False
 
-        self.packet_data = None
+        self.packet = None
         self.good_packet_counter = 0
         self.bad_packet_counter = 0
 
-        # Initialise the packet decoder class
+        # Initialise the packet decoder and the framer extracting packets from the serial stream
         self.decoder = HxtleakPacketDecoder()
+        self.framer = HxtleakPacketFramer(
+            self.decoder.size, self.decoder.EOP_BYTES, validate=self.decoder.verify_checksum
+        )
+
+        # Initialise the in-memory history of sensor values received in good packets
+        self.history = HxtleakHistory(history_size)
+        self.rollups = HxtleakRollups()
+
+        # Create a persistent history store if a store path is specified, restoring the most
+        # recent history from it. The store has its own decoder, so that packets read from it do
+        # not advance the sequence counter of the live decoder, and the history is restored from
+        # the channel columns unpacked from the store rather than by decoding each packet. The
+        # rollup tiers are saved periodically to the store directory and restored from there.
+        self.store = None
+        self.rollup_file = None
+        self.rollup_save_handle = None
+        if store_path:
+            try:
+                self.store = HxtleakHistoryStore(
+                    store_path, HxtleakPacketDecoder(), store_segment_records, store_retention,
+                    logger=self.logger
+                )
+                columns = self.store.read_columns(last=self.history.capacity)
+                self.history.extend(columns)
+                self.logger.info("Restored %d samples from history store", self.history.count)
+                self.rollup_file = os.path.join(store_path, HxtleakRollups.FILE_NAME)
+                self.restore_rollups(columns)
+                self.store.set_enabled(True)
+                self.rollup_save_handle = self.ioloop.call_later(
+                    self.ROLLUP_SAVE_INTERVAL, self.save_rollups
+                )
+            except (HxtleakError, OSError) as e:
+                self.logger.error("Failed to initialise history store: %s", e)
+                self.store = None
+                self.rollup_file = None
+
+        # Create a compressed cold history tier if a cold tier path is specified
+        self.cold = None
+        if cold_path:
+            try:
+                self.cold = HxtleakColdTier(cold_path, retention=cold_retention, logger=self.logger)
+            except (HxtleakError, OSError) as e:
+                self.logger.error("Failed to initialise cold history tier: %s", e)
+
+        # Create a histogram of the latency from fault detection to outlet relays being turned off
+        self.fault_latency = HxtleakLatencyHistogram()
 
         # Define the fault detect GPIO pin, add an event callback and initialise the fault state
         # value
@@ -97,40 +254,109 @@ class HxtleakController():
         self.daq_outlet = OutletRelay("DAQ", "P8_16", enabled=not self.fault_state)
         self.outlets = (self.chiller_outlet, self.daq_outlet)
 
-        # Initialise the serial port
-        try:
-            self.serial_input = serial.Serial(port=self.port_name, baudrate=57600, timeout=.5)
-        except serial.serialutil.SerialException:
-            self.logger.error('Failed to open serial port %s', self.port_name)
-            self.status = "No serial port"
-            self.receive_task_enable = False
+        # Create a capture recorder for raw serial data if a capture path is specified
+        self.recorder = None
+        if capture_path:
+            try:
+                self.recorder = HxtleakCaptureRecorder(
+                    capture_path, capture_file_size, capture_max_files, logger=self.logger
+                )
+                self.recorder.set_enabled(True)
+            except HxtleakError as e:
+                self.logger.error("Failed to initialise capture recorder: %s", e)
+
+        # If a replay capture is specified, initialise the replay as the packet source. Otherwise
+        # initialise the serial port for non-blocking reads, since reads are only made when the
+        # IOLoop signals that input is ready
+        self.replay = None
+        self.serial_input = None
+        if replay_path:
+            try:
+                self.replay = HxtleakCaptureReplay(replay_path, replay_speed, logger=self.logger)
+            except HxtleakError as e:
+                self.logger.error("Failed to initialise capture replay: %s", e)
+                self.status = "No replay capture"
+                self.receive_task_enable = False
+        else:
+            try:
+                self.serial_input = serial.Serial(port=self.port_name, baudrate=57600, timeout=0)
+            except serial.serialutil.SerialException:
+                self.logger.error('Failed to open serial port %s', self.port_name)
+                self.status = "No serial port"
+                self.receive_task_enable = False
 
         # Store all information in a parameter tree
-        self.param_tree = ParameterTree({
+        param_tree = {
             'system' : {
                 'status' : (lambda: str(self.status), None),
-                'packet_info' : (lambda: self.packet_data, None),
+                'packet_info' : (self._get_packet_info, None),
                 'time_received' : (self._get_time_received, None),
                 'good_packets' : (lambda: self.good_packet_counter, None),
                 'bad_packets' : (lambda: self.bad_packet_counter, None),
+                'discarded_bytes' : (lambda: self.framer.discarded_bytes, None),
                 'outlets' : {
                     'chiller': self.chiller_outlet.tree(),
                     'daq': self.daq_outlet.tree(),
                 },
                 'fault' : (lambda: bool(self.fault_state), None),
                 'warning': (lambda: bool(self.warning_state), None),
+                'fault_latency': self.fault_latency.tree(),
             },
+            'history': dict(self.history.tree(), rollups=self.rollups.tree()),
             'event_log': {
                 'events': (self.logger.events, None),
                 'last_timestamp': (self.logger.last_timestamp, None),
                 'events_since': (self.logger.events_since, self.logger.set_events_since),
+                'last_seq': (self.logger.last_seq, None),
+                'events_after': (self.logger.events_after, self.logger.set_events_after),
             },
-        })
+        }
+
+        param_tree['push'] = {
+            'websocket': self.push.tree(),
+            'sse': self.sse.tree(),
+            'long_poll': self.long_poll.tree(),
+        }
+        param_tree['versions'] = {
+            subtree: (partial(self.versions.get, subtree), None) for subtree in self.versions
+        }
+
+        # Add capture recorder and replay parameters to the tree if enabled
+        if self.recorder:
+            param_tree['capture'] = self.recorder.tree()
+        if self.store:
+            param_tree['history']['store'] = self.store.tree()
+        if self.cold:
+            param_tree['history']['cold'] = self.cold.tree()
+        if self.replay:
+            param_tree['replay'] = self.replay.tree()
 
-        # Launch the packet receive task in the background
+        self.param_tree = ParameterTree(param_tree)
+
+        # Encode the initial snapshot of the system state, which is encoded again each time the
+        # state changes
+        self.system_snapshot = None
+        self._encode_system_snapshot()
+
+        # Define the handlers of query paths, which take arguments and are resolved outside the
+        # parameter tree
+        self.queries = {
+            'history/query': self._query_history,
+            'event_log/query': self._query_events,
+        }
+
+        # Query paths whose results can be encoded as binary records
+        self.binary_queries = ('history/query',)
+
+        # Query paths resolved off the IOLoop, since their cost grows with the range queried. The
+        # history tiers copy the samples queried under their own locks, so that these queries may
+        # run in any thread.
+        self.background_queries = ('history/query',)
+
+        # Start receiving packets from the serial port
         if self.receive_task_enable:
-            self.logger.info("Launching packet receive task")
-            self.receive_packets()
+            self.logger.info("Starting packet reception")
+            self.start_receive()
 
     def get(self, path):
         """Get the parameter tree.
@@ -141,6 +367,177 @@ class HxtleakController():
         """
         return self.param_tree.get(path)
 
+    def has_query(self, path):
+        """Determine if a path is a query path.
+
+        :param path: path to check
+        :return: True if the path is handled by query()
+        """
+        return path.strip('/') in self.queries
+
+    def query(self, path, args):
+        """Resolve a query path with arguments.
+
+        :param path: query path
+        :param args: dict of query argument strings keyed by argument name
+        :return: dict of query results, or a string of JSON-encoded query results
+        """
+        return self.queries[path.strip('/')](args)
+
+    def version(self, path):
+        """Get the version of the parameter subtree containing a path.
+
+        :param path: path in the parameter tree
+        :return: version of the most specific versioned subtree containing the path, or None if
+                 the path is not within a versioned subtree
+        """
+        path = path.strip('/')
+        for (subtree_path, subtree) in self.VERSIONED_SUBTREES:
+            if path == subtree_path or path.startswith(subtree_path + '/'):
+                return self.versions[subtree]
+        return None
+
+    def _bump_versions(self, path):
+        """Bump the versions of all subtrees which may be changed by setting a path.
+
+        :param path: path set in the parameter tree
+        """
+        path = path.strip('/')
+        with self.versions_lock:
+            for (subtree_path, subtree) in self.VERSIONED_SUBTREES:
+                if not path or (path + '/').startswith(subtree_path + '/') or \
+                        subtree_path.startswith(path + '/'):
+                    self.versions[subtree] += 1
+
+    def _query_history(self, args):
+        """Query the sensor history.
+
+        The start and end arguments are times in seconds since the epoch, or if negative, relative
+        to the current time. The fields argument is a comma-separated list of channel names.
+        Minmax queries with a start time are answered from the rollup tiers if one retaining the
+        start time is suitable. Otherwise, queries starting before the in-memory history are
+        answered from the history store or compressed cold tier, if enabled, and all others from
+        the in-memory history. If none of these holds samples from the start time, minmax queries
+        are answered from a coarser rollup tier holding older samples if there is one, rather than
+        returning truncated results. This method is called off the IOLoop, as one of the
+        background queries.
+
+        :param args: dict of query argument strings (start, end, fields, points and method)
+        :return: dict of history query results
+        """
+        (start, end, fields) = self._history_range_args(args)
+        try:
+            points = int(args.get('points', 1000))
+        except ValueError as e:
+            raise HxtleakError("Invalid history query argument: {}".format(e))
+        method = args.get('method', 'minmax')
+
+        rollup_query = method == 'minmax' and start is not None
+        if rollup_query:
+            rollup_end = time.time() if end is None else end
+            result = self.rollups.query(start, rollup_end, fields, points)
+            if result is not None:
+                return result
+
+        # If the selected history tier has no samples from the start time, e.g. when the history
+        # has wrapped and no deeper tier is enabled, answer a minmax query from a coarser rollup
+        # tier holding older samples rather than return truncated results
+        tier = self._history_tier(start)
+        if rollup_query and not self._tier_retains(tier, start):
+            tier_start = tier.first_timestamp()
+            result = self.rollups.query(
+                start, rollup_end, fields, points,
+                older_than=rollup_end if tier_start is None else tier_start
+            )
+            if result is not None:
+                return result
+
+        return tier.query(start, end, fields, points, method)
+
+    def export_history(self, args):
+        """Export the sensor history over a time range.
+
+        The time range and fields are specified as for history queries. The samples are exported
+        in chunks from the same tier that would answer a raw query over the range, each chunk
+        being read only as the returned generator is consumed.
+
+        :param args: dict of argument strings (start, end and fields)
+        :return: tuple of the list of exported channel names and a generator yielding chunks
+        """
+        (start, end, fields) = self._history_range_args(args)
+        fields = HxtleakHistory.export_fields(fields)
+        return (fields, self._history_tier(start).export(start, end, fields))
+
+    @staticmethod
+    def _history_range_args(args):
+        """Parse the time range and fields arguments of a history request.
+
+        :param args: dict of argument strings
+        :return: tuple of start and end times in seconds since the epoch, or None, and the list of
+                 channel names or None
+        """
+        try:
+            (start, end) = (
+                float(args[name]) if args.get(name) else None for name in ('start', 'end')
+            )
+        except ValueError as e:
+            raise HxtleakError("Invalid history query argument: {}".format(e))
+
+        now = time.time()
+        if start is not None and start < 0:
+            start += now
+        if end is not None and end < 0:
+            end += now
+
+        fields = args['fields'].split(',') if args.get('fields') else None
+        return (start, end, fields)
+
+    def _history_tier(self, start):
+        """Select the history tier holding the samples from a start time.
+
+        Requests with a start time are answered from the first of the in-memory history, history
+        store and cold tier which holds samples from that time, or failing that the deepest tier
+        enabled, and all others from the in-memory history.
+
+        :param start: start time in seconds since the epoch, or None
+        :return: history tier instance
+        """
+        if start is None:
+            return self.history
+
+        tiers = [tier for tier in (self.history, self.store, self.cold) if tier is not None]
+        for tier in tiers:
+            if self._tier_retains(tier, start):
+                return tier
+        return tiers[-1]
+
+    @staticmethod
+    def _tier_retains(tier, start):
+        """Determine if a history tier holds samples from a start time.
+
+        :param tier: history tier instance
+        :param start: start time in seconds since the epoch
+        :return: True if the first sample held is at or before the start time
+        """
+        tier_start = tier.first_timestamp()
+        return tier_start is not None and tier_start <= start
+
+    def _query_events(self, args):
+        """Query the event log after a cursor.
+
+        :param args: dict of query argument strings (after and limit)
+        :return: JSON-encoded string of the events and the cursor for the next query
+        """
+        try:
+            after = int(args.get('after', 0))
+            limit = int(args['limit']) if args.get('limit') else None
+        except ValueError as e:
+            raise HxtleakError("Invalid event log query argument: {}".format(e))
+        if limit is not None and limit < 1:
+            raise HxtleakError("Event log query limit must be at least 1")
+
+        return self.logger.query(after, limit)
+
     def set(self, path, data):
         """Set parameter values.
 
@@ -149,9 +546,205 @@ class HxtleakController():
         :param path: path to set in the tree
         :param data: data value(s) to set
         """
+        system_version = self.versions['system']
         self.param_tree.set(path, data)
+        self._bump_versions(path)
+        if self.versions['system'] != system_version:
+            self._encode_system_snapshot()
+            self.push.notify('system')
+            self.long_poll.notify('system')
         return self.param_tree.get(path)
 
+    def subscribe(self, subscriber):
+        """Subscribe a WebSocket client to pushed updates.
+
+        The client is sent the current system state and the events held in the event log, and
+        thereafter updates as they change.
+
+        :param subscriber: client object with a write_message method accepting a string
+        """
+        events = self._subscribe_events(self.push, subscriber, 0)
+        self.push.send(subscriber, self._system_message())
+        self.push.send(subscriber, self._events_message(events))
+
+    def unsubscribe(self, subscriber):
+        """Unsubscribe a WebSocket client from pushed updates.
+
+        :param subscriber: client object previously subscribed
+        """
+        self.push.unsubscribe(subscriber)
+
+    def subscribe_sse(self, subscriber, last_event_id=None):
+        """Subscribe a server-sent event client to pushed updates.
+
+        The client is sent the most recent packet snapshot, and if resuming a previous stream,
+        the events logged after the last it received, and thereafter updates as they happen. If
+        the last event received is beyond the last event logged, i.e. the client has outlived a
+        restart of the adapter, the client is sent a reset event, so that it can discard the events
+        it holds, followed by all the events still held, as for the reset flag of event log queries.
+
+        :param subscriber: client object with a write_message method accepting a string
+        :param last_event_id: sequence number of the last event received if resuming, or None
+        """
+        after = self.logger.last_seq() if last_event_id is None else last_event_id
+        reset = after > self.logger.last_seq()
+        if reset:
+            after = 0
+
+        events = self._subscribe_events(self.sse, subscriber, after)
+        if reset:
+            self.sse.send(subscriber, 'id: 0\nevent: reset\ndata: {}\n\n')
+        if self.packet:
+            self.sse.send(subscriber, self._packet_sse())
+        if events:
+            self.sse.send(subscriber, self._events_sse(events))
+
+    def unsubscribe_sse(self, subscriber):
+        """Unsubscribe a server-sent event client from pushed updates.
+
+        :param subscriber: client object previously subscribed
+        """
+        self.sse.unsubscribe(subscriber)
+
+    def subscribe_poll(self, subscriber, version):
+        """Subscribe a long-poll client to the next change of the system state.
+
+        If the system state has changed since the version the client last received, the response
+        is returned immediately and the client is not subscribed. Otherwise the client is sent the
+        response when the state next changes, and must be unsubscribed once it has been sent or the
+        client stops waiting.
+
+        :param subscriber: client object with a write_message method accepting a string
+        :param version: version of the system state last received by the client
+        :return: JSON-encoded response if the state has changed, otherwise None
+        """
+        if version != self.versions['system']:
+            return self._system_poll_response()
+
+        self.long_poll.subscribe(subscriber)
+        return None
+
+    def unsubscribe_poll(self, subscriber):
+        """Unsubscribe a long-poll client from changes of the system state.
+
+        :param subscriber: client object previously subscribed
+        """
+        self.long_poll.unsubscribe(subscriber)
+
+    def _subscribe_events(self, publisher, subscriber, after):
+        """Subscribe a client to a publisher, returning the events it must be sent first.
+
+        The events returned are those after the specified sequence number up to the last event
+        pushed by the publisher, later events being pushed to all subscribers, so that the client
+        receives each event once.
+
+        :param publisher: publisher to subscribe the client to
+        :param subscriber: client object
+        :param after: sequence number of the last event already received by the client
+        :return: list of events to send to the client
+        """
+        # If no clients were subscribed, events have not been pushed, so start pushing from the
+        # most recent event
+        if not publisher.subscribers:
+            publisher.cursor = self.logger.last_seq()
+
+        publisher.subscribe(subscriber)
+        return [
+            event for event in self.logger.get_events_after(after)
+            if event.seq <= publisher.cursor
+        ]
+
+    def _system_changed(self, outlets=False):
+        """Bump the version of the system state and push it to streaming clients.
+
+        :param outlets: True if the outlet states may also have changed
+        """
+        with self.versions_lock:
+            if outlets:
+                self.versions['outlets'] += 1
+            self.versions['system'] += 1
+        self._encode_system_snapshot()
+        self.push.notify('system')
+        self.long_poll.notify('system')
+
+    def _encode_system_snapshot(self):
+        """Encode a snapshot of the system state as JSON.
+
+        This method is called each time the system state changes, so that the state is retrieved
+        from the parameter tree and serialised once however many clients request it. The snapshot
+        is replaced as a (version, JSON string) tuple so that readers see a consistent pair.
+        """
+        version = self.versions['system']
+        self.system_snapshot = (version, json.dumps(self.param_tree.get('system')))
+
+    def system_json(self):
+        """Get the JSON-encoded snapshot of the system state.
+
+        :return: JSON string of the system subtree of the parameter tree
+        """
+        return self.system_snapshot[1]
+
+    def _notify_events(self):
+        """Notify the publishers that an event has been logged.
+
+        This method is called from the thread logging the event, which may not be the IOLoop.
+        """
+        with self.versions_lock:
+            self.versions['event_log'] += 1
+        self.push.notify('events')
+        self.sse.notify('events')
+
+    def _events_update(self, publisher, encode):
+        """Build the pushed update of the events logged since the last pushed by a publisher.
+
+        :param publisher: publisher pushing the update
+        :param encode: callable encoding a list of events as an update message
+        :return: update message, or None if there are no events to push
+        """
+        events = self.logger.get_events_after(publisher.cursor)
+        if not events:
+            return None
+        publisher.cursor = events[-1].seq
+        return encode(events)
+
+    def _system_message(self):
+        """Build the pushed update message of the system state."""
+        return self._encode_message('system', self.system_json())
+
+    def _system_poll_response(self):
+        """Build the long-poll response of the system state and its version."""
+        (version, system) = self.system_snapshot
+        return '{{"version": {}, {}'.format(version, system[1:])
+
+    def _events_message(self, events):
+        """Build the pushed update message of a list of events."""
+        return self._encode_message('events', self.logger.encode_events(events))
+
+    @staticmethod
+    def _encode_message(message_type, data):
+        """Encode a pushed update message from its type and JSON-encoded data."""
+        return '{{"type": "{}", "data": {}}}'.format(message_type, data)
+
+    def _packet_sse(self):
+        """Build the server-sent event of the most recent packet snapshot."""
+        packet = self.packet
+        return 'event: packet\ndata: {}\n\n'.format(json.dumps(dict(
+            packet.as_dict(), seq=packet.seq, time_received=self._get_time_received()
+        )))
+
+    @staticmethod
+    def _events_sse(events):
+        """Build the server-sent events of a list of events, identified by sequence number."""
+        return ''.join(
+            'id: {}\nevent: log\ndata: {}\n\n'.format(event.seq, event.fragment)
+            for event in events
+        )
+
+    def _get_packet_info(self):
+        """Get the values of the last packet received as a dict."""
+        packet = self.packet
+        return packet.as_dict() if packet else None
+
     def _get_time_received(self):
         """Get the last packet receive time as a string."""
         if self.time_received:
@@ -162,44 +755,137 @@ class HxtleakController():
     def cleanup(self):
         """Clean up the controller instance.
 
-        This method stops the background task, allowing the adapter state to be cleaned up
-        correctly.
+        This method stops packet reception immediately, removing the serial input handler or
+        stopping replay and removing the receive timeout from the IOLoop, allowing the adapter
+        state to be cleaned up correctly.
         """
-        self.receive_task_enable = False
+        if self.receive_task_enable:
+            self.receive_task_enable = False
+            self.stop_receive()
+            if self.serial_input:
+                self.serial_input.close()
 
-    def fault_event_detected(self, _):
-        """Event callback for the fault detect GPIO pin.
+        if self.recorder:
+            self.recorder.set_enabled(False)
 
-        This method is called when transitions occur on the fault detect GPIO pin. The state of
-        the pin is read into the appropriate parameter, and the outlet relay states and enables
-        are set accordingly.
+        if self.store:
+            self.store.set_enabled(False)
+
+        if self.rollup_file:
+            if self.rollup_save_handle:
+                self.ioloop.remove_timeout(self.rollup_save_handle)
+                self.rollup_save_handle = None
+            self.write_rollups()
+
+        if self.cold:
+            self.cold.close()
+
+    def restore_rollups(self, columns):
+        """Restore the rollup tiers from the rollup file and the history store.
+
+        The tiers saved in the rollup file are loaded, retaining their full history, and the
+        samples recorded in the store since they were saved are then merged in. Tiers which could
+        not be loaded are rebuilt from the most recent samples in the store.
+
+        :param columns: dict of channel arrays of the most recent samples read from the store
         """
-        # Read the current state of the fault detect pin.
-        self.fault_state = bool(self.fault_detect.read())
-        logging.debug("Fault transition detected, state is now: %s", self.fault_state)
+        try:
+            restored = self.rollups.load(self.rollup_file)
+        except HxtleakError as e:
+            self.logger.warning("Discarding saved rollups: %s", e)
+            restored = 0
 
-        # Check and log the state of the system
-        self.report_system_state()
+        last_timestamp = self.rollups.last_timestamp()
+        if last_timestamp is not None:
+            columns = self.store.read_columns(start=last_timestamp, last=self.history.capacity)
+        self.rollups.extend(columns)
+        self.logger.info("Restored %d rollup tiers from %s", restored, self.rollup_file)
 
-        # If the fault state is set, disable user operation of the outlet relays and turn off.
-        # Otherwise, re-enable the relays but leave them off.
-        if self.fault_state:
-            for outlet in self.outlets:
-                outlet.set_state(False)
-                outlet.set_enabled(False)
+    def save_rollups(self):
+        """Save the rollup tiers periodically.
+
+        This method is called periodically on the IOLoop, writing the rollup tiers to the rollup
+        file in an executor so that the IOLoop is not blocked, and rescheduling itself.
+        """
+        self.ioloop.run_in_executor(None, self.write_rollups)
+        self.rollup_save_handle = self.ioloop.call_later(
+            self.ROLLUP_SAVE_INTERVAL, self.save_rollups
+        )
+
+    def write_rollups(self):
+        """Write the rollup tiers to the rollup file, logging any error."""
+        try:
+            self.rollups.save(self.rollup_file)
+        except HxtleakError as e:
+            self.logger.error("Failed to save rollups: %s", e)
+
+    def fault_event_detected(self, _):
+        """Event callback for the fault detect GPIO pin.
+
+        This method is called when transitions occur on the fault detect GPIO pin. When a fault is
+        detected, all outlet relays are turned off and disabled before anything else is done, and
+        the latency from the start of the callback to the relays being turned off is recorded. When
+        the fault clears, the relays are re-enabled but left off. The fault state is then updated
+        and its reporting deferred to the IOLoop, so that the callback never waits on the state lock
+        or logging.
+        """
+        # Read the current state of the fault detect pin and, if set, immediately shut down the
+        # outlet relays, recording the latency
+        edge_time = time.perf_counter()
+        fault_state = bool(self.fault_detect.read())
+        if fault_state:
+            switched_off = OutletRelay.shutdown(self.outlets)
+            self.fault_latency.record(time.perf_counter() - edge_time)
         else:
+            switched_off = []
             for outlet in self.outlets:
                 outlet.set_enabled(True)
 
+        self.fault_state = fault_state
+
+        # Defer reporting of the transition and system state to the IOLoop
+        self.ioloop.add_callback(self._report_fault_transition, fault_state, switched_off)
+
+    def _report_fault_transition(self, fault_state, switched_off):
+        """Report a fault state transition to the event log.
+
+        This method is called on the IOLoop following a fault transition, logging each outlet
+        turned off and reporting the system state.
+
+        :param fault_state: fault state following the transition
+        :param switched_off: list of outlets turned off by the transition
+        """
+        logging.debug("Fault transition detected, state is now: %s", fault_state)
+        for outlet in switched_off:
+            self.logger.info("%s outlet state set to off", outlet.name)
+        self.report_system_state()
+        self._system_changed(outlets=True)
+
+    @staticmethod
+    def packet_triggers(packet):
+        """Evaluate the fault and warning trigger conditions of a packet.
+
+        :param packet: decoded packet snapshot
+        :return: packed bitmask of SystemStateTrigger conditions
+        """
+        return (
+            (packet.sensor_status & STATUS_TRIGGERS)
+            | (SystemStateTrigger.LEAK_DETECTED if packet.leak_detected else 0)
+            | (0 if packet.leak_continuity else SystemStateTrigger.LEAK_CONTINUITY)
+        )
+
     def report_system_state(self):
         """Report system state to event log.
 
         This method reports the state of the system to the event log. Transitions in the fault
         and warning states are reported, along with changes in the conditions forming those states.
-        The last fault and warning states are stored so that changes can be detected.
+        The last fault and warning states are stored so that changes can be detected. Since the
+        trigger conditions are evaluated as each packet is received, this method need only be
+        called when a packet changes the trigger conditions or warning state, or when the fault
+        state changes.
         """
-        # Acquire the state lock, since this method may be called by the background packet
-        # receive thread or by the fault detection callback.
+        # Acquire the state lock, since this method may be called by the packet receive handler
+        # or by the fault detection callback.
         with self.state_lock:
 
             # If the fault state has changed, report and store the new state
@@ -210,25 +896,17 @@ class HxtleakController():
                     self.logger.info("Fault state cleared")
                 self.last_fault_state = self.fault_state
 
-            # Evaluate which conditions have triggered the change in the current fault state
-            fault_triggers = {
-                "Leak detected" : self.decoder.leak_detected,
-                "Leak continuity" : not self.decoder.leak_continuity,
-                "Probe 1 temp" : self.decoder.status_probe_1_temperature_fault(),
-                "Probe 2 temp" : self.decoder.status_probe_2_temperature_fault(),
-            }
-
-            # Save the last fault trigger data if not yet populated
-            if self.last_fault_triggers is None:
-                self.last_fault_triggers = fault_triggers
+            # Determine which trigger conditions have changed since the last report
+            triggers = self.triggers
+            changed_triggers = triggers ^ self.last_triggers
+            self.last_triggers = triggers
 
             # If the fault triggers have changed and the fault state is asserted, report which
             # conditions have triggered the fault
-            if fault_triggers != self.last_fault_triggers:
-                if self.fault_state:
-                    fault_str = [key for (key, val) in fault_triggers.items() if val]
-                    self.logger.warning("Fault conditions: %s", ', '.join(fault_str))
-                self.last_fault_triggers = fault_triggers
+            if changed_triggers & FAULT_TRIGGERS and self.fault_state:
+                self.logger.warning(
+                    "Fault conditions: %s", self._trigger_names(triggers & FAULT_TRIGGERS)
+                )
 
             # If the warning state has changed, report and store the new state
             if self.warning_state != self.last_warning_state:
@@ -238,88 +916,167 @@ class HxtleakController():
                     self.logger.info("Warning state cleared")
                 self.last_warning_state = self.warning_state
 
-            # Evaluate which conditions have triggered the change in the current warning state
-            warning_triggers = {
-                "Board temp" : self.decoder.status_board_temperature_warning(),
-                "Board humidity" : self.decoder.status_board_humidity_warning(),
-            }
-
-            # Save the last warning trigger data if not yet populated
-            if self.last_warning_triggers is None:
-                self.last_warning_triggers = warning_triggers
-
             # If the warning triggers have changed and the warning state is asserted, report which
             # conditions have triggered the warning
-            if warning_triggers != self.last_warning_triggers:
-                if self.warning_state:
-                    warning_str = [key for (key, val) in warning_triggers.items() if val]
-                    self.logger.warning("Warning conditions: %s", ', '.join(warning_str))
-                self.last_warning_triggers = warning_triggers
-
-    @run_on_executor
-    def receive_packets(self):
-        """Run the main packet receiver task.
-
-        This method reads data from the serial input and uses the packet decoder class to
-        parse the data. The values in the parameter tree are updated with the appropriate
-        information.
-        """
-        # Initialise the decoder maximum size and serial input buffer
-        maxsize = self.decoder.size * 2
-        input_buf = bytearray()
-
-        # Loop while this task is enabled
-        while self.receive_task_enable:
-
-            # Append any available data to the input buffer
-            input_buf.extend(self.serial_input.read(maxsize))
-
-            # If the input buffer terminates in an end of packet marker, process accordingly
-            if self.decoder.packet_complete(input_buf):
-
-                # Record time that packet was received
-                self.time_received = datetime.now()
-
-                # Unpack a packet from the input buffer if enough data received
-                if len(input_buf) >= self.decoder.size:
-
-                    self.decoder.unpack(input_buf[-(self.decoder.size):])
-
-                    # Verify that the transmitted packet checksum is correct
-                    if self.decoder.verify_checksum(input_buf[-(self.decoder.size):]):
-                        if self.status != PacketReceiveState.OK:
-                            self.logger.info("Packet received OK")
-                        self.status = PacketReceiveState.OK
-                        self.packet_data = self.decoder.as_dict()
-                        self.warning_state = self.packet_data["warning"]
-                        self.good_packet_counter += 1
-                    else:
-                        self.logger.warning(
-                            "Received packet with bad checksum 0x%X", self.decoder.checksum
-                        )
-                        self.status = PacketReceiveState.INVALID_CHECKSUM
-                        self.bad_packet_counter += 1
-
-                # Otherwise handle an invalid sized packet
-                else:
-                    self.status = PacketReceiveState.INVALID_SIZE
-                    self.logger.warning(
-                        "Received incorrectly size packet with length %d : %s",
-                        len(input_buf), ' '.join([hex(val) for val in input_buf])
-                    )
-                    self.bad_packet_counter += 1
+            if changed_triggers & WARNING_TRIGGERS and self.warning_state:
+                self.logger.warning(
+                    "Warning conditions: %s", self._trigger_names(triggers & WARNING_TRIGGERS)
+                )
 
-                # Reset the data bytearray
-                input_buf = bytearray()
+    @staticmethod
+    def _trigger_names(triggers):
+        """Return a string listing the names of the set trigger conditions."""
+        return ', '.join(name for (trigger, name) in TRIGGER_NAMES if triggers & trigger)
 
-            # Check if the packet receive timeout has been received and set status if so
-            else:
+    def start_receive(self):
+        """Start receiving packets from the serial port or replay capture.
+
+        This method registers a handler for serial input events on the IOLoop, or launches the
+        capture replay, and schedules the packet receive timeout check. No periodic polling takes
+        place; packets are processed only when data arrives.
+        """
+        if self.replay:
+            self.ioloop.spawn_callback(self.replay.run, self.process_input)
+        else:
+            self.ioloop.add_handler(
+                self.serial_input.fileno(), self.serial_input_ready, IOLoop.READ
+            )
+        self.recv_timeout_handle = self.ioloop.call_later(
+            self.packet_recv_timeout, self.check_receive_timeout
+        )
+
+        # Check and log the initial state of the system
+        self.report_system_state()
+
+    def stop_receive(self):
+        """Stop receiving packets from the serial port or replay capture.
+
+        This method removes the serial input handler, or stops the capture replay, and removes the
+        pending receive timeout from the IOLoop.
+        """
+        if self.replay:
+            self.replay.stop()
+        else:
+            self.ioloop.remove_handler(self.serial_input.fileno())
+        if self.recv_timeout_handle:
+            self.ioloop.remove_timeout(self.recv_timeout_handle)
+            self.recv_timeout_handle = None
+
+    def serial_input_ready(self, fd, events):
+        """Handle serial input ready events.
+
+        This method is called by the IOLoop when data is available to read from the serial port.
+        All available data is read and passed on to be processed. Serial port errors are reported
+        and stop packet reception, closing the port, but leave the other subsystems, e.g. the
+        history store and capture recorder, running.
+
+        :param fd: file descriptor of the serial port
+        :param events: IOLoop events signalled
+        """
+        try:
+            data = self.serial_input.read(self.SERIAL_READ_SIZE)
+        except serial.serialutil.SerialException as e:
+            self.logger.error("Error reading from serial port %s: %s", self.port_name, e)
+            self.status = PacketReceiveState.SERIAL_ERROR
+            self.receive_task_enable = False
+            self.stop_receive()
+            self.serial_input.close()
+            self._system_changed()
+            return
+
+        if data:
+            if self.recorder:
+                self.recorder.record(data)
+            self.process_input(data)
+
+    def check_receive_timeout(self):
+        """Check if the packet receive timeout has elapsed.
+
+        This method is called by the IOLoop when the packet receive timeout may have elapsed. If
+        no packet has been received within the timeout, the status is set accordingly. The check
+        is then rescheduled for when the timeout would next elapse.
+        """
+        recv_delta = time.monotonic() - self.last_packet_time
+        if recv_delta > self.packet_recv_timeout:
+            if self.status != PacketReceiveState.TIMEOUT:
+                self.logger.warning("Packet receive timed out")
+                self.status = PacketReceiveState.TIMEOUT
+                self._system_changed()
+            recv_delta = 0.0
 
-                recv_delta = (datetime.now() - self.time_received).total_seconds()
-                if recv_delta > self.packet_recv_timeout:
-                    if self.status != PacketReceiveState.TIMEOUT:
-                        self.logger.warning("Packet receive timed out")
-                    self.status = PacketReceiveState.TIMEOUT
+        self.recv_timeout_handle = self.ioloop.call_later(
+            self.packet_recv_timeout - recv_delta, self.check_receive_timeout
+        )
 
-            # Check and log the state of the system
+    def process_input(self, data):
+        """Process data received from the serial port.
+
+        This method feeds received data into the packet framer to extract all complete packets
+        and uses the packet decoder class to parse them. The values in the parameter tree are
+        updated with the appropriate information.
+
+        :param data: bytes-like object containing received data
+        """
+        # Feed the data into the packet framer, locating all complete packets in its buffer
+        offsets, discarded = self.framer.feed(data)
+
+        # If bytes were discarded while resynchronising to the packet stream, handle as an
+        # invalid sized packet
+        if discarded:
+            self.status = PacketReceiveState.INVALID_SIZE
+            self.logger.warning(
+                "Discarded %d bytes while resynchronising to packet stream", discarded
+            )
+            self.bad_packet_counter += 1
+
+        # Process each complete packet received, noting if any change the system state
+        state_changed = False
+        good_packets = self.good_packet_counter
+        for offset in offsets:
+
+            # Record time that packet was received
+            self.time_received = datetime.now()
+            wall_time = time.time()
+            self.last_packet_time = time.monotonic()
+
+            # Decode the packet directly from the framer buffer into an immutable snapshot
+            packet = self.decoder.decode(
+                self.framer.buffer, offset, timestamp=self.last_packet_time
+            )
+
+            # If the transmitted packet checksum is correct, publish the packet snapshot
+            if packet.checksum_valid:
+                if self.status != PacketReceiveState.OK:
+                    self.logger.info("Packet received OK")
+                self.status = PacketReceiveState.OK
+                self.packet = packet
+                self.good_packet_counter += 1
+                self.history.append(wall_time, packet)
+                self.rollups.append(wall_time, packet)
+                if self.store:
+                    self.store.record(wall_time, packet.raw)
+                if self.cold:
+                    self.cold.append(wall_time, packet)
+
+                # Evaluate the trigger conditions of the packet and note any state changes
+                triggers = self.packet_triggers(packet)
+                if triggers != self.triggers or packet.warning != self.warning_state:
+                    self.triggers = triggers
+                    self.warning_state = packet.warning
+                    state_changed = True
+            else:
+                self.logger.warning(
+                    "Received packet with bad checksum 0x%X", packet.checksum
+                )
+                self.status = PacketReceiveState.INVALID_CHECKSUM
+                self.bad_packet_counter += 1
+
+        # Check and log the state of the system if it has changed
+        if state_changed:
             self.report_system_state()
+
+        # Push the updated system state and packet snapshot to streaming clients
+        if offsets or discarded:
+            self._system_changed()
+        if self.good_packet_counter != good_packets:
+            self.sse.notify('packet')
@@ -0,0 +1,348 @@
+"""Firmware emulator for the Hxtleak system.
+
+This module implements an emulator of the Hxtleak data transmitter firmware, which writes valid
+data packets to a pseudo-terminal (pty) at a configurable rate, from the nominal 2Hz up to the
+line rate of the serial link. Faults can be injected into the packet stream, including bad
+checksums, truncated packets, noise bytes and transmission stalls, and the emulated sensor values
+can be driven through warning and fault scenarios. This allows the controller and API to be
+load- and soak-tested without hardware.
+
+The emulator can be run standalone with the hxtleak_emulator command, which prints the name of
+the pty port to connect the adapter to.
+
+Tim Nicholls, STFC Detector Systems Software Group
+"""
+import argparse
+import logging
+import os
+import pty
+import random
+import threading
+import time
+import tty
+
+from .packet_decoder import HxtleakPacketDecoder, HxtleakSensorStatus
+from .util import HxtleakError
+
+
+class HxtleakEmulator():
+    """Hxtleak firmware emulator class."""
+
+    # Emulated sensor thresholds
+    BOARD_TEMP_THRESHOLD = 37.0
+    BOARD_HUMIDITY_THRESHOLD = 60.0
+    PROBE_TEMP_THRESHOLD = 35.0
+
+    # Sensor scenarios which can be emulated
+    SCENARIOS = ('normal', 'board_temp', 'board_humidity', 'probe_temp', 'leak', 'continuity')
+
+    # Number of bits transmitted per byte on the serial line, including start and stop bits
+    BITS_PER_BYTE = 10
+
+    def __init__(
+        self, rate=2.0, baudrate=57600, bad_checksum_rate=0.0, truncate_rate=0.0,
+        noise_rate=0.0, stall_rate=0.0, stall_time=1.0, scenario='normal', seed=None
+    ):
+        """Initialise the emulator.
+
+        :param rate: packet transmit rate in Hz, or zero to transmit at the line rate
+        :param baudrate: emulated serial line baud rate, limiting the maximum packet rate
+        :param bad_checksum_rate: probability of a packet being sent with a bad checksum
+        :param truncate_rate: probability of a packet being truncated
+        :param noise_rate: probability of noise bytes being sent before a packet
+        :param stall_rate: probability of transmission stalling before a packet
+        :param stall_time: duration of transmission stalls in seconds
+        :param scenario: initial sensor scenario to emulate
+        :param seed: random number generator seed, allowing fault injection to be reproduced
+        """
+        self.decoder = HxtleakPacketDecoder()
+
+        self.baudrate = baudrate
+        self.line_interval = self.decoder.size * self.BITS_PER_BYTE / self.baudrate
+        self.set_rate(rate)
+
+        self.bad_checksum_rate = bad_checksum_rate
+        self.truncate_rate = truncate_rate
+        self.noise_rate = noise_rate
+        self.stall_rate = stall_rate
+        self.stall_time = stall_time
+        self.set_scenario(scenario)
+
+        self.random = random.Random(seed)
+
+        self.master = None
+        self.slave = None
+        self.port_name = None
+
+        self.running = False
+        self._thread = None
+
+        self.packets_sent = 0
+        self.bad_checksums = 0
+        self.truncated = 0
+        self.noise_bytes = 0
+        self.stalls = 0
+        self.dropped_bytes = 0
+
+    def set_rate(self, rate):
+        """Set the packet transmit rate.
+
+        :param rate: packet transmit rate in Hz, or zero to transmit at the line rate
+        """
+        self.rate = rate
+        self.interval = max(1.0 / rate if rate > 0 else 0.0, self.line_interval)
+
+    def set_scenario(self, scenario):
+        """Set the sensor scenario to emulate.
+
+        :param scenario: sensor scenario name, one of SCENARIOS
+        """
+        if scenario not in self.SCENARIOS:
+            raise HxtleakError("Unknown emulator scenario {}".format(scenario))
+        self.scenario = scenario
+
+    def encode_packet(
+        self, board_temp=25.0, board_humidity=40.0, probe_temp_1=20.0, probe_temp_2=20.0,
+        leak_detected=False, leak_continuity=True, fault=False, warning=False, sensor_status=0,
+        bad_checksum=False
+    ):
+        """Encode a data packet with the specified values.
+
+        :param board_temp: board temperature value
+        :param board_humidity: board humidity value
+        :param probe_temp_1: probe 1 temperature value
+        :param probe_temp_2: probe 2 temperature value
+        :param leak_detected: leak detected flag
+        :param leak_continuity: leak detector continuity flag
+        :param fault: fault flag
+        :param warning: warning flag
+        :param sensor_status: sensor status bits
+        :param bad_checksum: corrupt the packet checksum if True
+        :return: bytes object containing the encoded packet
+        """
+        packet = bytearray(self.decoder.pack(
+            self.BOARD_TEMP_THRESHOLD, self.BOARD_HUMIDITY_THRESHOLD,
+            self.PROBE_TEMP_THRESHOLD, self.PROBE_TEMP_THRESHOLD,
+            board_temp, board_humidity, probe_temp_1, probe_temp_2,
+            leak_detected, leak_continuity, fault, warning, sensor_status,
+            0, int.from_bytes(self.decoder.EOP_BYTES, 'little')
+        ))
+
+        checksum = self.decoder.calc_checksum(packet)
+        if bad_checksum:
+            checksum ^= 0xff
+        packet[self.decoder.size - self.decoder.CSUM_AND_EOP_SIZE] = checksum
+
+        return bytes(packet)
+
+    def scenario_packet(self, bad_checksum=False):
+        """Encode a data packet with sensor values for the current scenario.
+
+        Sensor values are varied randomly around nominal values, with the values, flags and
+        status bits appropriate to the warning or fault conditions of the current scenario.
+
+        :param bad_checksum: corrupt the packet checksum if True
+        :return: bytes object containing the encoded packet
+        """
+        values = {
+            'board_temp': self.random.gauss(25.0, 0.2),
+            'board_humidity': self.random.gauss(40.0, 0.5),
+            'probe_temp_1': self.random.gauss(20.0, 0.2),
+            'probe_temp_2': self.random.gauss(20.0, 0.2),
+        }
+        status = 0
+        scenario = self.scenario
+
+        if scenario == 'board_temp':
+            values['board_temp'] = self.BOARD_TEMP_THRESHOLD + 2.0
+            status |= HxtleakSensorStatus.STATUS_BOARD_TEMPERATURE_WARNING
+        elif scenario == 'board_humidity':
+            values['board_humidity'] = self.BOARD_HUMIDITY_THRESHOLD + 5.0
+            status |= HxtleakSensorStatus.STATUS_BOARD_HUMIDITY_WARNING
+        elif scenario == 'probe_temp':
+            values['probe_temp_1'] = self.PROBE_TEMP_THRESHOLD + 2.0
+            status |= HxtleakSensorStatus.STATUS_PROBE_1_TEMPERATURE_FAULT
+
+        leak_detected = (scenario == 'leak')
+        leak_continuity = (scenario != 'continuity')
+        warning = scenario in ('board_temp', 'board_humidity')
+        fault = scenario in ('probe_temp', 'leak', 'continuity')
+
+        return self.encode_packet(
+            leak_detected=leak_detected, leak_continuity=leak_continuity, fault=fault,
+            warning=warning, sensor_status=int(status), bad_checksum=bad_checksum, **values
+        )
+
+    def next_chunk(self):
+        """Generate the next chunk of data to transmit.
+
+        This method generates the next packet for the current scenario, injecting faults into
+        it according to the configured probabilities.
+
+        :return: bytes object containing the data to transmit
+        """
+        chunk = b''
+
+        if self.random.random() < self.noise_rate:
+            noise = bytes(
+                self.random.getrandbits(8) for _ in range(self.random.randint(1, 16))
+            )
+            self.noise_bytes += len(noise)
+            chunk += noise
+
+        bad_checksum = self.random.random() < self.bad_checksum_rate
+        if bad_checksum:
+            self.bad_checksums += 1
+        packet = self.scenario_packet(bad_checksum)
+
+        if self.random.random() < self.truncate_rate:
+            self.truncated += 1
+            packet = packet[self.random.randint(1, len(packet) - 1):]
+
+        self.packets_sent += 1
+        return chunk + packet
+
+    def open(self):
+        """Open the emulator pty.
+
+        This method opens a pty pair in raw mode, the slave side of which can be opened as a
+        serial port by the controller. The master side is non-blocking, so that data is dropped,
+        as on a real serial line, rather than blocking the emulator if nothing is reading it.
+
+        :return: name of the pty port
+        """
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.port_name = os.ttyname(self.slave)
+        return self.port_name
+
+    def close(self):
+        """Close the emulator pty."""
+        self.stop()
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                os.close(fd)
+        self.master = self.slave = None
+
+    def write(self, data):
+        """Write data to the emulator pty.
+
+        :param data: bytes-like object containing data to write
+        """
+        try:
+            written = os.write(self.master, data)
+        except BlockingIOError:
+            written = 0
+        self.dropped_bytes += len(data) - written
+
+    def start(self):
+        """Start transmitting packets in a background thread."""
+        if self.master is None:
+            self.open()
+        self.running = True
+        self._thread = threading.Thread(target=self._transmit_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop transmitting packets."""
+        self.running = False
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _transmit_loop(self):
+        """Run the packet transmit loop.
+
+        This method runs in the background thread, transmitting packets at the configured rate
+        and injecting stalls as configured. Transmit times are scheduled from the loop start
+        time so that the average rate is maintained.
+        """
+        next_time = time.monotonic()
+
+        while self.running:
+
+            if self.random.random() < self.stall_rate:
+                self.stalls += 1
+                next_time += self.stall_time
+
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            self.write(self.next_chunk())
+            next_time += self.interval
+
+
+def main():
+    """Run the emulator from the command line."""
+    parser = argparse.ArgumentParser(description="Hxtleak firmware emulator")
+    parser.add_argument(
+        '--rate', type=float, default=2.0,
+        help="packet rate in Hz, or zero for line rate (default: %(default)s)"
+    )
+    parser.add_argument(
+        '--baudrate', type=int, default=57600,
+        help="emulated serial baud rate (default: %(default)s)"
+    )
+    parser.add_argument(
+        '--bad-checksum', type=float, default=0.0, help="probability of a bad packet checksum"
+    )
+    parser.add_argument(
+        '--truncate', type=float, default=0.0, help="probability of a truncated packet"
+    )
+    parser.add_argument(
+        '--noise', type=float, default=0.0, help="probability of noise bytes before a packet"
+    )
+    parser.add_argument(
+        '--stall', type=float, default=0.0, help="probability of a transmission stall"
+    )
+    parser.add_argument(
+        '--stall-time', type=float, default=1.0,
+        help="transmission stall duration in seconds (default: %(default)s)"
+    )
+    parser.add_argument(
+        '--scenario', choices=HxtleakEmulator.SCENARIOS, default='normal',
+        help="sensor scenario to emulate (default: %(default)s)"
+    )
+    parser.add_argument(
+        '--cycle', type=float, default=0.0,
+        help="cycle through all scenarios with this period in seconds"
+    )
+    parser.add_argument('--seed', type=int, default=None, help="random number generator seed")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    emulator = HxtleakEmulator(
+        rate=args.rate, baudrate=args.baudrate, bad_checksum_rate=args.bad_checksum,
+        truncate_rate=args.truncate, noise_rate=args.noise, stall_rate=args.stall,
+        stall_time=args.stall_time, scenario=args.scenario, seed=args.seed
+    )
+
+    port_name = emulator.open()
+    logging.info("Emulator transmitting on port %s at %.1f packets/s", port_name,
+                 1.0 / emulator.interval)
+    emulator.start()
+
+    try:
+        scenario_idx = HxtleakEmulator.SCENARIOS.index(args.scenario)
+        while True:
+            time.sleep(args.cycle if args.cycle > 0 else 10.0)
+            if args.cycle > 0:
+                scenario_idx = (scenario_idx + 1) % len(HxtleakEmulator.SCENARIOS)
+                emulator.set_scenario(HxtleakEmulator.SCENARIOS[scenario_idx])
+                logging.info("Emulator scenario set to %s", emulator.scenario)
+            logging.info(
+                "Emulator sent %d packets (%d bad checksum, %d truncated, %d noise bytes, "
+                "%d stalls)", emulator.packets_sent, emulator.bad_checksums, emulator.truncated,
+                emulator.noise_bytes, emulator.stalls
+            )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.close()
+
+
+if __name__ == '__main__':
+    main()
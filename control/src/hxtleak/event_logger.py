@@ -3,18 +3,26 @@
 This module implements a simple event logger for the Hxtleak adapter. It implements the standard
 logging module method (e.g. debug(), info(), warning()), with log messages being emitted to the
 specified logger but also captured in a local queue of fixed depth, which can then be exposed
-by an adapter parameter tree for clients to retrieve. Events after a specified timestamp can be
-retrieved, minimising traffic and load to the client.
+by an adapter parameter tree for clients to retrieve. Each event is given a monotonically
+increasing sequence number, and is stored in a ring buffer at the position given by its sequence
+number, so that clients can retrieve the events after the last sequence number they have seen
+without copying or scanning the queue, however deep it is. Each event is serialised once when it
+is logged, both as a dict and as an encoded JSON fragment, so that serving events to any number of
+clients costs no more than joining the cached fragments. Events after a specified timestamp can
+also be retrieved, minimising traffic and load to the client.
 
 Tim Nicholls, STFC Detector Systems Software Group
 """
+import json
 import logging
+import threading
 
-from collections import deque
 from dataclasses import dataclass
 from datetime import datetime
 from functools import partial
 
+from .util import HxtleakError
+
 
 @dataclass
 class LogEvent:
@@ -23,6 +31,9 @@ class LogEvent:
     timestamp: datetime
     level: int
     message: str
+    seq: int
+    record: dict
+    fragment: str
 
 
 class HxtleakEventLogger():
@@ -39,16 +50,25 @@ class HxtleakEventLogger():
         :param logger: system logger instance to bind to. If None, bind to the root logger
         :param maxlen: maximum length of the event storage queue (default = 250)
         """
+        if maxlen < 1:
+            raise HxtleakError("Event log length must be at least 1: {}".format(maxlen))
+
         # If no logger specified, bind to the root logger instance
         if not logger:
             logger = logging.getLogger()
         self.logger = logger
 
-        # Set up the event queue and internal variables
-        self._deque = deque(maxlen=maxlen)
+        # Set up the event ring buffer and internal variables. Sequence numbers start at 1 so that
+        # clients can request all events as those after sequence number 0.
+        self.maxlen = maxlen
+        self._ring = [None] * maxlen
+        self._next_seq = 1
+        self._lock = threading.Lock()
         self._events = []
         self._last_timestamp = None
         self._events_since = None
+        self._events_after = 0
+        self._listeners = []
 
         # Generate logging convenience methods (e.g. debug(), info(), ...) which mirror the
         # standard logger
@@ -81,10 +101,99 @@ class HxtleakEventLogger():
             msg = str(msg)
             if args:
                 msg = msg % args
-            self._deque.append(LogEvent(timestamp, level, msg))
 
-            # Update the last timestamp record in the event logger
-            self._last_timestamp = timestamp
+            # Store the event in the ring buffer, overwriting the oldest event once full, and
+            # update the last timestamp record in the event logger. The event is serialised in its
+            # final wire forms here, once, rather than each time it is served to a client.
+            with self._lock:
+                seq = self._next_seq
+                record = {
+                    "seq": seq,
+                    "timestamp": datetime.strftime(timestamp, self.TIMESTAMP_FORMAT),
+                    "level": logging.getLevelName(level),
+                    "message": msg
+                }
+                self._ring[seq % self.maxlen] = LogEvent(
+                    timestamp, level, msg, seq, record, json.dumps(record)
+                )
+                self._next_seq = seq + 1
+                self._last_timestamp = timestamp
+
+            # Notify listeners that an event has been logged
+            for listener in self._listeners:
+                listener()
+
+    def add_listener(self, listener):
+        """Add a listener called whenever an event is logged.
+
+        Listeners are called on the thread logging the event and so should return quickly.
+
+        :param listener: callable taking no arguments
+        """
+        self._listeners.append(listener)
+
+    def last_seq(self):
+        """Return the sequence number of the most recent event logged, or 0 if none."""
+        return self._next_seq - 1
+
+    def get_events_after(self, seq, limit=None):
+        """Return the logged events after a sequence number.
+
+        Since sequence numbers are contiguous, the position of each event in the ring buffer is
+        calculated directly from its sequence number, so this costs O(k) for the k events
+        returned, regardless of the depth of the ring buffer. Events which have been overwritten
+        are skipped. No lock is taken, since each event is stored before the next sequence number
+        is advanced, and events overwritten during the call are detected by their sequence number.
+
+        :param seq: sequence number of the last event already seen, or 0 for all events
+        :param limit: maximum number of events to return, or None for all
+        :return: list of events in sequence order
+        """
+        next_seq = self._next_seq
+        first = max(seq + 1, next_seq - self.maxlen, 1)
+        stop = next_seq if limit is None else min(next_seq, first + limit)
+
+        events = []
+        for idx in range(first, stop):
+            event = self._ring[idx % self.maxlen]
+            if event.seq == idx:
+                events.append(event)
+        return events
+
+    def query(self, after=0, limit=None):
+        """Query the logged events after a cursor.
+
+        This method allows clients to retrieve events statelessly, each client holding its own
+        cursor, i.e. the sequence number of the last event it has received, and passing it with
+        each request. If the cursor is beyond the last event logged, e.g. because the client has
+        outlived a restart of the adapter, all events still held are returned and the reset flag
+        set, so that the client can discard the events it holds. The result is built by joining
+        the JSON fragments of the events cached when they were logged.
+
+        :param after: cursor sequence number to return events after
+        :param limit: maximum number of events to return, or None for all
+        :return: JSON-encoded string of the events, the cursor for the next query and reset flag
+        """
+        reset = after > self.last_seq()
+        if reset:
+            after = 0
+
+        return self.encode_events(self.get_events_after(after, limit), after, reset)
+
+    @staticmethod
+    def encode_events(events, after=0, reset=False):
+        """Encode a list of events as JSON from the fragments cached when they were logged.
+
+        :param events: list of events in sequence order
+        :param after: cursor sequence number the events were retrieved after
+        :param reset: value of the reset flag
+        :return: JSON-encoded string of the events, the cursor for the next query and reset flag
+        """
+        return '{{"events": [{}], "cursor": {}, "reset": {}}}'.format(
+            ', '.join(event.fragment for event in events),
+            events[-1].seq if events else after,
+            'true' if reset else 'false'
+        )
 
     def events(self):
         """Return logged events.
@@ -95,14 +204,7 @@ class HxtleakEventLogger():
 
         :return list of dict-formatted events since the set_events_since() timestamp
         """
-        return [
-            {
-                "timestamp": datetime.strftime(event.timestamp, self.TIMESTAMP_FORMAT),
-                "level": logging.getLevelName(event.level),
-                "message": event.message
-            }
-            for event in self._events
-        ]
+        return [event.record for event in self._events]
 
     def last_timestamp(self):
         """Return the last event timetamp.
@@ -140,8 +242,8 @@ class HxtleakEventLogger():
         # Create an empty event list to populate
         events = []
 
-        # Copy the event queue into a working list so that events aren't removed from it
-        event_list = list(self._deque)
+        # Copy the events in the ring buffer into a working list
+        event_list = self.get_events_after(0)
 
         # If a timestamp was specified, parse that and populate the event list with events logged
         # since that timestamp. Otherwise populate the event list with all logged events still
@@ -158,3 +260,26 @@ class HxtleakEventLogger():
             events = event_list
 
         self._events = events
+
+    def events_after(self):
+        """Return the currently set sequence number for retrieving events after.
+
+        :return: current events-after sequence number
+        """
+        return self._events_after
+
+    def set_events_after(self, seq=0):
+        """Set the sequence number for retrieving events after.
+
+        This method sets the events after sequence number, populating the internal event list with
+        the events logged after it, which is then retrieved by a subsequent call to events().
+        Clients should pass the sequence number of the last event they have received, or 0 to
+        receive all logged events still held.
+
+        :param seq: sequence number to get events after
+        """
+        try:
+            self._events_after = int(seq)
+        except (TypeError, ValueError):
+            raise HxtleakError("Invalid event sequence number: {}".format(seq))
+        self._events = self.get_events_after(self._events_after)
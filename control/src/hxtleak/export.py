@@ -0,0 +1,225 @@
+"""History export encoding for the Hxtleak adapter.
+
+This module implements the encoding of chunks of exported sensor history as CSV or newline-
+delimited JSON (NDJSON), optionally gzip-compressed. Each chunk is encoded independently as it is
+produced, using a row template built once for the exported channels, so that an export of any
+length can be streamed with no more than one chunk held in memory.
+
+History query results can also be encoded as a compact binary payload for analysis clients: a
+small JSON header describing the record layout as a NumPy structured dtype, followed by the packed
+records, allowing clients to load the records directly with numpy.frombuffer.
+
+Tim Nicholls, STFC Detector Systems Software Group
+"""
+import json
+import math
+import struct
+import sys
+import zlib
+from array import array
+
+from .history import HxtleakHistory
+from .util import HxtleakError
+
+
+class _JsonNull():
+    """Placeholder for non-finite values in NDJSON exports, formatted as a JSON null."""
+
+    def __format__(self, format_spec):
+        """Format the placeholder as null, whatever the format specification."""
+        return 'null'
+
+
+_NULL = _JsonNull()
+
+
+class HxtleakExportEncoder():
+    """History export encoder class."""
+
+    # Export formats and their content types
+    FORMATS = {
+        'csv': 'text/csv',
+        'ndjson': 'application/x-ndjson',
+    }
+
+    # Value formats of the exported channels. Timestamps are formatted to microsecond resolution
+    # and float channels to the precision of the float32 values held in the history. Non-finite
+    # float values are exported as nan or inf in CSV, and as null in NDJSON, since JSON has no
+    # representation of them.
+    TIMESTAMP_FORMAT = '{:.6f}'
+    FLOAT_FORMAT = '{:.7g}'
+    BIT_FORMAT = '{:d}'
+
+    def __init__(self, export_format, fields, compress=False):
+        """Initialise the export encoder.
+
+        :param export_format: export format, one of FORMATS
+        :param fields: list of exported channel names, in column order
+        :param compress: gzip-compress the encoded export if True
+        """
+        if export_format not in self.FORMATS:
+            raise HxtleakError("Unknown history export format {}".format(export_format))
+
+        self.export_format = export_format
+        self.content_type = self.FORMATS[export_format]
+        self.fields = list(fields)
+
+        # Float channels whose non-finite values are replaced by null placeholders when encoded
+        self._null_fields = []
+
+        value_formats = [self._value_format(name) for name in self.fields]
+        if export_format == 'csv':
+            self.row_template = ','.join(value_formats) + '\n'
+        else:
+            self._null_fields = [
+                name for (name, value_format) in zip(self.fields, value_formats)
+                if value_format == self.FLOAT_FORMAT
+            ]
+            self.row_template = '{{' + ','.join(
+                '"{}":{}'.format(name, value_format)
+                for (name, value_format) in zip(self.fields, value_formats)
+            ) + '}}\n'
+
+        # Create a gzip compressor if requested, the wbits value selecting the gzip container
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+    def _value_format(self, name):
+        """Return the value format of an exported channel."""
+        if name == 'timestamp':
+            return self.TIMESTAMP_FORMAT
+        if name in HxtleakHistory.BIT_FIELDS:
+            return self.BIT_FORMAT
+        return self.FLOAT_FORMAT
+
+    def header(self):
+        """Encode the header of the export.
+
+        :return: bytes of the CSV column header line, or empty for NDJSON
+        """
+        header = ','.join(self.fields) + '\n' if self.export_format == 'csv' else ''
+        return self._compress(header.encode())
+
+    def encode(self, chunk):
+        """Encode a chunk of exported history.
+
+        :param chunk: dict of lists of channel values keyed by channel name
+        :return: bytes of the encoded rows
+        """
+        row_template = self.row_template
+        columns = dict(chunk)
+        for name in self._null_fields:
+            column = columns[name]
+            if not all(map(math.isfinite, column)):
+                columns[name] = [value if math.isfinite(value) else _NULL for value in column]
+        rows = zip(*(columns[name] for name in self.fields))
+        return self._compress(''.join(row_template.format(*row) for row in rows).encode())
+
+    def finish(self):
+        """Complete the export.
+
+        :return: bytes remaining to be sent, flushed from the compressor if enabled
+        """
+        return self.compressor.flush() if self.compressor else b''
+
+    def _compress(self, data):
+        """Compress encoded data if compression is enabled."""
+        return self.compressor.compress(data) if self.compressor else data
+
+
+class HxtleakBinaryEncoder():
+    """Binary history query result encoder class.
+
+    The encoded payload starts with the MAGIC bytes and the length of the JSON header as a little-
+    endian 32-bit integer. The header holds the query time range, method and sample count, the
+    number of records and the record layout in NumPy array-interface dtype form. The packed,
+    little-endian records follow the header, which is padded so that they start on an 8-byte
+    boundary. A client can load the records as a NumPy structured array with:
+
+        size = struct.unpack_from('<I', payload, 8)[0]
+        header = json.loads(payload[12:12 + size])
+        dtype = [tuple(field) for field in header['dtype']]
+        records = numpy.frombuffer(payload, dtype, header['records'], 12 + size)
+    """
+
+    MAGIC = b'HXTLBIN1'
+    HEADER_SIZE = struct.Struct('<I')
+    ALIGNMENT = 8
+
+    # NumPy type descriptions of the array typecodes used for the record fields
+    DESCRS = {'d': '<f8', 'f': '<f4', 'B': '|u1'}
+
+    # Aggregate values always encoded at double precision
+    DOUBLE_KEYS = ('timestamp', 'mean', 'std')
+
+    @classmethod
+    def encode(cls, result):
+        """Encode a history query result.
+
+        Each channel of a raw result is encoded as a record field of the same name. Channels
+        reduced to several values, e.g. the minimum, maximum and mean of minmax results, are
+        encoded as a field for each, named by the channel and value, e.g. board_temp_min.
+
+        :param result: dict of history query results
+        :return: bytes of the encoded payload
+        """
+        typecodes = dict(HxtleakHistory.FIELDS)
+
+        columns = []
+        if 'timestamp' in result:
+            columns.append(('timestamp', 'd', result['timestamp']))
+        for (name, values) in result['fields'].items():
+            if isinstance(values, dict):
+                for (key, key_values) in values.items():
+                    typecode = 'd' if key in cls.DOUBLE_KEYS else typecodes[name]
+                    columns.append(('{}_{}'.format(name, key), typecode, key_values))
+            else:
+                columns.append((name, typecodes[name], values))
+
+        records = len(columns[0][2]) if columns else 0
+        header = {
+            'start': result['start'],
+            'end': result['end'],
+            'count': result['count'],
+            'method': result['method'],
+            'records': records,
+            'dtype': [(name, cls.DESCRS[typecode]) for (name, typecode, _) in columns],
+        }
+        if 'tier' in result:
+            header['tier'] = result['tier']
+
+        # Pad the header so that the records start on an aligned boundary
+        header = json.dumps(header).encode()
+        prefix_size = len(cls.MAGIC) + cls.HEADER_SIZE.size
+        header += b' ' * (-(prefix_size + len(header)) % cls.ALIGNMENT)
+
+        return cls.MAGIC + cls.HEADER_SIZE.pack(len(header)) + header + cls._pack_records(
+            columns, records
+        )
+
+    @staticmethod
+    def _pack_records(columns, records):
+        """Pack columns of values into interleaved records.
+
+        Each byte of each field is copied into the records with a single extended slice
+        assignment, so that the columns are interleaved without a Python loop over the records.
+
+        :param columns: list of (name, typecode, values) tuples of each record field
+        :param records: number of records
+        :return: bytearray of packed records
+        """
+        column_bytes = []
+        for (_, typecode, values) in columns:
+            column = array(typecode, values)
+            if sys.byteorder == 'big':
+                column.byteswap()
+            column_bytes.append((column.itemsize, column.tobytes()))
+
+        record_size = sum(itemsize for (itemsize, _) in column_bytes)
+        packed = bytearray(record_size * records)
+        offset = 0
+        for (itemsize, data) in column_bytes:
+            for byte_idx in range(itemsize):
+                packed[offset + byte_idx::record_size] = data[byte_idx::itemsize]
+            offset += itemsize
+
+        return packed
@@ -0,0 +1,96 @@
+"""Streaming packet framer for the Hxtleak adapter.
+
+This module implements a streaming packet framer, which extracts complete, fixed-size data packets
+from the raw byte stream received on the serial port. Data is fed into the framer as it is read,
+which scans for the end of packet marker anywhere in the buffered stream. The offsets of all
+complete packets in the framer buffer are returned, allowing them to be decoded without copying,
+any partial packet at the tail of the stream is retained until the next read, and bytes discarded
+while resynchronising to the packet boundaries are counted. Since the marker values can also occur
+within a packet payload, candidate packets found while resynchronising can be validated, e.g. by
+their checksum, before they are accepted.
+
+Tim Nicholls, STFC Detector Systems Software Group
+"""
+
+
+class HxtleakPacketFramer():
+    """Hxtleak streaming packet framer class."""
+
+    def __init__(self, packet_size, eop_bytes, validate=None):
+        """Initialise the packet framer.
+
+        :param packet_size: size of a complete packet in bytes, including the end of packet marker
+        :param eop_bytes: end of packet marker bytes terminating each packet
+        :param validate: optional callable taking the buffer and offset of a candidate packet
+                         found while resynchronising, returning True if it is a valid packet
+        """
+        self.packet_size = packet_size
+        self.eop_bytes = bytes(eop_bytes)
+        self.validate = validate
+
+        # A packet end marker can only be found at least this far into the unconsumed stream
+        self._eop_offset = self.packet_size - len(self.eop_bytes)
+
+        self.buffer = bytearray()
+        self._consumed = 0
+        self.packets_framed = 0
+        self.discarded_bytes = 0
+
+    def feed(self, data):
+        """Feed received data into the framer.
+
+        This method appends the received data to the framer buffer and locates all complete
+        packets in it. Bytes preceding a packet which cannot form part of it are discarded and
+        counted, and any trailing partial packet is retained for subsequent calls. The returned
+        packet offsets refer to the framer buffer and remain valid until the next call.
+
+        :param data: bytes-like object containing received data
+        :return: tuple of list of complete packet offsets in buffer and number of bytes discarded
+        """
+        # Remove data consumed by the previous call from the buffer before appending new data
+        buffer = self.buffer
+        del buffer[:self._consumed]
+        buffer.extend(data)
+
+        offsets = []
+        discarded = 0
+        start = 0
+        search = self._eop_offset
+
+        # Search for end of packet markers far enough into the stream to terminate a complete
+        # packet, which skips any marker values occuring within the packet payload itself
+        while True:
+            eop_pos = buffer.find(self.eop_bytes, search)
+            if eop_pos < 0:
+                break
+
+            end = eop_pos + len(self.eop_bytes)
+            packet_start = end - self.packet_size
+
+            # If resynchronising, the marker may lie within the payload of a packet, so reject an
+            # invalid candidate packet and continue searching from the next byte
+            if packet_start != start and self.validate and not self.validate(buffer, packet_start):
+                search = eop_pos + 1
+                continue
+
+            # Any bytes between the end of the last packet and this one are discarded
+            discarded += packet_start - start
+
+            offsets.append(packet_start)
+            start = end
+            search = start + self._eop_offset
+
+        # Retain at most the trailing bytes which could form part of the next packet, including
+        # a possible end of packet marker split across reads, discarding anything before that
+        self._consumed = max(start, len(buffer) - (self.packet_size - 1))
+        discarded += self._consumed - start
+
+        self.packets_framed += len(offsets)
+        self.discarded_bytes += discarded
+
+        return offsets, discarded
+
+    def reset(self):
+        """Reset the framer, clearing any buffered partial packet."""
+        self.buffer.clear()
+        self._consumed = 0
@@ -0,0 +1,527 @@
+"""In-memory sensor history for the Hxtleak adapter.
+
+This module implements a fixed-capacity, columnar ring buffer holding the history of the sensor
+values received in good packets. Each channel is stored in a preallocated typed array, so that
+appending a sample is O(1), overwrites the oldest sample once the buffer is full and creates no
+per-sample Python objects. The flag values of each packet are packed into a single byte. With the
+default capacity, a day of samples at the nominal 2Hz packet rate is held in about 7MB.
+
+The history can be queried over a time range for a projection of its channels, reduced to a target
+number of points either by aggregating time buckets to their minimum, maximum and mean values, or
+by selecting representative samples with the largest-triangle-three-buckets (LTTB) algorithm. The
+reductions operate on array slices using the builtin aggregate functions, so that the per-sample
+work is done in C rather than by Python loops wherever possible, the exception being the
+calculation of the LTTB triangle areas.
+
+Queries may be run off the IOLoop, e.g. in an executor thread, while samples are appended. The
+samples queried are therefore copied from the ring buffer under a lock shared with appending, so
+that the reduction sees a consistent snapshot without holding the lock.
+
+Tim Nicholls, STFC Detector Systems Software Group
+"""
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from functools import reduce
+from operator import or_
+
+from .util import HxtleakError
+
+
+def ring_range(column, head, count, start=0, stop=None):
+    """Return a chronological range of the values held in a ring buffer array.
+
+    Indices count from the oldest value held in the ring. Negative indices count back from the
+    most recent value, as for a list.
+
+    :param column: ring buffer array
+    :param head: index in the array at which the next value will be written
+    :param count: number of values held in the ring
+    :param start: index of the first value to return
+    :param stop: index after the last value to return, or None for the most recent
+    :return: array of values in chronological order
+    """
+    (start, stop, _) = slice(start, stop).indices(count)
+    if start >= stop:
+        return column[:0]
+
+    # Map the chronological range onto the ring, which wraps at most once
+    capacity = len(column)
+    oldest = head - count
+    first = (oldest + start) % capacity
+    last = (oldest + stop) % capacity or capacity
+
+    if first < last:
+        return column[first:last]
+    return column[first:] + column[:last]
+
+
+def bucket_bounds(timestamps, buckets):
+    """Divide a series of timestamps into buckets of equal time.
+
+    :param timestamps: array of timestamps in chronological order
+    :param buckets: number of buckets
+    :return: list of (start time, first index, end index) of each non-empty bucket
+    """
+    t_start = timestamps[0]
+    t_width = (timestamps[-1] - t_start) / buckets
+
+    bounds = []
+    first = 0
+    for bucket in range(1, buckets + 1):
+        last = (
+            len(timestamps) if bucket == buckets
+            else bisect_left(timestamps, t_start + bucket * t_width, first)
+        )
+        if last > first:
+            bounds.append((t_start + (bucket - 1) * t_width, first, last))
+            first = last
+
+    return bounds
+
+
+def bitwise_or(values):
+    """Return the bitwise OR of a sequence of byte values.
+
+    The distinct values are first collected in a set, so that only those are combined in Python.
+
+    :param values: sequence of byte values, e.g. an array slice
+    :return: bitwise OR of the values
+    """
+    return reduce(or_, set(values), 0)
+
+
+class HxtleakHistoryFlags():
+    """Bit values of the packet flags packed into the history flags channel."""
+
+    LEAK_DETECTED = 0x1
+    LEAK_CONTINUITY = 0x2
+    FAULT = 0x4
+    WARNING = 0x8
+
+
+class HxtleakHistory():
+    """Columnar sensor history ring buffer class."""
+
+    # Channels held in the history, with the array typecode used to store each. The timestamp is
+    # the wall-clock receive time in seconds since the epoch.
+    FIELDS = (
+        ('timestamp', 'd'),
+        ('board_temp', 'f'),
+        ('board_humidity', 'f'),
+        ('probe_temp_1', 'f'),
+        ('probe_temp_2', 'f'),
+        ('board_temp_threshold', 'f'),
+        ('board_humidity_threshold', 'f'),
+        ('probe_temp_1_threshold', 'f'),
+        ('probe_temp_2_threshold', 'f'),
+        ('flags', 'B'),
+        ('sensor_status', 'B'),
+    )
+    FIELD_NAMES = tuple(name for (name, _) in FIELDS)
+
+    # Channels holding bit values, which are aggregated by bitwise OR rather than min/max/mean
+    BIT_FIELDS = ('flags', 'sensor_status')
+
+    # Methods available to reduce queried history to the requested number of points
+    QUERY_METHODS = ('raw', 'minmax', 'lttb')
+
+    def __init__(self, capacity=172800, window=120):
+        """Initialise the history.
+
+        :param capacity: maximum number of samples held, the oldest being overwritten when full
+        :param window: number of most recent samples returned by the recent parameter
+        """
+        if capacity < 1:
+            raise HxtleakError("History capacity must be at least 1 sample")
+
+        self.capacity = capacity
+        self.window = window
+
+        # Preallocate a zero-filled array for each channel
+        self.columns = {
+            name: array(typecode, bytes(array(typecode).itemsize * capacity))
+            for (name, typecode) in self.FIELDS
+        }
+
+        self.count = 0
+        self.total = 0
+        self._head = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_columns(cls, columns):
+        """Create a full history from arrays of channel values.
+
+        Only the channels provided are held in the history, which is sized to fit them exactly.
+
+        :param columns: dict of arrays of channel values in chronological order, keyed by channel
+                        name, which must include the timestamps
+        :return: HxtleakHistory instance
+        """
+        count = len(columns['timestamp'])
+        history = cls.__new__(cls)
+        history.capacity = max(count, 1)
+        history.window = 0
+        history.columns = dict(columns)
+        history.count = count
+        history.total = count
+        history._head = 0
+        history._lock = threading.Lock()
+        return history
+
+    def append(self, timestamp, packet):
+        """Append a sample to the history.
+
+        :param timestamp: wall-clock receive time of the packet in seconds since the epoch
+        :param packet: decoded packet snapshot
+        """
+        flags = (
+            packet.leak_detected | packet.leak_continuity << 1
+            | packet.fault << 2 | packet.warning << 3
+        )
+        columns = self.columns
+
+        with self._lock:
+            idx = self._head
+            columns['timestamp'][idx] = timestamp
+            columns['board_temp'][idx] = packet.board_temp
+            columns['board_humidity'][idx] = packet.board_humidity
+            columns['probe_temp_1'][idx] = packet.probe_temp_1
+            columns['probe_temp_2'][idx] = packet.probe_temp_2
+            columns['board_temp_threshold'][idx] = packet.board_temp_threshold
+            columns['board_humidity_threshold'][idx] = packet.board_humidity_threshold
+            columns['probe_temp_1_threshold'][idx] = packet.probe_temp_1_threshold
+            columns['probe_temp_2_threshold'][idx] = packet.probe_temp_2_threshold
+            columns['flags'][idx] = flags
+            columns['sensor_status'][idx] = packet.sensor_status
+
+            self._head = idx + 1 if idx + 1 < self.capacity else 0
+            if self.count < self.capacity:
+                self.count += 1
+            self.total += 1
+
+    def extend(self, columns):
+        """Append samples to the history from arrays of channel values.
+
+        The samples are copied into the ring buffer with slice assignments, e.g. when restoring the
+        history from the history store, rather than appended individually.
+
+        :param columns: dict of arrays of the values of all channels in chronological order, keyed
+                        by channel name, each of the typecode of the channel in FIELDS
+        """
+        count = len(columns['timestamp'])
+        skip = max(count - self.capacity, 0)
+
+        with self._lock:
+            for (name, column) in self.columns.items():
+                values = columns[name][skip:]
+                idx = self._head
+                while values:
+                    chunk = min(len(values), self.capacity - idx)
+                    column[idx:idx + chunk] = values[:chunk]
+                    values = values[chunk:]
+                    idx = (idx + chunk) % self.capacity
+
+            self._head = (self._head + count - skip) % self.capacity
+            self.count = min(self.count + count, self.capacity)
+            self.total += count
+
+    def clear(self):
+        """Clear all samples from the history."""
+        with self._lock:
+            self.count = 0
+            self._head = 0
+
+    def column(self, name, start=0, stop=None):
+        """Return a range of samples of a channel in chronological order.
+
+        Sample indices count from the oldest sample held in the history. Negative indices count
+        back from the most recent sample, as for a list.
+
+        :param name: name of the channel
+        :param start: index of the first sample to return
+        :param stop: index after the last sample to return, or None for the most recent
+        :return: list of channel values
+        """
+        return self._column_array(name, start, stop).tolist()
+
+    def _column_array(self, name, start=0, stop=None):
+        """Return a range of samples of a channel in chronological order as an array.
+
+        :param name: name of the channel
+        :param start: index of the first sample to return
+        :param stop: index after the last sample to return, or None for the most recent
+        :return: array of channel values
+        """
+        if name not in self.columns:
+            raise HxtleakError("Unknown history field {}".format(name))
+
+        return ring_range(self.columns[name], self._head, self.count, start, stop)
+
+    def columns_dict(self, fields=None, start=0, stop=None):
+        """Return a range of samples of several channels in chronological order.
+
+        :param fields: iterable of channel names to return, or None for all channels
+        :param start: index of the first sample to return
+        :param stop: index after the last sample to return, or None for the most recent
+        :return: dict of lists of channel values keyed by channel name
+        """
+        fields = self.FIELD_NAMES if fields is None else fields
+        return {name: self.column(name, start, stop) for name in fields}
+
+    def query(self, start=None, end=None, fields=None, points=1000, method='minmax'):
+        """Query the history over a time range, reducing it to a target number of points.
+
+        The samples between the start and end times are selected by binary search of the
+        timestamps and copied under the lock, so that this method may be called from any thread. If
+        there are no more samples than requested points, or the raw method is requested, they are
+        returned unreduced. Otherwise, they are reduced by the minmax method,
+        which divides the time range into equal buckets and returns the minimum, maximum and mean
+        of each channel in each non-empty bucket, or the lttb method, which selects the sample of
+        each channel in each bucket best preserving the visual shape of the series.
+
+        :param start: start of time range in seconds since the epoch, or None for the oldest sample
+        :param end: end of time range in seconds since the epoch, or None for the newest sample
+        :param fields: iterable of channel names to return, or None for all channels
+        :param points: target number of points to reduce the samples to
+        :param method: reduction method, one of QUERY_METHODS
+        :return: dict of query results
+        """
+        fields = [
+            name for name in (self.FIELD_NAMES if fields is None else fields)
+            if name != 'timestamp'
+        ]
+        for name in fields:
+            if name not in self.columns:
+                raise HxtleakError("Unknown history field {}".format(name))
+        if method not in self.QUERY_METHODS:
+            raise HxtleakError("Unknown history query method {}".format(method))
+        if points < 3:
+            raise HxtleakError("History query must request at least 3 points")
+
+        # Locate the samples in the time range by binary search of the timestamps, copying the
+        # requested channels of the samples in the range under the lock
+        with self._lock:
+            timestamps = self._column_array('timestamp')
+            first = 0 if start is None else bisect_left(timestamps, start)
+            last = len(timestamps) if end is None else bisect_right(timestamps, end)
+            last = max(first, last)
+            timestamps = timestamps[first:last]
+            columns = {name: self._column_array(name, first, last) for name in fields}
+
+        result = {
+            'start': start,
+            'end': end,
+            'count': len(timestamps),
+            'method': method,
+        }
+
+        # Return the samples unreduced if requested or if they do not exceed the point count
+        if method == 'raw' or len(timestamps) <= points:
+            result['method'] = 'raw'
+            result['timestamp'] = timestamps.tolist()
+            result['fields'] = {name: column.tolist() for (name, column) in columns.items()}
+            return result
+
+        if method == 'minmax':
+            result.update(self._reduce_minmax(timestamps, columns, points))
+        else:
+            result.update(self._reduce_lttb(timestamps, columns, points))
+
+        return result
+
+    @classmethod
+    def export_fields(cls, fields=None):
+        """Resolve the channels included in an export of the history.
+
+        :param fields: iterable of channel names to export, or None for all channels
+        :return: list of channel names to export, always starting with the timestamp
+        """
+        fields = [
+            name for name in (cls.FIELD_NAMES if fields is None else fields)
+            if name != 'timestamp'
+        ]
+        for name in fields:
+            if name not in cls.FIELD_NAMES:
+                raise HxtleakError("Unknown history field {}".format(name))
+        return ['timestamp'] + fields
+
+    def export(self, start=None, end=None, fields=None, chunk_records=1024):
+        """Export the samples in a time range in chunks.
+
+        The samples in the range are located when called, and each chunk copied from the history
+        only as the returned generator is consumed. Samples are tracked by their absolute sample
+        number, so that samples appended while the export is in progress are not included, and
+        samples overwritten before they are exported are skipped.
+
+        :param start: start of time range in seconds since the epoch, or None for the oldest sample
+        :param end: end of time range in seconds since the epoch, or None for the newest sample
+        :param fields: iterable of channel names to export, or None for all channels
+        :param chunk_records: maximum number of samples in each chunk
+        :return: generator yielding dicts of lists of channel values keyed by channel name
+        """
+        fields = self.export_fields(fields)
+
+        with self._lock:
+            timestamps = self._column_array('timestamp')
+            offset = self.total - self.count
+        first = 0 if start is None else bisect_left(timestamps, start)
+        last = len(timestamps) if end is None else bisect_right(timestamps, end)
+
+        return self._export_chunks(fields, first + offset, last + offset, chunk_records)
+
+    def _export_chunks(self, fields, first, last, chunk_records):
+        """Generate chunks of exported samples between absolute sample numbers.
+
+        Exports may be consumed off the IOLoop, so each chunk is copied under the lock shared with
+        appending samples, which is released before the chunk is yielded.
+        """
+        while first < last:
+            chunk = None
+            with self._lock:
+                offset = self.total - self.count
+                chunk_first = max(first, offset)
+                chunk_last = min(chunk_first + chunk_records, last)
+                if chunk_last > chunk_first:
+                    chunk = self.columns_dict(fields, chunk_first - offset, chunk_last - offset)
+            if chunk:
+                yield chunk
+            first = chunk_last
+
+    def _reduce_minmax(self, timestamps, columns, points):
+        """Reduce samples to the minimum, maximum and mean values of equal time buckets.
+
+        Bit-valued channels are reduced to the bitwise OR of each bucket, so that any flag set
+        within a bucket is reported.
+
+        :param timestamps: array of sample timestamps in chronological order
+        :param columns: dict of arrays of channel values keyed by channel name
+        :param points: number of buckets
+        :return: dict of bucket start times and reduced channel values
+        """
+        bounds = bucket_bounds(timestamps, points)
+        fields = {}
+
+        for (name, column) in columns.items():
+            if name in self.BIT_FIELDS:
+                fields[name] = [bitwise_or(column[first:last]) for (_, first, last) in bounds]
+                continue
+
+            mins = []
+            maxs = []
+            means = []
+            for (_, first, last) in bounds:
+                bucket = column[first:last]
+                mins.append(min(bucket))
+                maxs.append(max(bucket))
+                means.append(sum(bucket) / len(bucket))
+            fields[name] = {'min': mins, 'max': maxs, 'mean': means}
+
+        return {
+            'timestamp': [t_bucket for (t_bucket, _, _) in bounds],
+            'fields': fields,
+        }
+
+    def _reduce_lttb(self, timestamps, columns, points):
+        """Reduce samples with the largest-triangle-three-buckets algorithm.
+
+        The first and last samples are always retained, and the remaining samples are divided into
+        points - 2 buckets of equal count. From each bucket, the sample forming the largest
+        triangle with the previously selected sample and the mean of the next bucket is selected.
+        Since the selected samples differ between channels, the timestamps of the selected samples
+        are returned for each channel.
+
+        The triangle areas are calculated by a Python loop over the samples, which was measured to
+        be faster than chaining operator functions mapped over the bucket slices, since every
+        intermediate value is still a Python float. LTTB queries of long ranges are therefore
+        costly, and should be run off the IOLoop.
+
+        :param timestamps: array of sample timestamps in chronological order
+        :param columns: dict of arrays of channel values keyed by channel name
+        :param points: number of points to select
+        :return: dict of selected timestamps and values of each channel
+        """
+        num_samples = len(timestamps)
+        buckets = points - 2
+        width = (num_samples - 2) / buckets
+        bounds = [int(1 + idx * width) for idx in range(buckets)] + [num_samples - 1]
+
+        # Calculate the mean timestamp of each bucket, plus the last sample, once for all channels
+        t_means = [
+            sum(timestamps[bounds[idx]:bounds[idx + 1]]) / (bounds[idx + 1] - bounds[idx])
+            for idx in range(buckets)
+        ] + [timestamps[-1]]
+
+        fields = {}
+        for (name, column) in columns.items():
+            v_means = [
+                sum(column[bounds[idx]:bounds[idx + 1]]) / (bounds[idx + 1] - bounds[idx])
+                for idx in range(buckets)
+            ] + [column[-1]]
+
+            selected = [0]
+            prev = 0
+            for idx in range(buckets):
+                (t_prev, v_prev) = (timestamps[prev], column[prev])
+                (t_next, v_next) = (t_means[idx + 1], v_means[idx + 1])
+
+                # The triangle area is proportional to the absolute value of this cross product
+                dt = t_next - t_prev
+                dv = v_next - v_prev
+                max_area = -1.0
+                for sample in range(bounds[idx], bounds[idx + 1]):
+                    area = abs(
+                        dt * (column[sample] - v_prev) - dv * (timestamps[sample] - t_prev)
+                    )
+                    if area > max_area:
+                        max_area = area
+                        prev = sample
+                selected.append(prev)
+            selected.append(num_samples - 1)
+
+            fields[name] = {
+                'timestamp': [timestamps[idx] for idx in selected],
+                'value': [column[idx] for idx in selected],
+            }
+
+        return {'fields': fields}
+
+    def memory_size(self):
+        """Return the memory used by the history channel arrays in bytes."""
+        return sum(column.itemsize * len(column) for column in self.columns.values())
+
+    def _set_window(self, window):
+        """Set the number of most recent samples returned by the recent parameter."""
+        self.window = max(int(window), 0)
+
+    def _get_recent(self):
+        """Return the most recent window of samples of all channels."""
+        return self.columns_dict(start=max(self.count - self.window, 0))
+
+    def first_timestamp(self):
+        """Return the timestamp of the oldest sample, or None if the history is empty."""
+        with self._lock:
+            return self.column('timestamp', 0, 1)[0] if self.count else None
+
+    def last_timestamp(self):
+        """Return the timestamp of the newest sample, or None if the history is empty."""
+        with self._lock:
+            return self.column('timestamp', -1)[0] if self.count else None
+
+    def tree(self):
+        """Return a dict-like tree of history parameters.
+
+        :return dict-like tree of history parameter accessors
+        """
+        return {
+            'capacity': (lambda: self.capacity, None),
+            'count': (lambda: self.count, None),
+            'total': (lambda: self.total, None),
+            'memory_size': (self.memory_size, None),
+            'fields': (lambda: list(self.FIELD_NAMES), None),
+            'first_timestamp': (self.first_timestamp, None),
+            'last_timestamp': (self.last_timestamp, None),
+            'window': (lambda: self.window, self._set_window),
+            'recent': (self._get_recent, None),
+        }
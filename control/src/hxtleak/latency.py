@@ -0,0 +1,84 @@
+"""Latency histogram for the Hxtleak adapter.
+
+This module implements a simple fixed-bucket latency histogram, used to record the distribution of
+latencies of time-critical operations, such as turning off the outlet relays when a fault is
+detected. Buckets are spaced logarithmically so that the histogram covers latencies from
+microseconds to seconds with constant relative resolution, and recording a latency is a bisection
+into the bucket bounds, allowing it to be called from time-critical code.
+
+Tim Nicholls, STFC Detector Systems Software Group
+"""
+import threading
+from bisect import bisect_left
+
+
+class HxtleakLatencyHistogram():
+    """Latency histogram class."""
+
+    def __init__(self, min_latency=1e-6, max_latency=1.0, buckets_per_decade=4):
+        """Initialise the latency histogram.
+
+        :param min_latency: upper bound of the lowest histogram bucket in seconds
+        :param max_latency: upper bound of the highest bounded histogram bucket in seconds
+        :param buckets_per_decade: number of buckets in each decade of latency
+        """
+        # Build the bucket upper bounds in microseconds. Latencies above the highest bound are
+        # counted in a final overflow bucket.
+        self.bounds = []
+        bound = min_latency
+        step = 10.0 ** (1.0 / buckets_per_decade)
+        while bound < max_latency * (1 + 1e-9):
+            self.bounds.append(round(bound * 1e6, 3))
+            bound *= step
+
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self, *_):
+        """Reset the histogram, clearing all recorded latencies."""
+        with self._lock:
+            self.counts = [0] * (len(self.bounds) + 1)
+            self.count = 0
+            self.last = None
+            self.min = None
+            self.max = None
+            self.total = 0.0
+
+    def record(self, latency):
+        """Record a latency in the histogram.
+
+        :param latency: latency in seconds
+        """
+        latency_us = latency * 1e6
+        with self._lock:
+            self.counts[bisect_left(self.bounds, latency_us)] += 1
+            self.count += 1
+            self.last = latency_us
+            self.total += latency_us
+            if self.min is None or latency_us < self.min:
+                self.min = latency_us
+            if self.max is None or latency_us > self.max:
+                self.max = latency_us
+
+    def mean(self):
+        """Return the mean recorded latency in microseconds, or None if none are recorded."""
+        return self.total / self.count if self.count else None
+
+    def tree(self):
+        """Return a dict-like tree of latency histogram parameters.
+
+        All latencies are reported in microseconds. The bucket counts have one more entry than
+        the bucket bounds, the last entry counting latencies exceeding the highest bound.
+
+        :return dict-like tree of histogram parameter accessors
+        """
+        return {
+            'count': (lambda: self.count, None),
+            'last_us': (lambda: self.last, None),
+            'min_us': (lambda: self.min, None),
+            'max_us': (lambda: self.max, None),
+            'mean_us': (self.mean, None),
+            'bounds_us': (lambda: self.bounds, None),
+            'counts': (lambda: list(self.counts), None),
+            'reset': (lambda: False, self.reset),
+        }
@@ -6,6 +6,7 @@ can be controlled, and the outlet control enabled/disabled as appropriate during
 Tim Nicholls, STFC Detector Systems Software Group
 """
 import logging
+import threading
 
 from .gpio import Gpio
 from .util import HxtleakError
@@ -19,6 +20,7 @@ class OutletRelay():
     """
 
     logger = logging.getLogger()  # Logger for OutletRelay instances - defaults to root logger
+    lock = threading.RLock()  # Lock serialising relay changes across all OutletRelay instances
 
     @classmethod
     def set_logger(cls, logger):
@@ -60,7 +62,8 @@ class OutletRelay():
 
         :param enable: enable state (True or False)
         """
-        self.enabled = enable
+        with self.lock:
+            self.enabled = enable
 
     def set_state(self, state):
         """
@@ -71,14 +74,38 @@ class OutletRelay():
 
         :param state: outlet state (True or False)
         """
-        if not self.enabled:
-            raise HxtleakError("Cannot change the state of a disabled outlet relay")
+        with self.lock:
+            if not self.enabled:
+                raise HxtleakError("Cannot change the state of a disabled outlet relay")
 
-        self.state = bool(state)
-        self.gpio.write(self.state)
+            self.state = bool(state)
+            self.gpio.write(self.state)
 
         self.logger.info("%s outlet state set to %s", self.name, "on" if state else "off")
 
+    @classmethod
+    def shutdown(cls, outlets):
+        """Turn off and disable a group of outlet relays.
+
+        This class method turns off and disables the specified outlet relays atomically with
+        respect to any other relay changes, writing the relay GPIO pins before anything else so
+        that the outlets are turned off as quickly as possible. Nothing is logged, allowing it to be
+        called from time-critical code; the caller is responsible for reporting the change.
+
+        :param outlets: iterable of OutletRelay instances to shut down
+        :return: list of the outlets turned off, to be reported by the caller
+        """
+        outlets = list(outlets)
+        with cls.lock:
+            for outlet in outlets:
+                outlet.gpio.write(False)
+
+            for outlet in outlets:
+                outlet.state = False
+                outlet.enabled = False
+
+        return outlets
+
     def tree(self):
         """
         Return a dict-like tree of outlet relay parameters.
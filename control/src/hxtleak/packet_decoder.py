@@ -1,13 +1,17 @@
 """Packet Decoder portion of the Hxtleak adapter.
 
-This handles the unpacking and validation of received packets,
-as well as the formatting of the decoded output.
+This handles the unpacking and validation of received packets into immutable
+packet snapshots, as well as the formatting of the decoded output.
 
 James Foster, STFC Detector Systems Software Group
 """
 import struct
+import time
+from collections import namedtuple
 from enum import IntFlag, auto
-from functools import partial
+from functools import reduce
+from itertools import count
+from operator import xor
 
 
 class HxtleakSensorStatus(IntFlag):
@@ -23,88 +27,22 @@ class HxtleakSensorStatus(IntFlag):
     STATUS_PROBE_2_TEMPERATURE_FAULT = auto()
 
 
-class HxtleakPacketDecoder(struct.Struct):
-    """Decoder class for received data packets."""
-
-    EOP_VAL = 0xa5
-    EOP_BYTES = bytearray([EOP_VAL]*2)
-
-    def __init__(self):
-        """Initialise the Packet Decoder.
-
-        The constructor uses a super init to create the structure
-        for a decoded packet, as well as setting the expected values to a default.
-        """
-        super().__init__('<ffffffff????BBH')
-
-        self.board_temp_threshold = None
-        self.board_humidity_threshold = None
-        self.probe_temp_1_threshold = None
-        self.probe_temp_2_threshold = None
-        self.board_temp = None
-        self.board_humidity = None
-        self.probe_temp_1 = None
-        self.probe_temp_2 = None
-        self.leak_detected = None
-        self.leak_continuity = None
-        self.fault = None
-        self.warning = None
-        self.sensor_status = None
-        self.checksum = None
-        self.eop = None
+class HxtleakPacket(namedtuple("HxtleakPacket", (
+    "board_temp_threshold", "board_humidity_threshold",
+    "probe_temp_1_threshold", "probe_temp_2_threshold",
+    "board_temp", "board_humidity", "probe_temp_1", "probe_temp_2",
+    "leak_detected", "leak_continuity", "fault", "warning", "sensor_status",
+    "checksum", "eop", "raw", "checksum_valid", "timestamp", "seq"
+))):
+    """Immutable snapshot of a decoded packet.
 
-        self.checksum_valid = None
+    Each decoded packet is returned as an immutable snapshot of the decoded values, the raw packet
+    bytes, checksum validity, monotonic receive timestamp and a sequence number. Snapshots can be
+    published to other threads by a single reference assignment, ensuring readers always see
+    consistent values from a single packet.
+    """
 
-        def _status_bit_set(bit_value):
-
-            return self.sensor_status and ((self.sensor_status & bit_value) != 0)
-
-        for bit in HxtleakSensorStatus:
-            setattr(self, bit.name.lower(), partial(_status_bit_set, bit.value))
-
-    def packet_complete(self, buffer):
-        """Verify the packet is complete.
-
-        Check if the packet is the appropriate size and has the correct
-        End of Packet identification bytes.
-
-        :param buffer: buffer for received raw data packet input
-        """
-        return len(buffer) > 2 and buffer[-2:] == self.EOP_BYTES
-
-    def unpack(self, buffer):
-        """Unpack the data from the buffer into the initialised values.
-
-        :param buffer: buffer for received raw data packet input
-        """
-        # (self.adc_val1, self.adc_val2, self.adc_val3, self.adc_val4,
-        (self.board_temp_threshold, self.board_humidity_threshold,
-         self.probe_temp_1_threshold, self.probe_temp_2_threshold,
-         self.board_temp, self.board_humidity, self.probe_temp_1, self.probe_temp_2,
-         self.leak_detected, self.leak_continuity, self.fault, self.warning, self.sensor_status,
-         self.checksum, self.eop) = super().unpack(buffer)
-
-        self.checksum_valid = None
-
-    def verify_checksum(self, buffer):
-        """Verify the checksum value of the packet using an XOR checksum.
-
-        :param buffer: buffer for received raw data packet input
-        """
-        calc_checksum = 0
-        csum_and_eop_size = 3
-        packet_size = (len(buffer) - csum_and_eop_size)
-        i = 0
-
-        for i in range(packet_size):
-            calc_checksum ^= buffer[i]
-
-        if calc_checksum == self.checksum:
-            self.checksum_valid = True
-        else:
-            self.checksum_valid = False
-
-        return self.checksum_valid
+    __slots__ = ()
 
     def as_dict(self):
         """Return the values as a dictionary."""
@@ -143,3 +81,142 @@ class HxtleakPacketDecoder(struct.Struct):
             self.leak_detected, self.leak_continuity, self.fault, self.warning, self.sensor_status,
             self.checksum, self.eop
         )
+
+
+def _status_bit_set(bit_value):
+    """Return a packet method testing if the specified sensor status bit is set."""
+    def status_bit_set(self):
+        return (self.sensor_status & bit_value) != 0
+    return status_bit_set
+
+
+# Add methods to the packet class to test each sensor status bit,
+# e.g. status_board_temperature_warning()
+for bit in HxtleakSensorStatus:
+    setattr(HxtleakPacket, bit.name.lower(), _status_bit_set(bit.value))
+
+
+class HxtleakPacketDecoder(struct.Struct):
+    """Decoder class for received data packets."""
+
+    EOP_VAL = 0xa5
+    EOP_BYTES = bytearray([EOP_VAL]*2)
+    CSUM_AND_EOP_SIZE = 3
+
+    def __init__(self):
+        """Initialise the Packet Decoder.
+
+        The constructor uses a super init to create the structure for a decoded packet and
+        initialises the packet sequence counter.
+        """
+        super().__init__('<ffffffff????BBH')
+
+        # Build a structure to unpack a complete packet as 64-bit words (and any remaining bytes)
+        # for checksum calculation
+        self._checksum_offset = self.size - self.CSUM_AND_EOP_SIZE
+        self._checksum_struct = struct.Struct('<{}Q{}B'.format(self.size // 8, self.size % 8))
+
+        self._seq = count()
+
+    def packet_complete(self, buffer):
+        """Verify the packet is complete.
+
+        Check if the packet is the appropriate size and has the correct
+        End of Packet identification bytes.
+
+        :param buffer: buffer for received raw data packet input
+        """
+        return len(buffer) > 2 and buffer[-2:] == self.EOP_BYTES
+
+    def decode(self, buffer, offset=0, timestamp=None):
+        """Decode a packet from the buffer into an immutable packet snapshot.
+
+        The packet values are unpacked directly from the buffer at the specified offset, without
+        copying, and the checksum verified. The returned snapshot is assigned the next packet
+        sequence number.
+
+        :param buffer: buffer for received raw data packet input
+        :param offset: offset of the packet in the buffer
+        :param timestamp: monotonic receive timestamp of the packet, defaults to the current time
+        :return: HxtleakPacket snapshot of the decoded packet
+        """
+        if timestamp is None:
+            timestamp = time.monotonic()
+
+        with memoryview(buffer) as view:
+            raw = bytes(view[offset:offset + self.size])
+
+        return HxtleakPacket(
+            *self.unpack_from(buffer, offset), raw, self.verify_checksum(buffer, offset),
+            timestamp, next(self._seq)
+        )
+
+    def calc_checksum(self, buffer, offset=0):
+        """Calculate the XOR checksum of the packet at the specified offset in the buffer.
+
+        The checksum is calculated without copying the buffer, by unpacking the whole packet as
+        64-bit words, XORing these together and folding the result down to a single byte. The
+        contribution of the bytes following the checksummed data is then removed.
+
+        :param buffer: buffer for received raw data packet input
+        :param offset: offset of the packet in the buffer
+        :return: calculated checksum value
+        """
+        trailer = offset + self._checksum_offset
+        return self._fold_checksum(
+            reduce(xor, self._checksum_struct.unpack_from(buffer, offset))
+        ) ^ buffer[trailer] ^ buffer[trailer + 1] ^ buffer[trailer + 2]
+
+    def verify_checksum(self, buffer, offset=0):
+        """Verify the checksum value of the packet using an XOR checksum.
+
+        Since the XOR of the checksummed data and a correct checksum is zero, the packet is
+        verified by XORing all bytes of the packet, excluding the end of packet marker.
+
+        :param buffer: buffer for received raw data packet input
+        :param offset: offset of the packet in the buffer
+        :return: True if the calculated checksum matches that transmitted in the packet
+        """
+        eop = offset + self.size - 2
+        return (self._fold_checksum(
+            reduce(xor, self._checksum_struct.unpack_from(buffer, offset))
+        ) ^ buffer[eop] ^ buffer[eop + 1]) == 0
+
+    def verify_checksums(self, buffer, offsets=None):
+        """Verify the checksum values of multiple packets in a buffer.
+
+        This method verifies the checksums of a batch of packets in a buffer. If offsets are
+        specified, packets are verified at those offsets, otherwise the buffer is treated as a
+        contiguous sequence of packets, which are unpacked in a single pass over the buffer.
+
+        :param buffer: buffer containing received raw data packets
+        :param offsets: optional iterable of packet offsets in the buffer
+        :return: list of checksum verification results for each packet
+        """
+        fold = self._fold_checksum
+        unpack = self._checksum_struct
+
+        if offsets is None:
+            size = self.size
+            with memoryview(buffer) as view:
+                eop_lo = view[size - 2::size].tolist()
+                eop_hi = view[size - 1::size].tolist()
+            return [
+                (fold(reduce(xor, words)) ^ lo ^ hi) == 0
+                for (words, lo, hi) in zip(unpack.iter_unpack(buffer), eop_lo, eop_hi)
+            ]
+
+        eop = self.size - 2
+        return [
+            (fold(reduce(xor, unpack.unpack_from(buffer, offset)))
+             ^ buffer[offset + eop] ^ buffer[offset + eop + 1]) == 0
+            for offset in offsets
+        ]
+
+    @staticmethod
+    def _fold_checksum(value):
+        """Fold a 64-bit XOR accumulator value down to a single byte checksum."""
+        value ^= value >> 32
+        value ^= value >> 16
+        value ^= value >> 8
+        return value & 0xff
@@ -0,0 +1,107 @@
+"""State update push publisher for the Hxtleak adapter.
+
+This module implements a publisher which pushes updates of the system state and event log to
+subscribed clients, e.g. WebSocket connections, as they change rather than when polled. Changes
+are notified by topic from any thread and handed to the IOLoop, where notifications of the same
+topic are coalesced until the update message for the topic is built, serialised once and sent to
+every subscriber. The cost of pushing updates therefore depends on how often the state
+changes, not on the number of clients, and nothing is built while no clients are subscribed.
+
+Tim Nicholls, STFC Detector Systems Software Group
+"""
+import logging
+
+
+class HxtleakPushPublisher():
+    """State update push publisher class."""
+
+    def __init__(self, ioloop):
+        """Initialise the publisher.
+
+        :param ioloop: IOLoop on which update messages are built and sent
+        """
+        self.ioloop = ioloop
+        self.subscribers = set()
+        self.topics = {}
+        self._pending = set()
+        self.messages_sent = 0
+
+        # Sequence number of the last event log entry pushed, maintained by the topic builders
+        self.cursor = 0
+
+    def add_topic(self, topic, build):
+        """Add a topic of updates.
+
+        :param topic: name of the topic
+        :param build: callable returning the serialised update message for the topic, or None if
+                      there is no update to send
+        """
+        self.topics[topic] = build
+
+    def subscribe(self, subscriber):
+        """Subscribe a client to updates.
+
+        :param subscriber: client object with a write_message method accepting a string
+        """
+        self.subscribers.add(subscriber)
+
+    def unsubscribe(self, subscriber):
+        """Unsubscribe a client from updates.
+
+        :param subscriber: client object previously subscribed
+        """
+        self.subscribers.discard(subscriber)
+
+    def notify(self, topic):
+        """Notify a change of a topic, scheduling its update to be pushed to subscribers.
+
+        This method may be called from any thread. The notification is handed to the IOLoop, on
+        which the update is built and sent once however many times the topic is notified before
+        then.
+
+        :param topic: name of the topic changed
+        """
+        self.ioloop.add_callback(self._schedule, topic)
+
+    def _schedule(self, topic):
+        """Schedule the update of a notified topic on the IOLoop, unless already scheduled."""
+        if not self.subscribers or topic in self._pending:
+            return
+        self._pending.add(topic)
+        self.ioloop.add_callback(self._publish, topic)
+
+    def _publish(self, topic):
+        """Build the update message of a topic and send it to all subscribers."""
+        self._pending.discard(topic)
+        if not self.subscribers:
+            return
+
+        message = self.topics[topic]()
+        if message is None:
+            return
+
+        for subscriber in list(self.subscribers):
+            self.send(subscriber, message)
+
+    def send(self, subscriber, message):
+        """Send a message to a subscriber, unsubscribing it if it fails.
+
+        :param subscriber: subscribed client object
+        :param message: serialised update message
+        """
+        try:
+            subscriber.write_message(message)
+            self.messages_sent += 1
+        except Exception as e:
+            logging.debug("Failed to push update to subscriber, unsubscribing: %s", e)
+            self.unsubscribe(subscriber)
+
+    def tree(self):
+        """Return a dict-like tree of publisher parameters.
+
+        :return dict-like tree of publisher parameter accessors
+        """
+        return {
+            'subscribers': (lambda: len(self.subscribers), None),
+            'messages_sent': (lambda: self.messages_sent, None),
+        }
@@ -0,0 +1,117 @@
+"""Capture replay for the Hxtleak adapter.
+
+This module implements a replay source which can stand in for the serial port in the Hxtleak
+controller, streaming raw serial data recorded by the capture recorder through the packet
+reception path. Captures can be replayed at real time, scaled by a speed factor, or as fast as
+possible, allowing incidents to be reproduced and the packet ingest pipeline to be benchmarked
+without hardware. Replay runs as a coroutine on the IOLoop.
+
+Tim Nicholls, STFC Detector Systems Software Group
+"""
+import logging
+import os
+import time
+
+from tornado import gen
+
+from .capture import read_capture
+from .util import HxtleakError
+
+
+class HxtleakCaptureReplay():
+    """Capture replay source class."""
+
+    # Number of chunks replayed between yields to the IOLoop when replaying as fast as possible
+    YIELD_CHUNKS = 64
+
+    def __init__(self, path, speed=1.0, logger=None):
+        """Initialise the capture replay.
+
+        :param path: capture file, or directory of capture files, to replay
+        :param speed: replay speed relative to real time, or zero to replay as fast as possible
+        :param logger: logger instance to use, defaults to the root logger
+        """
+        if not os.path.exists(path):
+            raise HxtleakError("Replay capture path {} does not exist".format(path))
+
+        self.path = path
+        self.speed = float(speed)
+        self.logger = logger if logger else logging.getLogger()
+
+        self.running = False
+        self.chunks_replayed = 0
+        self.bytes_replayed = 0
+        self.start_time = None
+        self.elapsed = 0.0
+
+    async def run(self, callback):
+        """Run the capture replay.
+
+        This coroutine reads chunks from the capture and passes the data to the callback,
+        pacing chunks according to their recorded receive times and the replay speed.
+
+        :param callback: callable to pass each replayed data chunk to
+        """
+        self.running = True
+        self.start_time = time.monotonic()
+        first_timestamp = None
+
+        self.logger.info(
+            "Replaying capture %s at %s", self.path,
+            "{}x speed".format(self.speed) if self.speed > 0 else "maximum speed"
+        )
+
+        try:
+            for (timestamp, data) in read_capture(self.path):
+
+                if not self.running:
+                    break
+
+                # Pace the replay to the recorded receive times scaled by the speed, or yield
+                # periodically to the IOLoop when replaying as fast as possible
+                if self.speed > 0:
+                    if first_timestamp is None:
+                        first_timestamp = timestamp
+                    delay = (
+                        (timestamp - first_timestamp) / 1e9 / self.speed
+                        - (time.monotonic() - self.start_time)
+                    )
+                    if delay > 0:
+                        await gen.sleep(delay)
+                elif self.chunks_replayed % self.YIELD_CHUNKS == 0:
+                    await gen.sleep(0)
+
+                callback(data)
+                self.chunks_replayed += 1
+                self.bytes_replayed += len(data)
+                self.elapsed = time.monotonic() - self.start_time
+
+        except (OSError, HxtleakError) as e:
+            self.logger.error("Capture replay failed: %s", e)
+
+        else:
+            if self.running:
+                self.logger.info(
+                    "Capture replay completed: %d bytes in %d chunks replayed in %.3f secs",
+                    self.bytes_replayed, self.chunks_replayed, self.elapsed
+                )
+
+        self.running = False
+
+    def stop(self):
+        """Stop the capture replay."""
+        self.running = False
+
+    def tree(self):
+        """Return a dict-like tree of capture replay parameters.
+
+        :return dict-like tree of replay parameter accessors
+        """
+        return {
+            'path': (lambda: self.path, None),
+            'speed': (lambda: self.speed, None),
+            'running': (lambda: self.running, None),
+            'chunks_replayed': (lambda: self.chunks_replayed, None),
+            'bytes_replayed': (lambda: self.bytes_replayed, None),
+            'elapsed': (lambda: self.elapsed, None),
+        }
@@ -0,0 +1,536 @@
+"""Rollup aggregates of the sensor history for the Hxtleak adapter.
+
+This module implements tiers of rolling aggregates of the sensor channels, maintained at fixed
+bucket intervals (by default 1 second, 1 minute and 1 hour). Each bucket holds the count of samples
+and the minimum, maximum, sum and sum of squares of each sensor channel, along with the bitwise OR
+of the flag and status bits. Buckets are held in fixed-capacity ring buffers of typed arrays and
+updated in place as each good packet is received, so that maintaining the rollups is O(1) per
+packet and bounded in memory, while the coarse tiers retain weeks to months of history.
+
+Since the coarse tiers retain far more history than can be rebuilt quickly at startup, the tiers
+can be saved to a file, written atomically from a snapshot of each tier taken under its lock, and
+loaded again when restarted. Samples received since the tiers were saved are then merged in, the
+samples already aggregated by each tier being skipped.
+
+Queries over long time ranges are answered from the coarsest tier whose interval does not exceed
+the requested point spacing and which still retains buckets from the start of the range, merging
+its buckets rather than scanning raw samples. Queries may be run off the IOLoop, the buckets queried
+being copied under a lock shared with updating each tier.
+
+Tim Nicholls, STFC Detector Systems Software Group
+"""
+import math
+import os
+import struct
+import threading
+from array import array
+from bisect import bisect_right
+from itertools import groupby
+from operator import mul
+
+from .history import bitwise_or, bucket_bounds, ring_range
+from .util import HxtleakError
+
+
+class HxtleakRollupFormat():
+    """Rollup file format definitions."""
+
+    MAGIC = b'HXRL'
+
+    # File header: magic and number of tiers
+    HEADER = struct.Struct('<4sB')
+
+    # Tier header: name, interval, capacity, bucket count, index of the current bucket, current
+    # bucket number and timestamp of the last sample aggregated (NaN if none), and the number of
+    # channels and bit-valued channels aggregated. The tier arrays follow each tier header.
+    TIER_HEADER = struct.Struct('<16sdIIIddBB')
+
+    # Array typecodes of the bucket start times and counts, and of the min, max, sum and sum of
+    # squares of each channel, and the bitwise OR of each bit-valued channel
+    TYPECODES = ('d', 'I', 'f', 'f', 'd', 'd', 'B')
+
+    @classmethod
+    def tier_size(cls, capacity, num_fields, num_bit_fields):
+        """Return the size in bytes of the arrays of a tier.
+
+        :param capacity: number of buckets in the tier
+        :param num_fields: number of channels aggregated
+        :param num_bit_fields: number of bit-valued channels aggregated
+        :return: size of the tier arrays in bytes
+        """
+        (start, count, *aggregates, bits) = (
+            array(typecode).itemsize for typecode in cls.TYPECODES
+        )
+        return capacity * (start + count + num_fields * sum(aggregates) + num_bit_fields * bits)
+
+
+def _zeros(typecode, length):
+    """Return a zero-filled array of the specified type and length."""
+    return array(typecode, bytes(array(typecode).itemsize * length))
+
+
+class HxtleakRollupTier():
+    """Rollup tier class, holding aggregate buckets of a fixed interval."""
+
+    def __init__(self, name, interval, capacity, fields, bit_fields):
+        """Initialise the rollup tier.
+
+        :param name: name of the tier
+        :param interval: bucket interval in seconds
+        :param capacity: maximum number of buckets held, the oldest being overwritten when full
+        :param fields: names of the channels aggregated
+        :param bit_fields: names of the bit-valued channels aggregated by bitwise OR
+        """
+        self.name = name
+        self.interval = interval
+        self.capacity = capacity
+        self.fields = tuple(fields)
+        self.bit_fields = tuple(bit_fields)
+
+        # Preallocate the bucket start time and sample count arrays, and arrays for each aggregate
+        # of each channel, indexed in field order
+        self.starts = _zeros('d', capacity)
+        self.counts = _zeros('I', capacity)
+        self.mins = [_zeros('f', capacity) for _ in self.fields]
+        self.maxs = [_zeros('f', capacity) for _ in self.fields]
+        self.sums = [_zeros('d', capacity) for _ in self.fields]
+        self.sumsqs = [_zeros('d', capacity) for _ in self.fields]
+        self.bits = [_zeros('B', capacity) for _ in self.bit_fields]
+
+        self.count = 0
+        self.last = None
+        self._idx = capacity - 1
+        self._bucket = None
+        self._lock = threading.Lock()
+
+    def update(self, timestamp, values, bits):
+        """Update the tier with a sample.
+
+        The sample is added to the current bucket, or starts a new bucket if its timestamp is
+        beyond the end of the current bucket. Samples timestamped before the current bucket, e.g.
+        following a wall-clock step, are added to the current bucket.
+
+        :param timestamp: sample time in seconds since the epoch
+        :param values: sequence of channel values in field order
+        :param bits: sequence of bit-valued channel values in bit field order
+        """
+        squares = [value * value for value in values]
+        with self._lock:
+            self._merge(timestamp // self.interval, 1, values, values, values, squares, bits)
+            self.last = timestamp
+
+    def extend(self, timestamps, columns, bit_columns):
+        """Update the tier with a series of samples, e.g. restored from the history store.
+
+        Runs of consecutive samples in the same bucket are aggregated with the builtin aggregate
+        functions on slices of the channel arrays, and merged into the tier as for single samples.
+        Samples at or before the last sample aggregated, e.g. when the tier was loaded from a file,
+        are skipped.
+
+        :param timestamps: array of sample times in seconds since the epoch, in ascending order
+        :param columns: sequence of arrays of channel values in field order
+        :param bit_columns: sequence of arrays of bit-valued channel values in bit field order
+        """
+        interval = self.interval
+
+        with self._lock:
+            lo = 0 if self.last is None else bisect_right(timestamps, self.last)
+            if lo == len(timestamps):
+                return
+            buckets = [timestamp // interval for timestamp in timestamps[lo:]]
+            for (bucket, run) in groupby(buckets):
+                hi = lo + len(list(run))
+                slices = [column[lo:hi] for column in columns]
+                self._merge(
+                    bucket, hi - lo,
+                    [min(values) for values in slices],
+                    [max(values) for values in slices],
+                    [sum(values) for values in slices],
+                    [sum(map(mul, values, values)) for values in slices],
+                    [bitwise_or(column[lo:hi]) for column in bit_columns]
+                )
+                lo = hi
+            self.last = timestamps[-1]
+
+    def _merge(self, bucket, count, mins, maxs, sums, sumsqs, bits):
+        """Merge the aggregates of samples in a bucket into the tier, with the lock held.
+
+        The aggregates start a new bucket if beyond the current bucket, otherwise they are merged
+        into the current bucket.
+
+        :param bucket: index of the bucket, i.e. the sample time divided by the interval
+        :param count: number of samples aggregated
+        :param mins: sequence of channel minima in field order
+        :param maxs: sequence of channel maxima in field order
+        :param sums: sequence of channel sums in field order
+        :param sumsqs: sequence of channel sums of squares in field order
+        :param bits: sequence of bitwise ORs of the bit-valued channels in bit field order
+        """
+        if self._bucket is None or bucket > self._bucket:
+            idx = self._idx = (self._idx + 1) % self.capacity
+            self._bucket = bucket
+            if self.count < self.capacity:
+                self.count += 1
+
+            self.starts[idx] = bucket * self.interval
+            self.counts[idx] = count
+            for field_idx in range(len(self.fields)):
+                self.mins[field_idx][idx] = mins[field_idx]
+                self.maxs[field_idx][idx] = maxs[field_idx]
+                self.sums[field_idx][idx] = sums[field_idx]
+                self.sumsqs[field_idx][idx] = sumsqs[field_idx]
+            for (field_idx, value) in enumerate(bits):
+                self.bits[field_idx][idx] = value
+        else:
+            idx = self._idx
+            self.counts[idx] += count
+            for field_idx in range(len(self.fields)):
+                if mins[field_idx] < self.mins[field_idx][idx]:
+                    self.mins[field_idx][idx] = mins[field_idx]
+                if maxs[field_idx] > self.maxs[field_idx][idx]:
+                    self.maxs[field_idx][idx] = maxs[field_idx]
+                self.sums[field_idx][idx] += sums[field_idx]
+                self.sumsqs[field_idx][idx] += sumsqs[field_idx]
+            for (field_idx, value) in enumerate(bits):
+                self.bits[field_idx][idx] |= value
+
+    def _range(self, column, start=0, stop=None):
+        """Return a chronological range of a bucket array."""
+        return ring_range(column, self._idx + 1, self.count, start, stop)
+
+    def first_timestamp(self):
+        """Return the start time of the oldest bucket, or None if the tier is empty."""
+        with self._lock:
+            return self._range(self.starts, 0, 1)[0] if self.count else None
+
+    def retains(self, start):
+        """Determine if the tier retains buckets from a start time.
+
+        :param start: start time in seconds since the epoch
+        :return: True if the oldest bucket held starts at or before the start time
+        """
+        first_timestamp = self.first_timestamp()
+        return first_timestamp is not None and first_timestamp <= start
+
+    def query(self, start, end, fields, points):
+        """Query the tier over a time range, merging buckets to the requested number of points.
+
+        Buckets are merged into equal-time query buckets, the minimum, maximum, mean and standard
+        deviation of each channel in each query bucket being calculated from the bucket aggregates.
+
+        :param start: start of time range in seconds since the epoch
+        :param end: end of time range in seconds since the epoch
+        :param fields: iterable of channel names to return
+        :param points: target number of points
+        :return: dict of query results
+        """
+        # Locate the buckets overlapping the time range by binary search of the start times, and
+        # copy the aggregates of the requested channels in those buckets under the lock
+        with self._lock:
+            starts = self._range(self.starts)
+            first = bisect_right(starts, start)
+            if first and starts[first - 1] + self.interval > start:
+                first -= 1
+            last = max(bisect_right(starts, end), first)
+            starts = starts[first:last]
+            counts = self._range(self.counts, first, last)
+
+            aggregates = {}
+            for name in fields:
+                if name in self.bit_fields:
+                    column = self.bits[self.bit_fields.index(name)]
+                    aggregates[name] = self._range(column, first, last)
+                else:
+                    field_idx = self.fields.index(name)
+                    aggregates[name] = tuple(
+                        self._range(columns[field_idx], first, last)
+                        for columns in (self.mins, self.maxs, self.sums, self.sumsqs)
+                    )
+
+        result = {
+            'start': start,
+            'end': end,
+            'count': sum(counts),
+            'method': 'minmax',
+            'tier': self.name,
+            'timestamp': [],
+            'fields': {},
+        }
+        if not starts:
+            return result
+
+        bounds = bucket_bounds(starts, points)
+        result['timestamp'] = [t_bucket for (t_bucket, _, _) in bounds]
+        bucket_counts = [sum(counts[lo:hi]) for (_, lo, hi) in bounds]
+
+        for name in fields:
+            if name in self.bit_fields:
+                column = aggregates[name]
+                result['fields'][name] = [bitwise_or(column[lo:hi]) for (_, lo, hi) in bounds]
+                continue
+
+            (mins, maxs, sums, sumsqs) = aggregates[name]
+
+            means = []
+            stds = []
+            for ((_, lo, hi), count) in zip(bounds, bucket_counts):
+                mean = sum(sums[lo:hi]) / count
+                means.append(mean)
+                stds.append(math.sqrt(max(sum(sumsqs[lo:hi]) / count - mean * mean, 0.0)))
+
+            result['fields'][name] = {
+                'min': [min(mins[lo:hi]) for (_, lo, hi) in bounds],
+                'max': [max(maxs[lo:hi]) for (_, lo, hi) in bounds],
+                'mean': means,
+                'std': stds,
+            }
+
+        return result
+
+    def _arrays(self):
+        """Return the tier arrays, in the order in which they are saved."""
+        return (
+            [self.starts, self.counts] + self.mins + self.maxs + self.sums + self.sumsqs + self.bits
+        )
+
+    def dump(self):
+        """Return a snapshot of the tier, as saved to a rollup file.
+
+        :return: bytes object containing the tier header and arrays
+        """
+        with self._lock:
+            header = HxtleakRollupFormat.TIER_HEADER.pack(
+                self.name.encode(), self.interval, self.capacity, self.count, self._idx,
+                math.nan if self._bucket is None else self._bucket,
+                math.nan if self.last is None else self.last,
+                len(self.fields), len(self.bit_fields)
+            )
+            return header + b''.join(column.tobytes() for column in self._arrays())
+
+    def restore(self, header, data):
+        """Restore the tier from a snapshot loaded from a rollup file.
+
+        The snapshot is only restored if it was saved from a tier of the same interval and
+        capacity aggregating the same number of channels.
+
+        :param header: tuple of tier header values
+        :param data: bytes object containing the tier arrays
+        :return: True if the tier was restored
+        """
+        (_, interval, capacity, count, idx, bucket, last, num_fields, num_bit_fields) = header
+        if (interval, capacity, num_fields, num_bit_fields) != (
+            self.interval, self.capacity, len(self.fields), len(self.bit_fields)
+        ):
+            return False
+
+        with self._lock:
+            offset = 0
+            for column in self._arrays():
+                size = column.itemsize * capacity
+                column[:] = array(column.typecode, data[offset:offset + size])
+                offset += size
+            self.count = count
+            self._idx = idx
+            self._bucket = None if math.isnan(bucket) else bucket
+            self.last = None if math.isnan(last) else last
+        return True
+
+    def memory_size(self):
+        """Return the memory used by the tier arrays in bytes."""
+        return sum(column.itemsize * len(column) for column in self._arrays())
+
+    def tree(self):
+        """Return a dict-like tree of rollup tier parameters.
+
+        :return dict-like tree of tier parameter accessors
+        """
+        return {
+            'interval': (lambda: self.interval, None),
+            'capacity': (lambda: self.capacity, None),
+            'count': (lambda: self.count, None),
+            'first_timestamp': (self.first_timestamp, None),
+            'memory_size': (self.memory_size, None),
+        }
+
+
+class HxtleakRollups():
+    """Rollup tiers class, maintaining aggregates of the sensor channels at several intervals."""
+
+    # Sensor and threshold channels aggregated by min, max, sum and sum of squares
+    FIELDS = (
+        'board_temp', 'board_humidity', 'probe_temp_1', 'probe_temp_2',
+        'board_temp_threshold', 'board_humidity_threshold',
+        'probe_temp_1_threshold', 'probe_temp_2_threshold',
+    )
+
+    # Bit-valued channels aggregated by bitwise OR
+    BIT_FIELDS = ('flags', 'sensor_status')
+
+    # Default tiers as (name, interval in seconds, capacity in buckets), retaining 6 hours of
+    # 1 second buckets, 14 days of 1 minute buckets and a year of 1 hour buckets
+    TIERS = (
+        ('1s', 1, 6 * 3600),
+        ('1m', 60, 14 * 24 * 60),
+        ('1h', 3600, 365 * 24),
+    )
+
+    # Name of the file to which the tiers are saved
+    FILE_NAME = 'rollups.dat'
+
+    def __init__(self, tiers=TIERS):
+        """Initialise the rollup tiers.
+
+        :param tiers: iterable of (name, interval in seconds, capacity in buckets) of each tier
+        """
+        self.tiers = [
+            HxtleakRollupTier(name, interval, capacity, self.FIELDS, self.BIT_FIELDS)
+            for (name, interval, capacity) in sorted(tiers, key=lambda tier: tier[1])
+        ]
+        self._save_lock = threading.Lock()
+
+    def append(self, timestamp, packet):
+        """Update all rollup tiers with a sample.
+
+        :param timestamp: wall-clock receive time of the packet in seconds since the epoch
+        :param packet: decoded packet snapshot
+        """
+        values = (
+            packet.board_temp, packet.board_humidity, packet.probe_temp_1, packet.probe_temp_2,
+            packet.board_temp_threshold, packet.board_humidity_threshold,
+            packet.probe_temp_1_threshold, packet.probe_temp_2_threshold,
+        )
+        bits = (
+            packet.leak_detected | packet.leak_continuity << 1
+            | packet.fault << 2 | packet.warning << 3,
+            packet.sensor_status,
+        )
+        for tier in self.tiers:
+            tier.update(timestamp, values, bits)
+
+    def last_timestamp(self):
+        """Return the timestamp of the oldest last sample aggregated by any tier.
+
+        :return: timestamp in seconds since the epoch, or None if any tier holds no samples
+        """
+        lasts = [tier.last for tier in self.tiers]
+        return None if None in lasts else min(lasts)
+
+    def save(self, file_name):
+        """Save the rollup tiers to a file.
+
+        A snapshot of each tier is written to a temporary file which then replaces the file, so
+        that a valid file always exists. This method may be called from any thread.
+
+        :param file_name: path of the rollup file
+        """
+        data = HxtleakRollupFormat.HEADER.pack(HxtleakRollupFormat.MAGIC, len(self.tiers))
+        data += b''.join(tier.dump() for tier in self.tiers)
+
+        with self._save_lock:
+            temp_name = file_name + '.tmp'
+            try:
+                with open(temp_name, 'wb') as rollup_file:
+                    rollup_file.write(data)
+                os.replace(temp_name, file_name)
+            except OSError as e:
+                raise HxtleakError("Failed to save rollups to {}: {}".format(file_name, e))
+
+    def load(self, file_name):
+        """Load the rollup tiers from a file.
+
+        Tiers in the file matching a tier by name, interval, capacity and the channels aggregated
+        are restored. Other tiers are left unchanged.
+
+        :param file_name: path of the rollup file
+        :return: number of tiers restored, zero if the file does not exist
+        """
+        try:
+            with open(file_name, 'rb') as rollup_file:
+                data = rollup_file.read()
+        except FileNotFoundError:
+            return 0
+        except OSError as e:
+            raise HxtleakError("Failed to load rollups from {}: {}".format(file_name, e))
+
+        header_size = HxtleakRollupFormat.HEADER.size
+        if len(data) < header_size or data[:4] != HxtleakRollupFormat.MAGIC:
+            raise HxtleakError("File {} is not a valid rollup file".format(file_name))
+
+        # Parse and validate every tier in the file before restoring any of them
+        snapshots = []
+        offset = header_size
+        for _ in range(HxtleakRollupFormat.HEADER.unpack_from(data)[1]):
+            if offset + HxtleakRollupFormat.TIER_HEADER.size > len(data):
+                raise HxtleakError("Rollup file {} is truncated".format(file_name))
+            header = HxtleakRollupFormat.TIER_HEADER.unpack_from(data, offset)
+            offset += HxtleakRollupFormat.TIER_HEADER.size
+            size = HxtleakRollupFormat.tier_size(header[2], header[7], header[8])
+            if offset + size > len(data):
+                raise HxtleakError("Rollup file {} is truncated".format(file_name))
+            snapshots.append((header, data[offset:offset + size]))
+            offset += size
+
+        tiers = {tier.name: tier for tier in self.tiers}
+        restored = 0
+        for (header, tier_data) in snapshots:
+            tier = tiers.get(header[0].rstrip(b'\0').decode(errors='replace'))
+            if tier and tier.restore(header, tier_data):
+                restored += 1
+        return restored
+
+    def extend(self, columns):
+        """Update all rollup tiers with a series of samples, e.g. restored from the history store.
+
+        :param columns: dict of arrays of channel values in chronological order keyed by channel
+                        name, including the timestamps and all aggregated channels
+        """
+        values = [columns[name] for name in self.FIELDS]
+        bits = [columns[name] for name in self.BIT_FIELDS]
+        for tier in self.tiers:
+            tier.extend(columns['timestamp'], values, bits)
+
+    def query(self, start, end, fields=None, points=1000, older_than=None):
+        """Query the rollups over a time range, if a suitable tier exists.
+
+        Only tiers retaining buckets from the start of the time range are considered, so that
+        results are never truncated. Of these, the coarsest tier whose bucket interval does not
+        exceed the spacing of the requested points is selected, so that the query loses no
+        resolution while merging the fewest buckets. If there is no such tier and older_than is
+        specified, e.g. as the first sample held by another history tier, the finest tier with a
+        longer interval holding samples older than that is selected instead, returning fewer
+        points.
+
+        :param start: start of time range in seconds since the epoch
+        :param end: end of time range in seconds since the epoch
+        :param fields: iterable of channel names to return, or None for all aggregated channels
+        :param points: target number of points
+        :param older_than: time before which a coarser tier must hold samples to be selected, or
+                           None to select only tiers matching the point spacing
+        :return: dict of query results, or None if no tier is suitable for the query
+        """
+        fields = self.FIELDS + self.BIT_FIELDS if fields is None else tuple(fields)
+        if any(name not in self.FIELDS + self.BIT_FIELDS for name in fields):
+            return None
+        if points < 1:
+            raise HxtleakError("Rollup query must request at least 1 point")
+
+        spacing = (end - start) / points
+        retained = [tier for tier in self.tiers if tier.retains(start)]
+
+        suitable = [tier for tier in retained if tier.interval <= spacing]
+        if suitable:
+            return suitable[-1].query(start, end, fields, points)
+
+        if older_than is not None:
+            for tier in retained:
+                if tier.interval > spacing and tier.first_timestamp() + tier.interval <= older_than:
+                    return tier.query(start, end, fields, points)
+
+        return None
+
+    def tree(self):
+        """Return a dict-like tree of rollup parameters.
+
+        :return dict-like tree of rollup tier parameter trees keyed by tier name
+        """
+        return {tier.name: tier.tree() for tier in self.tiers}
@@ -0,0 +1,670 @@
+"""Persistent history store for the Hxtleak adapter.
+
+This module implements a durable store of the packets received by the adapter, allowing the sensor
+history to survive restarts. Each good packet is stored as a fixed-size binary record, comprising
+its wall-clock receive timestamp followed by the raw packet bytes, in preallocated segment files
+accessed through memory maps. Records are queued by the receive path and written in batches by a
+background writer thread, so that writes to flash storage are coalesced and never block packet
+reception.
+
+Each segment file starts with a header containing a magic identifier, the record size, the record
+capacity and the number of records written, which is updated after each batch of records. Segments
+are rotated when full and deleted once all their records are older than the retention period. The
+first and last timestamps of each segment form an index, which with a binary search of the record
+timestamps within a segment allows time ranges to be located without scanning. Queries and exports
+unpack each requested channel as a column directly from the memory maps, gathering its bytes from
+every record with strided slices, so that no per-record Python objects are created.
+
+Tim Nicholls, STFC Detector Systems Software Group
+"""
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections import deque
+from contextlib import contextmanager
+
+from .history import HxtleakHistory, HxtleakHistoryFlags
+from .packet_decoder import HxtleakPacket
+from .util import HxtleakError
+
+
+class HxtleakStoreFormat():
+    """History store segment file format definitions."""
+
+    MAGIC = b'HXTSTO01'
+    HEADER = struct.Struct('<8sIIQ')
+    COUNT_OFFSET = 16
+    COUNT = struct.Struct('<Q')
+    TIMESTAMP = struct.Struct('<d')
+    FILE_PREFIX = 'hxtleak_history_'
+    FILE_SUFFIX = '.seg'
+
+
+class HxtleakStoreSegment():
+    """History store segment class, holding the index entry of a segment file."""
+
+    def __init__(self, file_name, record_size, capacity, count=0, first=None, last=None):
+        """Initialise the segment index entry.
+
+        :param file_name: path of the segment file
+        :param record_size: size of each record in bytes
+        :param capacity: maximum number of records in the segment
+        :param count: number of records written to the segment
+        :param first: timestamp of the first record in the segment
+        :param last: timestamp of the last record in the segment
+        """
+        self.file_name = file_name
+        self.record_size = record_size
+        self.capacity = capacity
+        self.count = count
+        self.first = first
+        self.last = last
+
+    @classmethod
+    def load(cls, file_name):
+        """Load the index entry of an existing segment file.
+
+        :param file_name: path of the segment file
+        :return: HxtleakStoreSegment instance
+        """
+        header_size = HxtleakStoreFormat.HEADER.size
+        with open(file_name, 'rb') as segment_file:
+            header = segment_file.read(header_size)
+            if len(header) < header_size:
+                raise HxtleakError("File {} is not a valid history segment".format(file_name))
+
+            (magic, record_size, capacity, count) = HxtleakStoreFormat.HEADER.unpack(header)
+            if magic != HxtleakStoreFormat.MAGIC:
+                raise HxtleakError("File {} is not a valid history segment".format(file_name))
+
+            segment = cls(file_name, record_size, capacity, count)
+            if count:
+                segment.first = segment._read_timestamp(segment_file, 0)
+                segment.last = segment._read_timestamp(segment_file, count - 1)
+
+        return segment
+
+    def _read_timestamp(self, segment_file, idx):
+        """Read the timestamp of a record from an open segment file."""
+        segment_file.seek(self.offset(idx))
+        return HxtleakStoreFormat.TIMESTAMP.unpack(
+            segment_file.read(HxtleakStoreFormat.TIMESTAMP.size)
+        )[0]
+
+    def offset(self, idx):
+        """Return the offset of a record in the segment file.
+
+        :param idx: index of the record
+        :return: offset of the record in bytes
+        """
+        return HxtleakStoreFormat.HEADER.size + idx * self.record_size
+
+    def file_size(self):
+        """Return the size of the segment file in bytes."""
+        return self.offset(self.capacity)
+
+    def search(self, buffer, timestamp, count=None, after=False):
+        """Search for the first record at, or after, a timestamp.
+
+        :param buffer: buffer mapping the segment file
+        :param timestamp: timestamp to search for
+        :param count: number of records to search, defaults to the number in the index
+        :param after: if True, search for the first record after the timestamp
+        :return: index of the first record at, or after, the timestamp
+        """
+        unpack_timestamp = HxtleakStoreFormat.TIMESTAMP.unpack_from
+        (low, high) = (0, self.count if count is None else count)
+        while low < high:
+            mid = (low + high) // 2
+            record_timestamp = unpack_timestamp(buffer, self.offset(mid))[0]
+            if record_timestamp < timestamp or (after and record_timestamp == timestamp):
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+
+class HxtleakHistoryStore():
+    """Persistent history store class."""
+
+    # Packet fields packed into the bits of the history flags channel, with their bit values
+    FLAG_FIELDS = (
+        ('leak_detected', HxtleakHistoryFlags.LEAK_DETECTED),
+        ('leak_continuity', HxtleakHistoryFlags.LEAK_CONTINUITY),
+        ('fault', HxtleakHistoryFlags.FAULT),
+        ('warning', HxtleakHistoryFlags.WARNING),
+    )
+
+    def __init__(
+        self, path, decoder, segment_records=43200, retention=30*24*3600, flush_interval=10.0,
+        max_query_records=345600, logger=None
+    ):
+        """Initialise the history store.
+
+        :param path: directory in which to store segment files
+        :param decoder: packet decoder instance, defining the packet size and decoding records
+        :param segment_records: number of records in each segment file
+        :param retention: time in seconds for which records are retained
+        :param flush_interval: interval in seconds at which queued records are written and flushed
+        :param max_query_records: maximum number of records read by a single query
+        :param logger: logger instance to use, defaults to the root logger
+        """
+        self.path = path
+        self.decoder = decoder
+        self.record_size = HxtleakStoreFormat.TIMESTAMP.size + decoder.size
+        self.segment_records = segment_records
+        self.retention = retention
+        self.flush_interval = flush_interval
+        self.max_query_records = max_query_records
+        self.logger = logger if logger else logging.getLogger()
+
+        # Determine the offset and typecode of each packet field within a record, following the
+        # timestamp, from the packet structure format
+        offset = HxtleakStoreFormat.TIMESTAMP.size
+        self._layout = {}
+        for (name, typecode) in zip(HxtleakPacket._fields, decoder.format.lstrip('<')):
+            self._layout[name] = (offset, typecode)
+            offset += struct.calcsize('<' + typecode)
+
+        try:
+            os.makedirs(self.path, exist_ok=True)
+        except OSError as e:
+            raise HxtleakError("Failed to create history store directory {}: {}".format(
+                self.path, e
+            ))
+
+        # Build the segment index from the existing segment files, ignoring any which are invalid
+        # or hold records of a different size
+        self.segments = []
+        for file_name in store_files(self.path):
+            try:
+                segment = HxtleakStoreSegment.load(file_name)
+            except (HxtleakError, OSError) as e:
+                self.logger.warning("Ignoring history segment %s: %s", file_name, e)
+                continue
+            if segment.count and segment.record_size == self.record_size:
+                self.segments.append(segment)
+
+        self.enabled = False
+        self.records_written = 0
+
+        self._records = deque()
+        self._lock = threading.Lock()
+        self._active = None
+        self._map = None
+        self._wakeup = threading.Event()
+        self._writer = None
+
+        self._expire_segments()
+
+    def record(self, timestamp, raw):
+        """Record a packet in the store.
+
+        This method queues a packet, along with its receive timestamp, for writing by the
+        background writer. It is safe to call from any thread and never blocks.
+
+        :param timestamp: wall-clock receive time of the packet in seconds since the epoch
+        :param raw: bytes object containing the raw packet
+        """
+        if self.enabled:
+            self._records.append((timestamp, raw))
+
+    def set_enabled(self, enable):
+        """Enable or disable recording to the store.
+
+        Enabling recording starts the background writer, which creates a new segment when the first
+        records are written. Disabling recording stops the writer once all queued records have been
+        written.
+
+        :param enable: store enable state (True or False)
+        """
+        enable = bool(enable)
+        if enable == self.enabled:
+            return
+
+        if enable:
+            self.enabled = True
+            self._writer = threading.Thread(target=self._write_loop, daemon=True)
+            self._writer.start()
+            self.logger.info("History store recording started in %s", self.path)
+        else:
+            self.enabled = False
+            self._wakeup.set()
+            self._writer.join()
+            self._writer = None
+            self.logger.info("History store recording stopped")
+
+    def read(self, start=None, end=None, last=None):
+        """Read packets from the store.
+
+        This generator reads the packets stored within a time range, or the most recent packets,
+        in chronological order, decoding each directly from the memory-mapped segment files.
+
+        :param start: start of time range in seconds since the epoch, or None for the oldest
+        :param end: end of time range in seconds since the epoch, or None for the newest
+        :param last: if specified, the maximum number of most recent packets to read
+        :return: generator yielding tuples of packet timestamp and decoded packet
+        """
+        ranges = self._locate(start, end, last)
+        unpack_timestamp = HxtleakStoreFormat.TIMESTAMP.unpack_from
+        timestamp_size = HxtleakStoreFormat.TIMESTAMP.size
+
+        for (segment, first, stop) in ranges:
+            with self._map_segment(segment) as buffer:
+                for idx in range(first, stop):
+                    offset = segment.offset(idx)
+                    timestamp = unpack_timestamp(buffer, offset)[0]
+                    yield (
+                        timestamp,
+                        self.decoder.decode(buffer, offset + timestamp_size, timestamp)
+                    )
+
+    def count(self, start=None, end=None):
+        """Count the packets stored within a time range.
+
+        :param start: start of time range in seconds since the epoch, or None for the oldest
+        :param end: end of time range in seconds since the epoch, or None for the newest
+        :return: number of packets stored in the range
+        """
+        return sum(stop - first for (_, first, stop) in self._locate(start, end))
+
+    def _locate(self, start=None, end=None, last=None):
+        """Locate the records within a time range or the most recent records.
+
+        The segments overlapping the time range are selected from the segment index, and the
+        records at the ends of the range located by binary search of their timestamps.
+
+        :param start: start of time range in seconds since the epoch, or None for the oldest
+        :param end: end of time range in seconds since the epoch, or None for the newest
+        :param last: if specified, the maximum number of most recent records to locate
+        :return: list of (segment, first record index, end record index) tuples
+        """
+        # Take a consistent snapshot of the index, since the writer may be appending records
+        with self._lock:
+            segments = [
+                (segment, segment.count) for segment in self.segments
+                if segment.count
+                and (start is None or segment.last >= start)
+                and (end is None or segment.first <= end)
+            ]
+
+        ranges = []
+        for (segment, count) in segments:
+            (first, stop) = (0, count)
+            if (start is not None and segment.first < start) or (
+                end is not None and segment.last > end
+            ):
+                with self._map_segment(segment) as buffer:
+                    if start is not None:
+                        first = segment.search(buffer, start, count)
+                    if end is not None:
+                        stop = segment.search(buffer, end, count, after=True)
+            if stop > first:
+                ranges.append((segment, first, stop))
+
+        # Trim the ranges to the most recent records if requested
+        if last is not None:
+            remaining = last
+            trimmed = []
+            for (segment, first, stop) in reversed(ranges):
+                if remaining <= 0:
+                    break
+                first = max(first, stop - remaining)
+                remaining -= stop - first
+                trimmed.insert(0, (segment, first, stop))
+            ranges = trimmed
+
+        return ranges
+
+    def query(self, start=None, end=None, fields=None, points=1000, method='minmax'):
+        """Query the store over a time range, reducing it to a target number of points.
+
+        The requested channels of the records in the range are unpacked as columns directly from
+        the segment files into a history, which is then queried as for the in-memory history.
+
+        :param start: start of time range in seconds since the epoch, or None for the oldest
+        :param end: end of time range in seconds since the epoch, or None for the newest
+        :param fields: iterable of channel names to return, or None for all channels
+        :param points: target number of points to reduce the records to
+        :param method: reduction method, one of HxtleakHistory.QUERY_METHODS
+        :return: dict of query results
+        """
+        fields = HxtleakHistory.export_fields(fields)
+        ranges = self._locate(start, end)
+        count = sum(stop - first for (_, first, stop) in ranges)
+        if count > self.max_query_records:
+            raise HxtleakError(
+                "History query range contains too many records ({} > {})".format(
+                    count, self.max_query_records
+                )
+            )
+
+        history = HxtleakHistory.from_columns(self._concat_columns(ranges, fields))
+        return history.query(start, end, fields[1:], points, method)
+
+    def read_columns(self, start=None, end=None, last=None, fields=None):
+        """Read the records within a time range, or the most recent records, as columns.
+
+        The channels are unpacked directly from the segment files as for queries, without decoding
+        the individual packets, e.g. to restore the in-memory history efficiently.
+
+        :param start: start of time range in seconds since the epoch, or None for the oldest
+        :param end: end of time range in seconds since the epoch, or None for the newest
+        :param last: if specified, the maximum number of most recent records to read
+        :param fields: iterable of channel names to read, or None for all channels
+        :return: dict of arrays of channel values keyed by channel name, including the timestamps
+        """
+        fields = HxtleakHistory.export_fields(fields)
+        return self._concat_columns(self._locate(start, end, last), fields)
+
+    def _concat_columns(self, ranges, fields):
+        """Unpack channels of several ranges of records and concatenate them.
+
+        :param ranges: list of (segment, first record index, end record index) tuples
+        :param fields: list of channel names to unpack, including the timestamps
+        :return: dict of arrays of channel values keyed by channel name
+        """
+        columns = {name: array(typecode) for (name, typecode) in HxtleakHistory.FIELDS
+                   if name in fields}
+        for (segment, first, stop) in ranges:
+            for (name, column) in self._read_columns(segment, first, stop, fields).items():
+                columns[name].extend(column)
+        return columns
+
+    def export(self, start=None, end=None, fields=None, chunk_records=1024):
+        """Export the packets stored in a time range in chunks.
+
+        Records are read from the store only as the returned generator is consumed, each chunk
+        being unpacked directly from the segment file as columns, so that exporting a long time
+        range holds no more than one chunk in memory.
+
+        :param start: start of time range in seconds since the epoch, or None for the oldest
+        :param end: end of time range in seconds since the epoch, or None for the newest
+        :param fields: iterable of channel names to export, or None for all channels
+        :param chunk_records: maximum number of packets in each chunk
+        :return: generator yielding dicts of lists of channel values keyed by channel name
+        """
+        fields = HxtleakHistory.export_fields(fields)
+        return self._export_chunks(start, end, fields, chunk_records)
+
+    def _export_chunks(self, start, end, fields, chunk_records):
+        """Generate chunks of exported records read from the store.
+
+        Chunks are filled across segment boundaries, so that every chunk other than the last holds
+        exactly the requested number of records.
+        """
+        chunk = {name: [] for name in fields}
+        count = 0
+        for (segment, first, stop) in self._locate(start, end):
+            while first < stop:
+                chunk_stop = min(first + chunk_records - count, stop)
+                columns = self._read_columns(segment, first, chunk_stop, fields)
+                for name in fields:
+                    chunk[name].extend(columns[name].tolist())
+                count += chunk_stop - first
+                first = chunk_stop
+                if count == chunk_records:
+                    yield chunk
+                    chunk = {name: [] for name in fields}
+                    count = 0
+
+        if count:
+            yield chunk
+
+    def _read_columns(self, segment, first, stop, fields):
+        """Unpack channels of a range of records in a segment as columns.
+
+        Each byte of each channel value is gathered from all the records in the range with a
+        single strided slice of a memoryview of the mapped segment file, so that the columns are
+        unpacked without a Python loop over the records. The flags channel is packed from the
+        individual flag bytes using integer operations across the whole column.
+
+        :param segment: segment index entry
+        :param first: index of the first record
+        :param stop: index after the last record
+        :param fields: iterable of history channel names to unpack
+        :return: dict of arrays of channel values keyed by channel name
+        """
+        count = stop - first
+        columns = {}
+        with self._map_segment(segment) as buffer:
+            with memoryview(buffer) as view:
+                records = view[segment.offset(first):segment.offset(stop)]
+                for name in fields:
+                    if name == 'flags':
+                        columns[name] = self._unpack_flags(records, count)
+                    elif name == 'timestamp':
+                        columns[name] = self._unpack_column(records, 0, 'd', count)
+                    else:
+                        (offset, typecode) = self._layout[name]
+                        columns[name] = self._unpack_column(
+                            records, offset, typecode.replace('?', 'B'), count
+                        )
+                records.release()
+
+        return columns
+
+    @contextmanager
+    def _map_segment(self, segment):
+        """Map a segment file for reading.
+
+        Segments located by a reader may be deleted by the writer as they expire before the reader
+        opens them, in which case an error is raised. Once mapped, the segment remains readable
+        even if its file is deleted.
+
+        :param segment: segment index entry
+        :return: context manager yielding the read-only memory map of the segment file
+        """
+        try:
+            with open(segment.file_name, 'rb') as segment_file:
+                buffer = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            raise HxtleakError("Failed to read history segment {}: {}".format(
+                segment.file_name, e
+            ))
+
+        with buffer:
+            yield buffer
+
+    def _unpack_column(self, records, offset, typecode, count):
+        """Unpack a field of a range of records as an array.
+
+        :param records: memoryview of the records
+        :param offset: offset of the field in each record
+        :param typecode: array typecode of the field
+        :param count: number of records
+        :return: array of field values
+        """
+        column = array(typecode)
+        itemsize = column.itemsize
+        data = bytearray(itemsize * count)
+        for byte_idx in range(itemsize):
+            data[byte_idx::itemsize] = records[offset + byte_idx::self.record_size]
+
+        column.frombytes(data)
+        if itemsize > 1 and sys.byteorder == 'big':
+            column.byteswap()
+        return column
+
+    def _unpack_flags(self, records, count):
+        """Unpack the flag fields of a range of records, packed into the history flags channel.
+
+        Each flag byte is normalised to 0 or 1 and the flag columns combined as large integers, one
+        byte per record, since the shifted flag bits never carry into the adjacent record.
+
+        :param records: memoryview of the records
+        :param count: number of records
+        :return: array of packed flags values
+        """
+        flags = 0
+        for (name, bit) in self.FLAG_FIELDS:
+            offset = self._layout[name][0]
+            column = bytes(records[offset::self.record_size]).translate(_FLAG_BYTES)
+            flags |= int.from_bytes(column, 'little') * bit
+        return array('B', flags.to_bytes(count, 'little'))
+
+    def first_timestamp(self):
+        """Return the timestamp of the oldest stored record, or None if the store is empty."""
+        with self._lock:
+            return self.segments[0].first if self.segments else None
+
+    def disk_size(self):
+        """Return the total size of the segment files in bytes."""
+        with self._lock:
+            return sum(segment.file_size() for segment in self.segments)
+
+    def tree(self):
+        """Return a dict-like tree of history store parameters.
+
+        :return dict-like tree of history store parameter accessors
+        """
+        return {
+            'enabled': (lambda: self.enabled, self.set_enabled),
+            'path': (lambda: self.path, None),
+            'segments': (lambda: len(self.segments), None),
+            'records_written': (lambda: self.records_written, None),
+            'records_pending': (lambda: len(self._records), None),
+            'first_timestamp': (self.first_timestamp, None),
+            'disk_size': (self.disk_size, None),
+        }
+
+    def _write_loop(self):
+        """Run the background store writer.
+
+        This method runs in the writer thread, periodically writing all queued records to the
+        active segment and flushing it. Writing stops if an error occurs.
+        """
+        try:
+            while self.enabled:
+                self._wakeup.wait(self.flush_interval)
+                self._wakeup.clear()
+                self._write_records()
+            self._write_records()
+        except (OSError, ValueError) as e:
+            self.enabled = False
+            self.logger.error("History store recording failed: %s", e)
+        finally:
+            self._close_segment()
+
+    def _write_records(self):
+        """Write all queued records to the active segment and flush it, rotating as needed."""
+        pack_timestamp = HxtleakStoreFormat.TIMESTAMP.pack_into
+        timestamp_size = HxtleakStoreFormat.TIMESTAMP.size
+
+        written = 0
+        while self._records:
+            if self._active is None or self._active.count >= self._active.capacity:
+                self._flush_segment()
+                self._close_segment()
+                self._open_segment(self._records[0][0])
+
+            segment = self._active
+            (timestamp, raw) = self._records.popleft()
+            offset = segment.offset(segment.count)
+            pack_timestamp(self._map, offset, timestamp)
+            self._map[offset + timestamp_size:offset + self.record_size] = raw
+
+            # Update the index entry under the lock, so that readers see a consistent count
+            with self._lock:
+                if segment.first is None:
+                    segment.first = timestamp
+                segment.last = timestamp
+                segment.count += 1
+
+            self.records_written += 1
+            written += 1
+
+        if written:
+            self._flush_segment()
+            self._expire_segments()
+
+    def _flush_segment(self):
+        """Update the record count in the active segment header and flush it to disk."""
+        if self._active is not None:
+            HxtleakStoreFormat.COUNT.pack_into(
+                self._map, HxtleakStoreFormat.COUNT_OFFSET, self._active.count
+            )
+            self._map.flush()
+
+    def _open_segment(self, timestamp):
+        """Create a new active segment, deleting segments older than the retention period.
+
+        :param timestamp: timestamp of the first record in the segment, used to name the file
+        """
+        # Name the segment by the microsecond timestamp of its first record, so that segment files
+        # sort chronologically, ensuring that an existing segment is never overwritten
+        name_time = int(timestamp * 1e6)
+        while True:
+            file_name = os.path.join(self.path, "{}{:018d}{}".format(
+                HxtleakStoreFormat.FILE_PREFIX, name_time, HxtleakStoreFormat.FILE_SUFFIX
+            ))
+            if not os.path.exists(file_name):
+                break
+            name_time += 1
+
+        segment = HxtleakStoreSegment(file_name, self.record_size, self.segment_records)
+
+        # Create the segment file at its full size, which is allocated sparsely, and map it
+        with open(file_name, 'wb+') as segment_file:
+            segment_file.truncate(segment.file_size())
+            self._map = mmap.mmap(segment_file.fileno(), 0)
+        HxtleakStoreFormat.HEADER.pack_into(
+            self._map, 0, HxtleakStoreFormat.MAGIC, self.record_size, self.segment_records, 0
+        )
+
+        # Add the segment to the index and delete any segments beyond the retention period
+        with self._lock:
+            self.segments.append(segment)
+        self._active = segment
+        self._expire_segments()
+
+    def _expire_segments(self):
+        """Delete segments whose records are all older than the retention period.
+
+        This method is called when the store is opened and after each batch of records is written,
+        including when segments are rotated, so that segments expire while recording continues in
+        the active segment. The newest segment is always retained.
+        """
+        expired = []
+        cutoff = time.time() - self.retention
+        with self._lock:
+            while len(self.segments) > 1 and self.segments[0].last < cutoff:
+                expired.append(self.segments.pop(0))
+
+        for segment in expired:
+            try:
+                os.remove(segment.file_name)
+                self.logger.info("Deleted expired history segment %s", segment.file_name)
+            except OSError as e:
+                self.logger.warning(
+                    "Failed to delete expired history segment %s: %s", segment.file_name, e
+                )
+
+    def _close_segment(self):
+        """Close the active segment."""
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._active = None
+
+
+# Translation table normalising flag bytes to 0 or 1
+_FLAG_BYTES = bytes([0]) + bytes([1]) * 255
+
+
+def store_files(path):
+    """Return the history store segment files in a directory.
+
+    :param path: directory containing segment files
+    :return: list of segment file paths, sorted from oldest to newest
+    """
+    return sorted(
+        os.path.join(path, file_name) for file_name in os.listdir(path)
+        if file_name.startswith(HxtleakStoreFormat.FILE_PREFIX)
+        and file_name.endswith(HxtleakStoreFormat.FILE_SUFFIX)
+    )
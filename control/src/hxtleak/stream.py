@@ -0,0 +1,271 @@
+"""Streaming HTTP server for the Hxtleak adapter.
+
+This module implements a small Tornado web application, listening on its own port alongside the
+odin-control server, for responses which cannot be returned as a single ApiAdapterResponse. The
+history export handler streams the sensor history over a time range as CSV or NDJSON using chunked
+transfer encoding, gzip-compressed if the client accepts it. Chunks are read from the history
+tiers in the default executor, so that reading and decoding them does not stall the IOLoop, and
+each chunk is flushed to the client before the next is read, so that memory use is bounded by the
+chunk size regardless of the length of the export.
+
+The state WebSocket handler subscribes each connection to the updates of the system state and
+event log pushed by the controller, replacing polling of the adapter by clients. The event stream
+handler similarly streams packet snapshots and log events to clients such as scripts as
+server-sent events, log events being identified by their sequence number so that clients can
+resume a stream with the Last-Event-ID header, or are sent a reset event if the adapter has
+restarted since. Heartbeat comments are sent periodically to keep idle event streams open.
+
+The system poll handler serves long-poll requests for clients unable to use WebSockets, e.g.
+through HTTP proxies. A request giving the version of the system state last received is held on
+the IOLoop until the state changes, or a timeout elapses, so that clients receive changes as they
+happen without repeated polling.
+
+Tim Nicholls, STFC Detector Systems Software Group
+"""
+import logging
+import time
+from datetime import timedelta
+
+import tornado.web
+import tornado.websocket
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.iostream import StreamClosedError
+
+from .export import HxtleakExportEncoder
+from .util import HxtleakError
+
+
+class HxtleakExportHandler(tornado.web.RequestHandler):
+    """History export request handler class."""
+
+    def initialize(self, controller):
+        """Initialise the handler.
+
+        :param controller: controller instance providing the history export
+        """
+        self.controller = controller
+
+    async def get(self):
+        """Handle a history export request.
+
+        The start, end and fields arguments select the exported history as for history queries,
+        and the format argument selects CSV (the default) or NDJSON.
+        """
+        args = {name: self.get_argument(name) for name in self.request.arguments}
+        compress = 'gzip' in self.request.headers.get('Accept-Encoding', '')
+
+        try:
+            (fields, chunks) = self.controller.export_history(args)
+            encoder = HxtleakExportEncoder(args.get('format', 'csv'), fields, compress)
+        except HxtleakError as e:
+            self.set_status(400)
+            self.finish({'error': str(e)})
+            return
+
+        self.set_header('Content-Type', encoder.content_type)
+        file_name = 'hxtleak_history_{}.{}'.format(
+            time.strftime('%Y%m%d_%H%M%S'), encoder.export_format
+        )
+        self.set_header('Content-Disposition', 'attachment; filename="{}"'.format(file_name))
+        self.set_header('Vary', 'Accept-Encoding')
+        if compress:
+            self.set_header('Content-Encoding', 'gzip')
+
+        ioloop = IOLoop.current()
+        try:
+            self.write(encoder.header())
+            while True:
+                chunk = await ioloop.run_in_executor(None, next, chunks, None)
+                if chunk is None:
+                    break
+                self.write(encoder.encode(chunk))
+                await self.flush()
+            self.finish(encoder.finish())
+        except StreamClosedError:
+            logging.debug("History export client disconnected")
+        finally:
+            chunks.close()
+
+
+class HxtleakStateSocketHandler(tornado.websocket.WebSocketHandler):
+    """System state WebSocket handler class."""
+
+    def initialize(self, controller):
+        """Initialise the handler.
+
+        :param controller: controller instance pushing state updates
+        """
+        self.controller = controller
+
+    def check_origin(self, origin):
+        """Allow connections from any origin, since the web app is served from another port."""
+        return True
+
+    def open(self):
+        """Subscribe the connection to state updates when opened."""
+        self.controller.subscribe(self)
+
+    def on_message(self, message):
+        """Ignore messages received from the client."""
+        pass
+
+    def on_close(self):
+        """Unsubscribe the connection from state updates when closed."""
+        self.controller.unsubscribe(self)
+
+
+class HxtleakEventStreamHandler(tornado.web.RequestHandler):
+    """Server-sent event stream handler class."""
+
+    # Reconnection delay advised to clients in milliseconds
+    RETRY_MS = 5000
+
+    def initialize(self, controller):
+        """Initialise the handler.
+
+        :param controller: controller instance pushing server-sent events
+        """
+        self.controller = controller
+        self._closed = None
+
+    async def get(self):
+        """Handle an event stream request.
+
+        The connection is subscribed to the server-sent events pushed by the controller and held
+        open until the client disconnects. A client resuming a stream is sent the events logged
+        after that identified by its Last-Event-ID header.
+        """
+        try:
+            last_event_id = self.request.headers.get('Last-Event-ID')
+            last_event_id = int(last_event_id) if last_event_id else None
+        except ValueError:
+            self.set_status(400)
+            self.finish({'error': "Invalid Last-Event-ID {}".format(last_event_id)})
+            return
+
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        self.write('retry: {}\n\n'.format(self.RETRY_MS))
+        self.flush()
+
+        self._closed = Future()
+        self.controller.subscribe_sse(self, last_event_id)
+        try:
+            await self._closed
+        finally:
+            self.controller.unsubscribe_sse(self)
+
+    def write_message(self, message):
+        """Write a message to the event stream.
+
+        :param message: server-sent event message
+        """
+        if self._closed is None or self._closed.done():
+            raise StreamClosedError()
+        self.write(message)
+        self.flush()
+
+    def on_connection_close(self):
+        """Complete the request when the client closes the connection."""
+        if self._closed is not None and not self._closed.done():
+            self._closed.set_result(None)
+
+
+class HxtleakSystemPollHandler(tornado.web.RequestHandler):
+    """System state long-poll request handler class."""
+
+    # Default and maximum times in seconds to wait for the system state to change
+    DEFAULT_TIMEOUT = 30.0
+    MAX_TIMEOUT = 120.0
+
+    def initialize(self, controller):
+        """Initialise the handler.
+
+        :param controller: controller instance answering long-poll requests
+        """
+        self.controller = controller
+        self._changed = None
+
+    async def get(self):
+        """Handle a system state long-poll request.
+
+        The version argument gives the version of the system state last received by the client,
+        and the timeout argument the time in seconds to wait for it to change. The response holds
+        the current version of the system state and, unless the timeout elapsed without a change,
+        the system state itself. A request without a version is answered immediately.
+        """
+        try:
+            version = int(self.get_argument('version', -1))
+            timeout = float(self.get_argument('timeout', self.DEFAULT_TIMEOUT))
+        except ValueError:
+            self.set_status(400)
+            self.finish({'error': "Invalid system poll argument"})
+            return
+
+        timeout = min(max(timeout, 0.0), self.MAX_TIMEOUT)
+        self.set_header('Content-Type', 'application/json')
+        self.set_header('Cache-Control', 'no-cache')
+
+        # Wait for the next change of the system state if unchanged since the version given
+        self._changed = Future()
+        response = self.controller.subscribe_poll(self, version)
+        if response is None:
+            try:
+                response = await gen.with_timeout(timedelta(seconds=timeout), self._changed)
+            except gen.TimeoutError:
+                response = '{{"version": {}}}'.format(self.controller.version('system'))
+            finally:
+                self.controller.unsubscribe_poll(self)
+
+        # The response is None if the client closed the connection while waiting
+        if response is not None:
+            self.finish(response)
+
+    def write_message(self, message):
+        """Complete the request with the response to a change of the system state.
+
+        :param message: JSON-encoded long-poll response
+        """
+        if self._changed is None or self._changed.done():
+            raise StreamClosedError()
+        self._changed.set_result(message)
+
+    def on_connection_close(self):
+        """Stop waiting when the client closes the connection."""
+        if self._changed is not None and not self._changed.done():
+            self._changed.set_result(None)
+
+
+class HxtleakStreamServer():
+    """Streaming HTTP server class."""
+
+    def __init__(self, controller, port, address='', heartbeat_interval=15.0):
+        """Initialise the streaming server, listening on the specified port.
+
+        :param controller: controller instance serving the streamed responses
+        :param port: port to listen on
+        :param address: address to listen on, or empty for all interfaces
+        :param heartbeat_interval: interval in seconds between event stream heartbeats
+        """
+        self.port = port
+        self.application = tornado.web.Application([
+            (r'/export', HxtleakExportHandler, dict(controller=controller)),
+            (r'/ws', HxtleakStateSocketHandler, dict(controller=controller)),
+            (r'/events', HxtleakEventStreamHandler, dict(controller=controller)),
+            (r'/system', HxtleakSystemPollHandler, dict(controller=controller)),
+        ])
+        self.server = self.application.listen(port, address)
+        logging.debug("HxtleakStreamServer listening on port %d", port)
+
+        # Send heartbeats to all event stream clients periodically
+        self.heartbeat = PeriodicCallback(
+            lambda: controller.sse.notify('heartbeat'), heartbeat_interval * 1000
+        )
+        self.heartbeat.start()
+
+    def stop(self):
+        """Stop the streaming server listening for connections."""
+        self.heartbeat.stop()
+        self.server.stop()
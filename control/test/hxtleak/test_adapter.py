@@ -2,9 +2,12 @@
 
 James Foster
 """
+import json
 import pytest
 import sys
 from hxtleak.adapter import HxtleakAdapter
+from hxtleak.export import HxtleakBinaryEncoder
+from tornado.ioloop import IOLoop
 
 if sys.version_info[0] == 3:  # pragma: no cover
     from unittest.mock import Mock
@@ -13,6 +16,14 @@ else:                         # pragma: no cover
     from mock import Mock
 
 
+def run(coroutine):
+    """Run an adapter coroutine to completion on the IOLoop and return its result."""
+    async def wait():
+        return await coroutine
+
+    return IOLoop.current().run_sync(wait)
+
+
 @pytest.fixture(scope="class")
 def dummy_hxtleak_adapter():
     """Test the simple test fixture used in testing the hxtleak adapter."""
@@ -28,7 +39,7 @@ class TestHxtleakAdapter():
         expected_response = {'status': 'unknown'}
         mock_request = Mock()
         mock_request.headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
-        response = dummy_hxtleak_adapter.get('status', mock_request)
+        response = run(dummy_hxtleak_adapter.get('status', mock_request))
         assert response.data == expected_response
         assert response.status_code == 200
 
@@ -37,11 +48,69 @@ class TestHxtleakAdapter():
         expected_response = {'error': 'Invalid path: bad_param_tree'}
         mock_request = Mock()
         mock_request.headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
-        response = dummy_hxtleak_adapter.get('bad_param_tree', mock_request)
+        response = run(dummy_hxtleak_adapter.get('bad_param_tree', mock_request))
         assert response.data == expected_response
         assert response.status_code == 400
 
+    def test_adapter_get_versioned(self, dummy_hxtleak_adapter):
+        """Test that versioned subtrees are served from the response cache until they change."""
+        mock_request = Mock()
+        mock_request.headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
+        controller = dummy_hxtleak_adapter.controller
+
+        response = run(dummy_hxtleak_adapter.get('system', mock_request))
+        assert response.status_code == 200
+        assert json.loads(response.data) == controller.get('system')
+        assert run(dummy_hxtleak_adapter.get('system', mock_request)).data is response.data
+
+        controller.set('system/outlets/daq/state', True)
+        changed = run(dummy_hxtleak_adapter.get('/system/', mock_request)).data
+        assert changed is not response.data
+        assert json.loads(changed)['system']['outlets']['daq']['state']
+
+    def test_adapter_get_query(self, dummy_hxtleak_adapter):
+        """Test that the adapter get method resolves a query path with the request arguments."""
+        mock_request = Mock()
+        mock_request.headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
+        mock_request.query_arguments = {'points': [b'100', b'10'], 'fields': [b'board_temp']}
+        response = run(dummy_hxtleak_adapter.get('history/query', mock_request))
+        assert response.status_code == 200
+        assert response.data['count'] == 0
+        assert response.data['fields'] == {'board_temp': []}
+
+    def test_adapter_get_query_binary(self, dummy_hxtleak_adapter):
+        """Test that a query result is returned as binary if requested."""
+        mock_request = Mock()
+        mock_request.headers = {'Accept': 'application/octet-stream'}
+        mock_request.query_arguments = {'fields': [b'board_temp,flags']}
+        response = run(dummy_hxtleak_adapter.get('history/query', mock_request))
+        assert response.status_code == 200
+        assert response.content_type == 'application/octet-stream'
+        assert response.data.startswith(HxtleakBinaryEncoder.MAGIC)
+
+    def test_adapter_get_event_query(self, dummy_hxtleak_adapter):
+        """Test that an event log query returns the pre-encoded JSON events."""
+        mock_request = Mock()
+        mock_request.headers = {'Accept': 'application/octet-stream,application/json'}
+        mock_request.query_arguments = {'after': [b'0']}
+        response = run(dummy_hxtleak_adapter.get('event_log/query', mock_request))
+        assert response.status_code == 200
+        assert response.content_type == 'application/json'
+        result = json.loads(response.data)
+        logger = dummy_hxtleak_adapter.controller.logger
+        assert result['events'] == [event.record for event in logger.get_events_after(0)]
+        assert result['cursor'] == logger.last_seq()
+
+    def test_adapter_get_query_bad_args(self, dummy_hxtleak_adapter):
+        """Test that a query with invalid arguments returns an error."""
+        mock_request = Mock()
+        mock_request.headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
+        mock_request.query_arguments = {'points': [b'1']}
+        response = run(dummy_hxtleak_adapter.get('history/query', mock_request))
+        assert response.status_code == 400
+        assert 'error' in response.data
+
     def test_cleanup(self, dummy_hxtleak_adapter):
         """Test the cleanup function."""
-        dummy_hxtleak_adapter.cleanup()
+        run(dummy_hxtleak_adapter.cleanup())
         assert not dummy_hxtleak_adapter.controller.background_task_enable
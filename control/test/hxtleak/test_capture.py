@@ -0,0 +1,101 @@
+"""Test capture recorder class.
+
+Tim Nicholls, STFC Detector Systems Software Group
+"""
+import pytest
+import os
+
+from hxtleak.capture import (
+    HxtleakCaptureRecorder, HxtleakCaptureFormat, capture_files, read_capture
+)
+
+
+class CaptureTestFixture(object):
+    """Container class used in the creation of a capture recorder fixture."""
+
+    def __init__(self, path):
+        """Initialise the capture recorder and test data."""
+        self.path = str(path)
+        self.chunks = [bytes([val]) * 10 for val in range(5)]
+        self.recorder = HxtleakCaptureRecorder(
+            self.path, max_file_size=80, max_files=2, flush_interval=0.01
+        )
+
+    def read_chunks(self, file_name):
+        """Read the chunks recorded in a capture file."""
+        with open(file_name, 'rb') as capture_file:
+            data = capture_file.read()
+
+        (magic, _, _) = HxtleakCaptureFormat.FILE_HEADER.unpack_from(data)
+        assert magic == HxtleakCaptureFormat.MAGIC
+
+        chunks = []
+        offset = HxtleakCaptureFormat.FILE_HEADER.size
+        while offset < len(data):
+            (_, length) = HxtleakCaptureFormat.CHUNK_HEADER.unpack_from(data, offset)
+            offset += HxtleakCaptureFormat.CHUNK_HEADER.size
+            chunks.append(data[offset:offset + length])
+            offset += length
+
+        return chunks
+
+
+@pytest.fixture()
+def capture_fixture(tmp_path):
+    """Test fixture used in the testing of capture recorder behaviour."""
+    capture_fixture = CaptureTestFixture(tmp_path)
+    yield capture_fixture
+    capture_fixture.recorder.set_enabled(False)
+
+
+class TestCaptureRecorder():
+    """Class to test the capture recorder behaviour."""
+
+    def test_record_disabled(self, capture_fixture):
+        """Test that data is not recorded when the recorder is disabled."""
+        capture_fixture.recorder.record(capture_fixture.chunks[0])
+        assert capture_files(capture_fixture.path) == []
+
+    def test_record(self, capture_fixture):
+        """Test that recorded chunks are written to a capture file."""
+        capture_fixture.recorder.set_enabled(True)
+        for chunk in capture_fixture.chunks[:2]:
+            capture_fixture.recorder.record(chunk)
+        capture_fixture.recorder.set_enabled(False)
+
+        files = capture_files(capture_fixture.path)
+        assert len(files) == 1
+        assert capture_fixture.read_chunks(files[0]) == capture_fixture.chunks[:2]
+        assert capture_fixture.recorder.bytes_written == 20
+
+    def test_rotation(self, capture_fixture):
+        """Test that capture files are rotated and the oldest deleted beyond the limit."""
+        capture_fixture.recorder.set_enabled(True)
+        for chunk in capture_fixture.chunks:
+            capture_fixture.recorder.record(chunk)
+        capture_fixture.recorder.set_enabled(False)
+
+        files = capture_files(capture_fixture.path)
+        assert len(files) == 2
+        assert capture_fixture.read_chunks(files[-1]) == capture_fixture.chunks[-1:]
+
+    def test_tree(self, capture_fixture):
+        """Test that the recorder parameter tree reports the recorder state."""
+        tree = capture_fixture.recorder.tree()
+        assert tree['enabled'][0]() is False
+        assert tree['path'][0]() == capture_fixture.path
+        assert os.path.isdir(capture_fixture.path)
+
+    def test_read_capture(self, capture_fixture):
+        """Test that chunks recorded across rotated capture files are read back in order."""
+        capture_fixture.recorder.max_files = 10
+        capture_fixture.recorder.set_enabled(True)
+        for chunk in capture_fixture.chunks:
+            capture_fixture.recorder.record(chunk)
+        capture_fixture.recorder.set_enabled(False)
+
+        replayed = list(read_capture(capture_fixture.path))
+        assert [data for (_, data) in replayed] == capture_fixture.chunks
+
+        timestamps = [timestamp for (timestamp, _) in replayed]
+        assert timestamps == sorted(timestamps)
@@ -0,0 +1,242 @@
+"""Test compressed cold history tier classes.
+
+Tim Nicholls, STFC Detector Systems Software Group
+"""
+import pytest
+import os
+import random
+import time
+
+from hxtleak.cold import HxtleakColdTier, _BitReader, _BitWriter, cold_files
+from hxtleak.emulator import HxtleakEmulator
+from hxtleak.history import HxtleakHistory
+from hxtleak.packet_decoder import HxtleakPacketDecoder
+from hxtleak.util import HxtleakError
+
+
+class ColdTierTestFixture(object):
+    """Container class used in the creation of a cold tier fixture."""
+
+    def __init__(self, path):
+        """Initialise the cold tier and test samples."""
+        self.path = str(path)
+        self.cold = self.create_cold()
+
+        # Generate samples with jittered timestamps and slowly varying, quantised sensor values
+        decoder = HxtleakPacketDecoder()
+        emulator = HxtleakEmulator(seed=1)
+        rand = random.Random(1)
+        self.start = float(int(time.time())) - 1000.0
+        values = [25.0, 40.0, 20.0, 20.0]
+        self.samples = []
+        for idx in range(200):
+            values = [value + rand.choice((-0.0625, 0.0, 0.0, 0.0625)) for value in values]
+            packet = decoder.decode(emulator.encode_packet(
+                *values, leak_detected=(idx == 120), sensor_status=(0x40 if idx > 150 else 0)
+            ))
+            timestamp = round(self.start + idx * 0.5 + rand.uniform(-0.003, 0.003), 3)
+            self.samples.append((timestamp, packet))
+
+    def create_cold(self, **kwargs):
+        """Create a cold tier in the fixture path."""
+        options = {'block_samples': 50, 'blocks_per_file': 2}
+        options.update(kwargs)
+        return HxtleakColdTier(self.path, **options)
+
+    def fill(self, num_samples=None):
+        """Append samples to the cold tier and wait for sealed blocks to be written."""
+        for (timestamp, packet) in self.samples[:num_samples]:
+            self.cold.append(timestamp, packet)
+        self.cold.flush()
+
+    def history(self):
+        """Return an in-memory history holding all the samples."""
+        history = HxtleakHistory(len(self.samples))
+        for (timestamp, packet) in self.samples:
+            history.append(timestamp, packet)
+        return history
+
+
+@pytest.fixture()
+def cold_fixture(tmp_path):
+    """Test fixture used in the testing of cold tier behaviour."""
+    cold_fixture = ColdTierTestFixture(tmp_path)
+    yield cold_fixture
+    cold_fixture.cold.close()
+
+
+class TestColdTier():
+    """Class to test the compressed cold tier behaviour."""
+
+    def test_bit_stream(self):
+        """Test that values written to a bit stream are read back."""
+        values = [(1, 1), (0, 1), (0x5a, 7), (0xFFFFFFFF, 32), (3, 2), (0x123456789, 64)]
+        writer = _BitWriter()
+        for (value, num_bits) in values:
+            writer.write(value, num_bits)
+        assert writer.bits == sum(num_bits for (_, num_bits) in values)
+
+        reader = _BitReader(writer.getvalue())
+        assert [reader.read(num_bits) for (_, num_bits) in values] == [
+            value for (value, _) in values
+        ]
+
+    def test_roundtrip(self, cold_fixture):
+        """Test that all samples are decoded losslessly from sealed and unsealed blocks."""
+        cold_fixture.fill(180)
+        assert len(cold_fixture.cold.blocks) == 3
+        assert cold_fixture.cold.block.count == 30
+
+        result = cold_fixture.cold.query(
+            cold_fixture.start - 1, cold_fixture.start + 1000, points=1000, method='raw'
+        )
+        expected = cold_fixture.history().query(
+            cold_fixture.start - 1, cold_fixture.samples[179][0], points=1000, method='raw'
+        )
+        assert result['count'] == 180
+        assert result['timestamp'] == pytest.approx(expected['timestamp'])
+        assert result['fields'] == expected['fields']
+
+    def test_compression(self, cold_fixture):
+        """Test that slowly varying samples are compressed well below the raw record size."""
+        cold_fixture.fill()
+        raw_size = len(cold_fixture.samples) * (8 + len(cold_fixture.samples[0][1].raw))
+        assert cold_fixture.cold.bytes_written * 5 < raw_size
+
+    def test_file_rotation(self, cold_fixture):
+        """Test that files are rotated and reindexed when the cold tier is reopened."""
+        cold_fixture.fill()
+        assert len(cold_files(cold_fixture.path)) == 2
+
+        cold = HxtleakColdTier(cold_fixture.path)
+        assert len(cold.blocks) == 4
+        assert cold.first_timestamp() == cold_fixture.samples[0][0]
+        cold.close()
+
+    def test_seal_background(self, cold_fixture):
+        """Test that sealed blocks are queryable before and after being written by the writer."""
+        cold = cold_fixture.cold
+        for (timestamp, packet) in cold_fixture.samples[:60]:
+            cold.append(timestamp, packet)
+        assert len(cold.query(method='raw')['timestamp']) == 60
+
+        assert cold.flush(timeout=5.0)
+        assert len(cold.blocks) == 1
+        assert cold.samples_written == 50
+        assert len(cold.query(method='raw')['timestamp']) == 60
+
+    def test_checkpoint_recovery(self, cold_fixture):
+        """Test that the checkpointed unsealed block is recovered when the cold tier is reopened."""
+        cold_fixture.cold.close()
+        cold_fixture.cold = cold_fixture.create_cold(checkpoint_interval=0.01)
+        cold_fixture.fill(70)
+        deadline = time.time() + 5.0
+        while cold_fixture.cold._checkpoint_count != 20 and time.time() < deadline:
+            time.sleep(0.01)
+        assert os.path.exists(cold_fixture.cold.checkpoint_name)
+
+        # Reopen the cold tier without closing it, as if the adapter had stopped unexpectedly
+        cold = cold_fixture.create_cold()
+        assert not os.path.exists(cold.checkpoint_name)
+        assert [entry.count for entry in cold.blocks] == [50, 20]
+
+        expected = cold_fixture.history().query(
+            end=cold_fixture.samples[69][0], fields=['probe_temp_1'], method='raw'
+        )
+        assert cold.query(fields=['probe_temp_1'], method='raw')['fields'] == expected['fields']
+        cold.close()
+
+    def test_checkpoint_removed_on_close(self, cold_fixture):
+        """Test that the checkpoint is removed when the current block is sealed on close."""
+        cold_fixture.cold.close()
+        cold_fixture.cold = cold_fixture.create_cold(checkpoint_interval=0.01)
+        cold_fixture.fill(20)
+        cold_fixture.cold.close()
+        assert not os.path.exists(cold_fixture.cold.checkpoint_name)
+
+        cold = cold_fixture.create_cold()
+        assert [entry.count for entry in cold.blocks] == [20]
+        cold.close()
+
+    def test_timestamp_step_seals_block(self, cold_fixture):
+        """Test that a large timestamp step seals the current block."""
+        cold_fixture.fill(10)
+        cold_fixture.cold.append(cold_fixture.start + 1e6, cold_fixture.samples[10][1])
+        cold_fixture.cold.flush()
+        assert len(cold_fixture.cold.blocks) == 1
+        assert cold_fixture.cold.block.count == 1
+
+    def test_expired_file_delete_failure(self, cold_fixture, caplog):
+        """Test that a failure to delete an expired file is logged without stopping the writer."""
+        cold_fixture.cold.close()
+        cold_fixture.cold = cold_fixture.create_cold(retention=100)
+        cold_fixture.fill(100)
+        expired = cold_files(cold_fixture.path)
+        os.remove(expired[0])
+
+        for (timestamp, packet) in cold_fixture.samples[100:]:
+            cold_fixture.cold.append(timestamp, packet)
+        assert cold_fixture.cold.flush(timeout=5.0)
+        assert "Failed to delete expired cold tier file" in caplog.text
+        assert cold_fixture.cold.samples_written == 200
+        assert all(entry.file_name != expired[0] for entry in cold_fixture.cold.blocks)
+
+    def test_query_deleted_file(self, cold_fixture):
+        """Test that querying a block whose file has been deleted raises an error."""
+        cold_fixture.fill()
+        os.remove(cold_fixture.cold.blocks[0].file_name)
+        with pytest.raises(HxtleakError, match="Failed to read cold tier file"):
+            cold_fixture.cold.query(method='raw')
+
+    def test_pending_samples(self, cold_fixture):
+        """Test that samples not yet written are counted in the pending samples."""
+        for (timestamp, packet) in cold_fixture.samples[:60]:
+            cold_fixture.cold.append(timestamp, packet)
+        assert cold_fixture.cold.pending_samples() in (10, 60)
+        assert cold_fixture.cold.flush(timeout=5.0)
+        assert cold_fixture.cold.pending_samples() == 10
+
+    def test_query_summaries(self, cold_fixture):
+        """Test that coarse minmax queries are answered from the block summaries."""
+        cold_fixture.fill()
+        result = cold_fixture.cold.query(
+            cold_fixture.start, cold_fixture.start + 100, ['probe_temp_1', 'flags'], points=2
+        )
+        assert result['tier'] == 'cold'
+        assert result['count'] == 200
+        assert len(result['timestamp']) == 2
+
+        probe_temps = [packet.probe_temp_1 for (_, packet) in cold_fixture.samples]
+        assert result['fields']['probe_temp_1']['min'][0] == min(probe_temps[:100])
+        assert result['fields']['probe_temp_1']['max'][1] == max(probe_temps[100:])
+        assert result['fields']['flags'] == [0x2, 0x3]
+
+    def test_query_too_many_records(self, cold_fixture):
+        """Test that reduced queries of too many samples are answered from the block summaries."""
+        cold_fixture.cold.max_query_records = 60
+        cold_fixture.fill()
+        result = cold_fixture.cold.query(
+            cold_fixture.start, cold_fixture.start + 100, ['probe_temp_1'], points=1000
+        )
+        assert result['tier'] == 'cold'
+        assert result['count'] == 200
+        assert len(result['timestamp']) == 4
+
+        with pytest.raises(HxtleakError, match="too many records"):
+            cold_fixture.cold.query(fields=['probe_temp_1'], method='raw')
+
+    def test_query_unknown_field(self, cold_fixture):
+        """Test that querying an unknown field raises an error."""
+        with pytest.raises(HxtleakError, match="Unknown history field"):
+            cold_fixture.cold.query(fields=['missing'])
+
+    def test_export(self, cold_fixture):
+        """Test that a time range of the cold tier is exported in chunks of one block."""
+        cold_fixture.fill(120)
+        (start, end) = (cold_fixture.samples[30][0], cold_fixture.samples[110][0])
+        chunks = list(cold_fixture.cold.export(start, end, ['probe_temp_1']))
+        assert [len(chunk['timestamp']) for chunk in chunks] == [20, 50, 11]
+
+        expected = cold_fixture.history().query(start, end, ['probe_temp_1'], method='raw')
+        assert sum((chunk['probe_temp_1'] for chunk in chunks), []) == \
+            expected['fields']['probe_temp_1']
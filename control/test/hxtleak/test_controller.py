@@ -2,32 +2,37 @@
 
 James Foster
 """
-import pytest
-from hxtleak.controller import HxtleakController
-import struct
+import json
+import logging
 import os
-import time
+import threading
+from unittest.mock import Mock
 
-from odin.adapters.parameter_tree import ParameterTreeError
+import pytest
+import serial
+from hxtleak.controller import HxtleakController, PacketReceiveState, SystemStateTrigger
+from hxtleak.emulator import HxtleakEmulator
+from hxtleak.history import HxtleakHistory
+from hxtleak.rollup import HxtleakRollups
+from hxtleak.util import HxtleakError
 
-try:
-    import pty
-except ImportError:
-    pty = None
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from odin.adapters.parameter_tree import ParameterTreeError
 
 
 class DummySerialPortFixture(object):
     """Container class used in the creation of a dummy serial port fixture."""
 
     def __init__(self):
-        """Initialise the dummy serial port and test packets."""
-        self.master, self.slave = pty.openpty()
-
-        self.port_name = os.ttyname(self.slave)
+        """Initialise the emulated serial port and test packets."""
+        self.emulator = HxtleakEmulator(seed=1)
+        self.port_name = self.emulator.open()
 
-        self.packet = struct.pack('<HH?BH', 1, 2, 0, 3, 42405)
-        self.packet_small = struct.pack('<HH?H', 5, 2, 0, 42405)
-        self.bad_checksum = struct.pack('<HH?BH', 1, 2, 0, 0, 42405)
+        self.packet = self.emulator.encode_packet(board_temp=21.5, probe_temp_1=18.25)
+        self.packet_small = self.packet[:-10]
+        self.bad_checksum = self.emulator.encode_packet(bad_checksum=True)
 
         self.controller = HxtleakController(self.port_name)
 
@@ -36,7 +41,22 @@ class DummySerialPortFixture(object):
 
         :param input: input packet written to the port
         """
-        os.write(self.master, input)
+        self.emulator.write(input)
+
+    def run_until(self, condition, timeout=1.0):
+        """Run the IOLoop until a condition is met or the timeout elapses.
+
+        :param condition: callable returning True when the condition is met
+        :param timeout: maximum time to run the IOLoop for
+        """
+        async def wait_for_condition():
+            while not condition():
+                await gen.sleep(0.01)
+
+        try:
+            IOLoop.current().run_sync(wait_for_condition, timeout=timeout)
+        except gen.TimeoutError:
+            pass
 
 
 @pytest.fixture()
@@ -45,6 +65,7 @@ def serial_fixture():
     serial_fixture = DummySerialPortFixture()
     yield serial_fixture
     serial_fixture.controller.cleanup()
+    serial_fixture.emulator.close()
 
 
 class TestHxtleakController():
@@ -53,21 +74,315 @@ class TestHxtleakController():
     def test_serial_read(self, serial_fixture):
         """Test that a packet written to serial can be read."""
         serial_fixture.ser_write(serial_fixture.packet)
-        while serial_fixture.controller.status == 'unknown':
-            pass
-        serial_fixture.controller.background_task_enable = False
-        output = serial_fixture.controller.decoder
-        assert serial_fixture.packet[0] == output.t1
-        assert serial_fixture.packet[2] == output.t2
-        assert serial_fixture.packet[4] == output.fault
+        serial_fixture.run_until(lambda: serial_fixture.controller.packet)
+        output = serial_fixture.controller.packet
+        assert output.board_temp == 21.5
+        assert output.probe_temp_1 == 18.25
+        assert not output.fault
+        assert serial_fixture.controller.status == PacketReceiveState.OK
 
     def test_serial_packet_small(self, serial_fixture):
         """Test that a packet which is too small is not decoded."""
         serial_fixture.ser_write(serial_fixture.packet_small)
-        time.sleep(.1)
-        serial_fixture.controller.background_task_enable = False
-        output = serial_fixture.controller.decoder
-        assert serial_fixture.packet_small[0] != output.t1
+        serial_fixture.run_until(lambda: False, timeout=0.1)
+        assert serial_fixture.controller.packet is None
+        assert serial_fixture.controller.good_packet_counter == 0
+
+    def test_serial_packet_resync(self, serial_fixture):
+        """Test that a packet following a truncated packet is decoded."""
+        serial_fixture.ser_write(serial_fixture.packet_small + serial_fixture.packet)
+        serial_fixture.run_until(lambda: serial_fixture.controller.packet)
+        assert serial_fixture.controller.packet.board_temp == 21.5
+        assert serial_fixture.controller.framer.discarded_bytes == len(
+            serial_fixture.packet_small
+        )
+
+    def test_serial_multiple_packets(self, serial_fixture):
+        """Test that all packets available in a single read are processed."""
+        serial_fixture.ser_write(serial_fixture.packet * 3)
+        serial_fixture.run_until(lambda: serial_fixture.controller.good_packet_counter >= 3)
+        assert serial_fixture.controller.good_packet_counter == 3
+        assert serial_fixture.controller.framer.discarded_bytes == 0
+
+    def test_receive_timeout(self, serial_fixture):
+        """Test that the status times out when no packet is received, and recovers on the next."""
+        controller = serial_fixture.controller
+        controller.last_packet_time -= controller.packet_recv_timeout + 1.0
+        controller.check_receive_timeout()
+        assert controller.status == PacketReceiveState.TIMEOUT
+        assert controller.recv_timeout_handle is not None
+
+        serial_fixture.ser_write(serial_fixture.packet)
+        serial_fixture.run_until(lambda: controller.status == PacketReceiveState.OK)
+        assert controller.status == PacketReceiveState.OK
+
+    def test_serial_error(self, serial_fixture):
+        """Test that a serial port error stops reception without stopping other subsystems."""
+        controller = serial_fixture.controller
+        controller.recorder = Mock()
+
+        def read_error(size):
+            raise serial.serialutil.SerialException("device disconnected")
+
+        controller.serial_input.read = read_error
+        serial_fixture.ser_write(serial_fixture.packet)
+        serial_fixture.run_until(lambda: controller.status == PacketReceiveState.SERIAL_ERROR)
+        assert controller.status == PacketReceiveState.SERIAL_ERROR
+        assert not controller.receive_task_enable
+        assert not controller.serial_input.is_open
+        assert controller.recv_timeout_handle is None
+        assert not controller.recorder.set_enabled.called
+
+    def test_history(self, serial_fixture):
+        """Test that good packets are appended to the sensor history."""
+        serial_fixture.ser_write(serial_fixture.packet + serial_fixture.bad_checksum)
+        serial_fixture.run_until(lambda: serial_fixture.controller.bad_packet_counter)
+        assert serial_fixture.controller.history.count == 1
+        recent = serial_fixture.controller.get('history/recent')['recent']
+        assert recent['board_temp'] == [21.5]
+        assert recent['probe_temp_1'] == [18.25]
+
+    def test_history_query(self, serial_fixture):
+        """Test that the history can be queried with string arguments."""
+        serial_fixture.ser_write(serial_fixture.packet)
+        serial_fixture.run_until(lambda: serial_fixture.controller.history.count)
+
+        controller = serial_fixture.controller
+        assert controller.has_query('history/query/')
+        result = controller.query('history/query', {'start': '-60', 'fields': 'board_temp'})
+        assert result['fields'] == {'board_temp': [21.5]}
+
+        result = controller.query('history/query', {'end': '-60'})
+        assert result['count'] == 0
+
+        with pytest.raises(HxtleakError, match="Invalid history query argument"):
+            controller.query('history/query', {'points': 'many'})
+
+    def test_history_query_rollup_retention(self, serial_fixture):
+        """Test that a minmax query starting before the rollup retention is not truncated."""
+        controller = serial_fixture.controller
+        controller.rollups = HxtleakRollups(tiers=(('1s', 1, 8), ('10s', 10, 8)))
+        packet = controller.decoder.decode(serial_fixture.packet)
+        for idx in range(80):
+            controller.history.append(1000.0 + idx / 2, packet)
+            controller.rollups.append(1000.0 + idx / 2, packet)
+        args = {'start': '1000', 'end': '1040', 'points': '10', 'fields': 'board_temp'}
+
+        # The 1s tier matches the point spacing but retains only the last 8 seconds, so the query
+        # is answered from the in-memory history
+        result = controller.query('history/query', args)
+        assert 'tier' not in result
+        assert result['count'] == 80
+        assert result['timestamp'][0] == 1000.0
+
+        # If the history has also wrapped, the coarser 10s tier holding older samples is queried
+        controller.history = HxtleakHistory(20)
+        for idx in range(80):
+            controller.history.append(1000.0 + idx / 2, packet)
+        result = controller.query('history/query', args)
+        assert result['tier'] == '10s'
+        assert result['count'] == 80
+
+    def test_history_store_restore(self, serial_fixture, tmp_path):
+        """Test that the history is restored from the history store when restarted."""
+        serial_fixture.controller.cleanup()
+        controller = HxtleakController(serial_fixture.port_name, store_path=str(tmp_path))
+        serial_fixture.ser_write(serial_fixture.packet * 2)
+        serial_fixture.run_until(lambda: controller.history.count == 2)
+        controller.cleanup()
+
+        controller = HxtleakController(serial_fixture.port_name, store_path=str(tmp_path))
+        assert controller.history.count == 2
+        assert controller.get('history/store/segments')['segments'] == 1
+        assert controller.history.column('board_temp') == [21.5, 21.5]
+        controller.cleanup()
+
+    def test_history_store_restore_rollups(self, serial_fixture, tmp_path):
+        """Test that the rollups are restored from the saved tiers rather than the history."""
+        serial_fixture.controller.cleanup()
+        controller = HxtleakController(
+            serial_fixture.port_name, history_size=2, store_path=str(tmp_path)
+        )
+        serial_fixture.ser_write(serial_fixture.packet * 3)
+        serial_fixture.run_until(lambda: controller.good_packet_counter == 3)
+        controller.cleanup()
+        assert os.path.exists(controller.rollup_file)
+
+        # The saved tiers hold all the samples although the restored history holds only two, and
+        # the samples in the store already held by the tiers are not merged again
+        controller = HxtleakController(
+            serial_fixture.port_name, history_size=2, store_path=str(tmp_path)
+        )
+        tier = controller.rollups.tiers[-1]
+        assert controller.history.count == 2
+        assert sum(tier._range(tier.counts)) == 3
+        controller.cleanup()
+
+    def test_history_store_restore_decoder(self, serial_fixture, tmp_path):
+        """Test that restoring the history leaves the live packet decoder untouched."""
+        serial_fixture.controller.cleanup()
+        controller = HxtleakController(serial_fixture.port_name, store_path=str(tmp_path))
+        serial_fixture.ser_write(serial_fixture.packet * 3)
+        serial_fixture.run_until(lambda: controller.history.count == 3)
+        controller.cleanup()
+
+        controller = HxtleakController(serial_fixture.port_name, store_path=str(tmp_path))
+        assert controller.store.decoder is not controller.decoder
+        assert controller.rollups.tiers[0].count
+        serial_fixture.ser_write(serial_fixture.packet)
+        serial_fixture.run_until(lambda: controller.packet)
+        assert controller.packet.seq == 0
+        controller.cleanup()
+
+    def test_history_cold_tier(self, serial_fixture, tmp_path):
+        """Test that received packets are compressed into the cold tier and sealed on cleanup."""
+        serial_fixture.controller.cleanup()
+        controller = HxtleakController(serial_fixture.port_name, cold_path=str(tmp_path))
+        serial_fixture.ser_write(serial_fixture.packet * 2)
+        serial_fixture.run_until(lambda: controller.cold.block.count == 2)
+        controller.cleanup()
+
+        controller = HxtleakController(serial_fixture.port_name, cold_path=str(tmp_path))
+        assert controller.get('history/cold/blocks')['blocks'] == 1
+        assert controller.get('history/cold/samples')['samples'] == 2
+        controller.cleanup()
+
+    def test_event_log_query(self, serial_fixture):
+        """Test that the event log can be queried after a cursor."""
+        controller = serial_fixture.controller
+        last_seq = controller.logger.last_seq()
+        controller.logger.warning("Test event")
+        result = json.loads(controller.query('event_log/query', {'after': str(last_seq)}))
+        assert [event['message'] for event in result['events']] == ["Test event"]
+        assert result['cursor'] == last_seq + 1
+
+        with pytest.raises(HxtleakError, match="Invalid event log query argument"):
+            controller.query('event_log/query', {'after': 'x'})
+        with pytest.raises(HxtleakError, match="limit must be at least 1"):
+            controller.query('event_log/query', {'limit': '0'})
+
+    def test_push_packet(self, serial_fixture):
+        """Test that the system state is pushed to subscribers when a packet is received."""
+        messages = []
+
+        class Subscriber():
+            def write_message(self, message):
+                messages.append(json.loads(message))
+
+        serial_fixture.controller.subscribe(Subscriber())
+        assert [message['type'] for message in messages] == ['system', 'events']
+
+        serial_fixture.ser_write(serial_fixture.packet)
+        serial_fixture.run_until(lambda: len(messages) > 2)
+        system = [message['data'] for message in messages[2:] if message['type'] == 'system']
+        assert system[-1]['system']['status'] == 'OK'
+
+    def test_push_packet_sse(self, serial_fixture):
+        """Test that packet snapshots are pushed to server-sent event subscribers."""
+        messages = []
+
+        class Subscriber():
+            def write_message(self, message):
+                messages.append(message)
+
+        serial_fixture.controller.subscribe_sse(Subscriber())
+        assert messages == []
+
+        serial_fixture.ser_write(serial_fixture.packet)
+        serial_fixture.run_until(lambda: messages)
+        (event, data) = messages[0].splitlines()[:2]
+        assert event == 'event: packet'
+        assert json.loads(data[len('data: '):])['board_temp'] == 21.5
+
+    def test_push_sse_reset(self, serial_fixture):
+        """Test that a server-sent event client resuming beyond the last event is reset."""
+        messages = []
+
+        class Subscriber():
+            def write_message(self, message):
+                messages.append(message)
+
+        controller = serial_fixture.controller
+        controller.logger.warning("Event before reset")
+        last_seq = controller.logger.last_seq()
+
+        controller.subscribe_sse(Subscriber(), last_event_id=last_seq)
+        assert messages == []
+
+        controller.subscribe_sse(Subscriber(), last_event_id=last_seq + 100)
+        assert messages[0] == 'id: 0\nevent: reset\ndata: {}\n\n'
+        replayed = [
+            int(line[len('id: '):]) for line in messages[1].splitlines() if line.startswith('id: ')
+        ]
+        assert replayed == list(range(1, last_seq + 1))
+
+    def test_versions(self, serial_fixture):
+        """Test that subtree versions are bumped only when something under the subtree changes."""
+        controller = serial_fixture.controller
+        versions = dict(controller.versions)
+        assert controller.version('system/status') == versions['system']
+        assert controller.version('system/outlets/daq') == versions['outlets']
+        assert controller.version('history') is None
+
+        serial_fixture.ser_write(serial_fixture.packet)
+        serial_fixture.run_until(lambda: controller.good_packet_counter)
+        assert controller.versions['system'] > versions['system']
+        assert controller.versions['outlets'] == versions['outlets']
+
+        versions = dict(controller.versions)
+        controller.set('system/outlets/chiller/state', True)
+        assert controller.versions['system'] > versions['system']
+        assert controller.versions['outlets'] > versions['outlets']
+
+        versions = dict(controller.versions)
+        controller.logger.warning("Versioned event")
+        assert controller.versions['event_log'] > versions['event_log']
+        assert controller.versions['system'] == versions['system']
+        assert controller.get('versions/event_log')['event_log'] == controller.versions['event_log']
+
+    def test_versions_threads(self, serial_fixture):
+        """Test that the event log version is bumped once for each event logged from any thread."""
+        controller = serial_fixture.controller
+        version = controller.versions['event_log']
+
+        def log_events():
+            for idx in range(200):
+                controller.logger.warning("Threaded event %d", idx)
+
+        threads = [threading.Thread(target=log_events) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert controller.versions['event_log'] == version + 800
+
+    def test_system_snapshot(self, serial_fixture):
+        """Test that the system state snapshot is encoded again when the state changes."""
+        controller = serial_fixture.controller
+        snapshot = controller.system_json()
+        assert json.loads(snapshot) == controller.get('system')
+
+        serial_fixture.ser_write(serial_fixture.packet)
+        serial_fixture.run_until(lambda: controller.good_packet_counter)
+        snapshot = json.loads(controller.system_json())
+        assert snapshot['system']['packet_info']['board_temp'] == 21.5
+        assert snapshot == controller.get('system')
+
+        controller.set('system/outlets/daq/state', True)
+        assert json.loads(controller.system_json())['system']['outlets']['daq']['state']
+
+        unchanged = controller.system_json()
+        controller.set('event_log/events_after', 0)
+        assert controller.system_json() is unchanged
+
+    def test_emulator_stream(self, serial_fixture):
+        """Test that a stream of packets from the emulator is received."""
+        serial_fixture.emulator.set_rate(100)
+        serial_fixture.emulator.start()
+        serial_fixture.run_until(lambda: serial_fixture.controller.good_packet_counter >= 10)
+        serial_fixture.emulator.stop()
+        assert serial_fixture.controller.good_packet_counter >= 10
+        assert serial_fixture.controller.bad_packet_counter == 0
 
     def test_no_serial_port(self):
         """Test that creating a controller with a non-existent port sets the status message."""
@@ -82,7 +397,7 @@ class TestHxtleakController():
     def test_param_tree_get_single_value(self, serial_fixture):
         """Test that an individual param tree value can be obtained using get function."""
         expected_output = "unknown"
-        dt_odin_ver = serial_fixture.controller.get('status')
+        dt_odin_ver = serial_fixture.controller.get('system/status')
         assert dt_odin_ver['status'] == expected_output
 
     def test_param_tree_missing_value(self, serial_fixture):
@@ -95,11 +410,11 @@ class TestHxtleakController():
     def test_checksum_bad(self, serial_fixture):
         """Test that an invalid checksum sets the status message."""
         serial_fixture.ser_write(serial_fixture.bad_checksum)
-        while serial_fixture.controller.status == 'unknown':
-            pass
-        serial_fixture.controller.background_task_enable = False
+        serial_fixture.run_until(
+            lambda: serial_fixture.controller.status != PacketReceiveState.UNKNOWN
+        )
         output = serial_fixture.controller.status
-        assert output == "Checksum invalid"
+        assert output == PacketReceiveState.INVALID_CHECKSUM
 
     def test_good_packet_counter(self, serial_fixture):
         """
@@ -107,9 +422,9 @@ class TestHxtleakController():
         when a packet with no errors is received.
         """
         serial_fixture.ser_write(serial_fixture.packet)
-        while serial_fixture.controller.status == 'unknown':
-            pass
-        serial_fixture.controller.background_task_enable = False
+        serial_fixture.run_until(
+            lambda: serial_fixture.controller.status != PacketReceiveState.UNKNOWN
+        )
         assert serial_fixture.controller.good_packet_counter == 1
 
     def test_bad_packet_counter(self, serial_fixture):
@@ -118,12 +433,69 @@ class TestHxtleakController():
         if the packet does not meet the requirements.
         """
         serial_fixture.ser_write(serial_fixture.bad_checksum)
-        while serial_fixture.controller.status == 'unknown':
-            pass
-        serial_fixture.controller.background_task_enable = False
+        serial_fixture.run_until(
+            lambda: serial_fixture.controller.status != PacketReceiveState.UNKNOWN
+        )
         assert serial_fixture.controller.bad_packet_counter == 1
 
+    def test_packet_triggers(self, serial_fixture):
+        """Test that the trigger conditions of each emulator scenario are evaluated."""
+        expected_triggers = {
+            'normal': 0,
+            'board_temp': SystemStateTrigger.BOARD_TEMP,
+            'board_humidity': SystemStateTrigger.BOARD_HUMIDITY,
+            'probe_temp': SystemStateTrigger.PROBE_1_TEMP,
+            'leak': SystemStateTrigger.LEAK_DETECTED,
+            'continuity': SystemStateTrigger.LEAK_CONTINUITY,
+        }
+        decoder = serial_fixture.controller.decoder
+        for (scenario, triggers) in expected_triggers.items():
+            serial_fixture.emulator.set_scenario(scenario)
+            packet = decoder.decode(serial_fixture.emulator.scenario_packet())
+            assert serial_fixture.controller.packet_triggers(packet) == triggers
+
+    def test_state_change_reported(self, serial_fixture):
+        """Test that the system state is only evaluated when received packets change it."""
+        serial_fixture.emulator.set_scenario('board_temp')
+        warning_packet = serial_fixture.emulator.scenario_packet()
+        serial_fixture.ser_write(warning_packet * 3)
+        serial_fixture.run_until(lambda: serial_fixture.controller.good_packet_counter == 3)
+
+        assert serial_fixture.controller.triggers == SystemStateTrigger.BOARD_TEMP
+        assert serial_fixture.controller.last_triggers == SystemStateTrigger.BOARD_TEMP
+        assert serial_fixture.controller.last_warning_state
+
+        serial_fixture.controller.logger.set_events_since()
+        messages = [event['message'] for event in serial_fixture.controller.logger.events()]
+        assert messages.count("Warning state detected") == 1
+        assert messages.count("Warning conditions: Board temp") == 1
+
+    def test_fault_shutdown(self, serial_fixture, caplog):
+        """Test that a fault edge turns off and disables the outlets and records the latency."""
+        caplog.set_level(logging.INFO)
+        controller = serial_fixture.controller
+        controller.chiller_outlet.set_state(True)
+
+        controller.fault_detect.read = lambda: 1
+        controller.fault_event_detected(controller.fault_detect.pin)
+        assert all(not outlet.state and not outlet.enabled for outlet in controller.outlets)
+        assert controller.fault_state
+        assert controller.get('system/fault_latency/count')['count'] == 1
+
+        serial_fixture.run_until(lambda: controller.last_fault_state)
+        messages = caplog.messages
+        assert messages.index("Chiller outlet state set to off") < messages.index(
+            "Fault state detected"
+        )
+        assert "DAQ outlet state set to off" in messages
+
+        controller.fault_detect.read = lambda: 0
+        controller.fault_event_detected(controller.fault_detect.pin)
+        assert all(not outlet.state and outlet.enabled for outlet in controller.outlets)
+        serial_fixture.run_until(lambda: not controller.last_fault_state)
+        assert controller.fault_latency.count == 1
+
     def test_cleanup(self, serial_fixture):
         """Test the controller cleanup function."""
         serial_fixture.controller.cleanup()
-        assert not serial_fixture.controller.background_task_enable
+        assert not serial_fixture.controller.receive_task_enable
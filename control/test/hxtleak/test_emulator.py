@@ -0,0 +1,105 @@
+"""Test firmware emulator class.
+
+Tim Nicholls, STFC Detector Systems Software Group
+"""
+import pytest
+import os
+import time
+
+from hxtleak.emulator import HxtleakEmulator
+from hxtleak.framer import HxtleakPacketFramer
+from hxtleak.packet_decoder import HxtleakPacketDecoder
+from hxtleak.util import HxtleakError
+
+
+class EmulatorTestFixture(object):
+    """Container class used in the creation of an emulator fixture."""
+
+    def __init__(self):
+        """Initialise the emulator, packet framer and decoder."""
+        self.emulator = HxtleakEmulator(seed=1)
+        self.decoder = HxtleakPacketDecoder()
+        self.framer = HxtleakPacketFramer(self.decoder.size, self.decoder.EOP_BYTES)
+
+    def decode(self, data):
+        """Frame and decode all packets in the data."""
+        offsets, _ = self.framer.feed(data)
+        return [self.decoder.decode(self.framer.buffer, offset) for offset in offsets]
+
+
+@pytest.fixture()
+def emulator_fixture():
+    """Test fixture used in the testing of emulator behaviour."""
+    emulator_fixture = EmulatorTestFixture()
+    yield emulator_fixture
+    emulator_fixture.emulator.close()
+
+
+class TestEmulator():
+    """Class to test the emulator behaviour."""
+
+    def test_encode_packet(self, emulator_fixture):
+        """Test that an encoded packet decodes to the specified values."""
+        data = emulator_fixture.emulator.encode_packet(board_temp=30.5, leak_detected=True)
+        packet = emulator_fixture.decoder.decode(data)
+        assert packet.checksum_valid
+        assert packet.board_temp == 30.5
+        assert packet.leak_detected
+        assert packet.board_temp_threshold == HxtleakEmulator.BOARD_TEMP_THRESHOLD
+
+    def test_encode_bad_checksum(self, emulator_fixture):
+        """Test that a packet can be encoded with a bad checksum."""
+        data = emulator_fixture.emulator.encode_packet(bad_checksum=True)
+        assert not emulator_fixture.decoder.decode(data).checksum_valid
+
+    @pytest.mark.parametrize("scenario, fault, warning", [
+        ('normal', False, False),
+        ('board_temp', False, True),
+        ('board_humidity', False, True),
+        ('probe_temp', True, False),
+        ('leak', True, False),
+        ('continuity', True, False),
+    ])
+    def test_scenarios(self, emulator_fixture, scenario, fault, warning):
+        """Test that scenario packets have the appropriate fault and warning states."""
+        emulator_fixture.emulator.set_scenario(scenario)
+        packet = emulator_fixture.decoder.decode(emulator_fixture.emulator.scenario_packet())
+        assert packet.fault == fault
+        assert packet.warning == warning
+
+    def test_bad_scenario(self, emulator_fixture):
+        """Test that setting an unknown scenario raises an error."""
+        with pytest.raises(HxtleakError):
+            emulator_fixture.emulator.set_scenario('bad_scenario')
+
+    def test_fault_injection(self, emulator_fixture):
+        """Test that injected faults are counted and resynchronised by the framer."""
+        emulator = emulator_fixture.emulator
+        emulator.bad_checksum_rate = emulator.truncate_rate = emulator.noise_rate = 0.2
+
+        packets = emulator_fixture.decode(b''.join(emulator.next_chunk() for _ in range(200)))
+        bad_packets = len([packet for packet in packets if not packet.checksum_valid])
+
+        assert emulator.bad_checksums and emulator.truncated and emulator.noise_bytes
+        assert len(packets) - bad_packets >= 200 - emulator.bad_checksums - emulator.truncated * 2
+
+    def test_line_rate(self, emulator_fixture):
+        """Test that the packet rate is limited by the line rate."""
+        emulator_fixture.emulator.set_rate(0)
+        assert emulator_fixture.emulator.interval == emulator_fixture.emulator.line_interval
+
+    def test_transmit(self, emulator_fixture):
+        """Test that packets are transmitted to the pty."""
+        emulator = emulator_fixture.emulator
+        emulator.set_rate(100)
+        port_name = emulator.open()
+
+        port = os.open(port_name, os.O_RDONLY | os.O_NONBLOCK)
+        emulator.start()
+        time.sleep(0.1)
+        emulator.stop()
+        data = os.read(port, 4096)
+        os.close(port)
+
+        packets = emulator_fixture.decode(data)
+        assert packets and all(packet.checksum_valid for packet in packets)
@@ -0,0 +1,128 @@
+"""Test event logger class.
+
+Tim Nicholls, STFC Detector Systems Software Group
+"""
+import json
+import logging
+
+import pytest
+
+from hxtleak.event_logger import HxtleakEventLogger
+from hxtleak.util import HxtleakError
+
+
+class EventLoggerTestFixture(object):
+    """Container class used in the creation of an event logger fixture."""
+
+    def __init__(self):
+        """Initialise the event logger."""
+        self.maxlen = 5
+        logger = logging.getLogger('hxtleak_test_event_logger')
+        logger.setLevel(logging.DEBUG)
+        self.event_logger = HxtleakEventLogger(logger, maxlen=self.maxlen)
+
+    def log(self, num_events):
+        """Log the specified number of events, numbered by index."""
+        for idx in range(num_events):
+            self.event_logger.info("Event %d", idx)
+
+
+@pytest.fixture()
+def event_logger_fixture():
+    """Test fixture used in the testing of event logger behaviour."""
+    event_logger_fixture = EventLoggerTestFixture()
+    yield event_logger_fixture
+
+
+class TestEventLogger():
+    """Class to test the event logger behaviour."""
+
+    def test_sequence(self, event_logger_fixture):
+        """Test that logged events are numbered in sequence from 1."""
+        event_logger = event_logger_fixture.event_logger
+        assert event_logger.last_seq() == 0
+        event_logger_fixture.log(3)
+        assert event_logger.last_seq() == 3
+        assert [event.seq for event in event_logger.get_events_after(0)] == [1, 2, 3]
+
+    def test_events_after(self, event_logger_fixture):
+        """Test that the events after a sequence number are returned, up to a limit."""
+        event_logger = event_logger_fixture.event_logger
+        event_logger_fixture.log(4)
+        assert [event.message for event in event_logger.get_events_after(2)] == [
+            "Event 2", "Event 3"
+        ]
+        assert [event.seq for event in event_logger.get_events_after(0, limit=2)] == [1, 2]
+        assert event_logger.get_events_after(4) == []
+
+    def test_events_overwritten(self, event_logger_fixture):
+        """Test that overwritten events are skipped once the ring buffer is full."""
+        event_logger = event_logger_fixture.event_logger
+        event_logger_fixture.log(8)
+        assert [event.seq for event in event_logger.get_events_after(1)] == [4, 5, 6, 7, 8]
+        assert [event.seq for event in event_logger.get_events_after(6)] == [7, 8]
+
+    def test_set_events_after(self, event_logger_fixture):
+        """Test that setting the events after sequence number selects the events returned."""
+        event_logger = event_logger_fixture.event_logger
+        event_logger_fixture.log(3)
+        event_logger.set_events_after(1)
+        assert event_logger.events_after() == 1
+        events = event_logger.events()
+        assert [event['seq'] for event in events] == [2, 3]
+        assert events[0]['level'] == 'INFO'
+        assert events[0]['message'] == "Event 1"
+
+    def test_set_events_after_invalid(self, event_logger_fixture):
+        """Test that setting a non-numeric events after sequence number raises an error."""
+        with pytest.raises(HxtleakError, match="Invalid event sequence number"):
+            event_logger_fixture.event_logger.set_events_after("latest")
+        assert event_logger_fixture.event_logger.events_after() == 0
+
+    def test_invalid_maxlen(self):
+        """Test that an event log length of less than 1 is rejected."""
+        with pytest.raises(HxtleakError, match="Event log length must be at least 1"):
+            HxtleakEventLogger(maxlen=0)
+
+    def test_set_events_since(self, event_logger_fixture):
+        """Test that setting the events since timestamp selects the events returned."""
+        event_logger = event_logger_fixture.event_logger
+        event_logger_fixture.log(2)
+        event_logger.set_events_since()
+        assert len(event_logger.events()) == 2
+
+        last_timestamp = event_logger.last_timestamp()
+        event_logger_fixture.log(1)
+        event_logger.set_events_since(last_timestamp)
+        assert [event['seq'] for event in event_logger.events()] == [3]
+
+    def test_query(self, event_logger_fixture):
+        """Test that querying after a cursor returns the events and the next cursor."""
+        event_logger = event_logger_fixture.event_logger
+        event_logger_fixture.log(3)
+        result = json.loads(event_logger.query(1, limit=1))
+        assert [event['message'] for event in result['events']] == ["Event 1"]
+        assert result['cursor'] == 2
+        assert not result['reset']
+
+        result = json.loads(event_logger.query(result['cursor']))
+        assert [event['seq'] for event in result['events']] == [3]
+        assert json.loads(event_logger.query(3)) == {'events': [], 'cursor': 3, 'reset': False}
+
+    def test_query_reset(self, event_logger_fixture):
+        """Test that querying with a cursor beyond the last event returns all events."""
+        event_logger = event_logger_fixture.event_logger
+        event_logger_fixture.log(2)
+        result = json.loads(event_logger.query(10))
+        assert result['reset']
+        assert [event['seq'] for event in result['events']] == [1, 2]
+        assert result['cursor'] == 2
+
+    def test_serialised_once(self, event_logger_fixture):
+        """Test that events are served from the records serialised when they were logged."""
+        event_logger = event_logger_fixture.event_logger
+        event_logger_fixture.log(2)
+        event_logger.set_events_after(0)
+        events = event_logger.get_events_after(0)
+        assert event_logger.events()[1] is events[1].record
+        assert json.loads(event_logger.query(0))['events'] == event_logger.events()
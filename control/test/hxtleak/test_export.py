@@ -0,0 +1,130 @@
+"""Test history export encoder classes.
+
+Tim Nicholls, STFC Detector Systems Software Group
+"""
+import json
+import struct
+
+import pytest
+
+from hxtleak.emulator import HxtleakEmulator
+from hxtleak.export import HxtleakBinaryEncoder, HxtleakExportEncoder
+from hxtleak.history import HxtleakHistory
+from hxtleak.packet_decoder import HxtleakPacketDecoder
+from hxtleak.util import HxtleakError
+
+
+class ExportTestFixture(object):
+    """Container class used in the creation of an export encoder fixture."""
+
+    def __init__(self):
+        """Initialise the test history."""
+        self.history = HxtleakHistory(10)
+
+        decoder = HxtleakPacketDecoder()
+        emulator = HxtleakEmulator(seed=1)
+        for idx in range(10):
+            self.history.append(1000.0 + idx, decoder.decode(emulator.encode_packet(
+                board_temp=20.0 + idx / 4, warning=bool(idx % 2)
+            )))
+
+    @staticmethod
+    def decode_binary(payload):
+        """Decode a binary payload into its header and a list of record tuples."""
+        assert payload[:8] == HxtleakBinaryEncoder.MAGIC
+        size = struct.unpack_from('<I', payload, 8)[0]
+        header = json.loads(payload[12:12 + size])
+        assert (12 + size) % HxtleakBinaryEncoder.ALIGNMENT == 0
+
+        record = struct.Struct('<' + ''.join(
+            {'<f8': 'd', '<f4': 'f', '|u1': 'B'}[descr] for (_, descr) in header['dtype']
+        ))
+        assert len(payload) == 12 + size + record.size * header['records']
+        return (header, list(record.iter_unpack(payload[12 + size:])))
+
+
+@pytest.fixture()
+def export_fixture():
+    """Test fixture used in the testing of export encoder behaviour."""
+    export_fixture = ExportTestFixture()
+    yield export_fixture
+
+
+class TestExportEncoder():
+    """Class to test the export encoder behaviour."""
+
+    def test_csv(self, export_fixture):
+        """Test that chunks are encoded as CSV rows following the header."""
+        encoder = HxtleakExportEncoder('csv', ['timestamp', 'board_temp', 'flags'])
+        chunk = export_fixture.history.columns_dict(encoder.fields, 0, 2)
+        assert encoder.header() + encoder.encode(chunk) + encoder.finish() == (
+            b'timestamp,board_temp,flags\n1000.000000,20,2\n1001.000000,20.25,10\n'
+        )
+
+    def test_ndjson(self, export_fixture):
+        """Test that chunks are encoded as JSON records, one per line."""
+        encoder = HxtleakExportEncoder('ndjson', ['timestamp', 'board_temp'])
+        chunk = export_fixture.history.columns_dict(encoder.fields, 8)
+        lines = (encoder.header() + encoder.encode(chunk)).splitlines()
+        assert [json.loads(line) for line in lines] == [
+            {'timestamp': 1008.0, 'board_temp': 22.0},
+            {'timestamp': 1009.0, 'board_temp': 22.25},
+        ]
+
+    def test_ndjson_non_finite(self):
+        """Test that non-finite values are encoded as nulls in NDJSON but not in CSV."""
+        chunk = {
+            'timestamp': [1000.0, 1001.0, 1002.0],
+            'board_temp': [float('nan'), 21.5, -float('inf')],
+        }
+        encoder = HxtleakExportEncoder('ndjson', ['timestamp', 'board_temp'])
+        lines = encoder.encode(chunk).splitlines()
+        assert [json.loads(line) for line in lines] == [
+            {'timestamp': 1000.0, 'board_temp': None},
+            {'timestamp': 1001.0, 'board_temp': 21.5},
+            {'timestamp': 1002.0, 'board_temp': None},
+        ]
+        assert chunk['board_temp'][1] == 21.5
+
+        encoder = HxtleakExportEncoder('csv', ['timestamp', 'board_temp'])
+        assert encoder.encode(chunk) == b'1000.000000,nan\n1001.000000,21.5\n1002.000000,-inf\n'
+
+    def test_unknown_format(self):
+        """Test that an unknown export format raises an error."""
+        with pytest.raises(HxtleakError, match="Unknown history export format"):
+            HxtleakExportEncoder('xml', ['timestamp'])
+
+
+class TestBinaryEncoder():
+    """Class to test the binary query result encoder behaviour."""
+
+    def test_raw(self, export_fixture):
+        """Test that a raw query result is encoded as records of each channel."""
+        result = export_fixture.history.query(1002.0, 1004.0, ['board_temp', 'flags'])
+        (header, records) = export_fixture.decode_binary(HxtleakBinaryEncoder.encode(result))
+
+        assert header['method'] == 'raw'
+        assert header['count'] == 3
+        assert header['dtype'] == [['timestamp', '<f8'], ['board_temp', '<f4'], ['flags', '|u1']]
+        assert records == [(1002.0, 20.5, 2), (1003.0, 20.75, 10), (1004.0, 21.0, 2)]
+
+    def test_minmax(self, export_fixture):
+        """Test that a reduced query result is encoded as records of each reduced value."""
+        result = export_fixture.history.query(fields=['board_temp', 'flags'], points=5)
+        (header, records) = export_fixture.decode_binary(HxtleakBinaryEncoder.encode(result))
+
+        assert header['method'] == 'minmax'
+        assert header['records'] == len(result['timestamp'])
+        assert [name for (name, _) in header['dtype']] == [
+            'timestamp', 'board_temp_min', 'board_temp_max', 'board_temp_mean', 'flags'
+        ]
+        assert records[0] == (
+            result['timestamp'][0], 20.0, 20.25, 20.125, result['fields']['flags'][0]
+        )
+
+    def test_empty(self, export_fixture):
+        """Test that an empty query result is encoded as a header without records."""
+        result = export_fixture.history.query(2000.0, 3000.0, ['board_temp'])
+        (header, records) = export_fixture.decode_binary(HxtleakBinaryEncoder.encode(result))
+        assert header['records'] == 0
+        assert records == []
@@ -0,0 +1,120 @@
+"""Test packet framer class.
+
+Tim Nicholls, STFC Detector Systems Software Group
+"""
+import pytest
+import struct
+
+from hxtleak.framer import HxtleakPacketFramer
+from hxtleak.packet_decoder import HxtleakPacketDecoder
+
+
+class FramerTestFixture(object):
+    """Container class used in the creation of a packet framer fixture."""
+
+    def __init__(self):
+        """Initialise the packet framer and test packets."""
+        self.decoder = HxtleakPacketDecoder()
+        self.packet_size = self.decoder.size
+
+        self.packets = [self.make_packet(temp) for temp in (20.0, 21.0, 22.0)]
+        self.framer = HxtleakPacketFramer(
+            self.packet_size, self.decoder.EOP_BYTES, validate=self.decoder.verify_checksum
+        )
+
+    def make_packet(self, board_temp, board_humidity=40.0):
+        """Build a packet with the specified board values and a valid checksum."""
+        values = [30.0, 50.0, 25.0, 25.0, board_temp, board_humidity, 18.0, 18.0,
+                  False, True, False, False, 0]
+        payload = struct.pack('<ffffffff????B', *values)
+        checksum = 0
+        for byte in payload:
+            checksum ^= byte
+        return payload + struct.pack('<BH', checksum, 0xa5a5)
+
+    def framed(self, offsets):
+        """Return the packets at the specified offsets in the framer buffer."""
+        buffer = self.framer.buffer
+        return [bytes(buffer[offset:offset + self.packet_size]) for offset in offsets]
+
+
+@pytest.fixture()
+def framer_fixture():
+    """Test fixture used in the testing of packet framer behaviour."""
+    framer_fixture = FramerTestFixture()
+    yield framer_fixture
+
+
+class TestPacketFramer():
+    """Class to test the packet framer behaviour."""
+
+    def test_single_packet(self, framer_fixture):
+        """Test that a single complete packet is framed."""
+        offsets, discarded = framer_fixture.framer.feed(framer_fixture.packets[0])
+        assert framer_fixture.framed(offsets) == [framer_fixture.packets[0]]
+        assert discarded == 0
+        assert offsets == [0]
+
+    def test_multiple_packets(self, framer_fixture):
+        """Test that all complete packets in a single read are framed."""
+        offsets, discarded = framer_fixture.framer.feed(b''.join(framer_fixture.packets))
+        assert framer_fixture.framed(offsets) == framer_fixture.packets
+        assert discarded == 0
+        assert framer_fixture.framer.packets_framed == len(framer_fixture.packets)
+
+    def test_partial_packet_retained(self, framer_fixture):
+        """Test that a partial packet is retained and completed by the next read."""
+        data = b''.join(framer_fixture.packets[:2])
+        split = framer_fixture.packet_size + 10
+
+        offsets, discarded = framer_fixture.framer.feed(data[:split])
+        assert framer_fixture.framed(offsets) == framer_fixture.packets[:1]
+
+        offsets, discarded = framer_fixture.framer.feed(data[split:])
+        assert framer_fixture.framed(offsets) == framer_fixture.packets[1:2]
+        assert framer_fixture.framer.discarded_bytes == 0
+
+    def test_split_eop_marker(self, framer_fixture):
+        """Test that an end of packet marker split across reads is found."""
+        packet = framer_fixture.packets[0]
+
+        offsets, _ = framer_fixture.framer.feed(packet[:-1])
+        assert framer_fixture.framed(offsets) == []
+
+        offsets, _ = framer_fixture.framer.feed(packet[-1:])
+        assert framer_fixture.framed(offsets) == [packet]
+
+    def test_resync_after_noise(self, framer_fixture):
+        """Test that the framer resynchronises after noise and counts the discarded bytes."""
+        noise = bytes([0x01, 0x02, 0xa5, 0x03, 0x04])
+        offsets, discarded = framer_fixture.framer.feed(noise + framer_fixture.packets[0])
+        assert framer_fixture.framed(offsets) == [framer_fixture.packets[0]]
+        assert discarded == len(noise)
+
+    def test_resync_marker_in_payload(self, framer_fixture):
+        """Test that an end of packet marker within a payload is not framed when resynchronising."""
+        humidity = struct.unpack('<f', b'\xa5\xa5\x20\x42')[0]
+        packets = [framer_fixture.make_packet(20.0, humidity), framer_fixture.packets[1]]
+
+        # Place the marker in the payload of the first packet where it is found by the resync
+        noise = bytes(framer_fixture.packet_size - 20)
+        offsets, discarded = framer_fixture.framer.feed(noise + b''.join(packets))
+        assert framer_fixture.framed(offsets) == packets
+        assert discarded == len(noise)
+
+    def test_truncated_packet_discarded(self, framer_fixture):
+        """Test that a truncated packet is discarded and the following packet framed."""
+        truncated = framer_fixture.packets[0][-10:]
+        offsets, discarded = framer_fixture.framer.feed(truncated + framer_fixture.packets[1])
+        assert framer_fixture.framed(offsets) == [framer_fixture.packets[1]]
+        assert discarded == len(truncated)
+
+    def test_buffer_bounded(self, framer_fixture):
+        """Test that data without an end of packet marker does not grow the buffer unbounded."""
+        noise = bytes(framer_fixture.packet_size * 5)
+        offsets, discarded = framer_fixture.framer.feed(noise)
+        assert framer_fixture.framed(offsets) == []
+        assert len(framer_fixture.framer.buffer) - framer_fixture.framer._consumed == (
+            framer_fixture.packet_size - 1
+        )
+        assert discarded == len(noise) - (framer_fixture.packet_size - 1)
@@ -0,0 +1,217 @@
+"""Test sensor history class.
+
+Tim Nicholls, STFC Detector Systems Software Group
+"""
+import threading
+
+import pytest
+
+from hxtleak.emulator import HxtleakEmulator
+from hxtleak.history import HxtleakHistory, HxtleakHistoryFlags
+from hxtleak.packet_decoder import HxtleakPacketDecoder
+from hxtleak.util import HxtleakError
+
+
+class HistoryTestFixture(object):
+    """Container class used in the creation of a sensor history fixture."""
+
+    def __init__(self):
+        """Initialise the history and test packets."""
+        self.capacity = 5
+        self.history = HxtleakHistory(self.capacity, window=3)
+
+        decoder = HxtleakPacketDecoder()
+        emulator = HxtleakEmulator(seed=1)
+        self.packets = [
+            decoder.decode(emulator.encode_packet(board_temp=float(idx), warning=bool(idx % 2)))
+            for idx in range(8)
+        ]
+
+    def fill(self, num_packets):
+        """Append the specified number of test packets to the history, timestamped by index."""
+        for idx in range(num_packets):
+            self.history.append(1000.0 + idx, self.packets[idx])
+
+
+@pytest.fixture()
+def history_fixture():
+    """Test fixture used in the testing of sensor history behaviour."""
+    history_fixture = HistoryTestFixture()
+    yield history_fixture
+
+
+class TestHistory():
+    """Class to test the sensor history behaviour."""
+
+    def test_empty(self, history_fixture):
+        """Test that an empty history returns no samples."""
+        assert history_fixture.history.count == 0
+        assert history_fixture.history.column('board_temp') == []
+        assert history_fixture.history.tree()['last_timestamp'][0]() is None
+
+    def test_append(self, history_fixture):
+        """Test that appended samples are returned in order."""
+        history_fixture.fill(3)
+        assert history_fixture.history.count == 3
+        assert history_fixture.history.column('board_temp') == [0.0, 1.0, 2.0]
+        assert history_fixture.history.column('timestamp') == [1000.0, 1001.0, 1002.0]
+
+    def test_wraparound(self, history_fixture):
+        """Test that the oldest samples are overwritten once the history is full."""
+        history_fixture.fill(8)
+        assert history_fixture.history.count == history_fixture.capacity
+        assert history_fixture.history.total == 8
+        assert history_fixture.history.column('board_temp') == [3.0, 4.0, 5.0, 6.0, 7.0]
+
+    def test_extend(self, history_fixture):
+        """Test that samples are appended from columns, wrapping around the ring."""
+        history_fixture.fill(3)
+        source = HxtleakHistory(8)
+        for idx in range(3, 8):
+            source.append(1000.0 + idx, history_fixture.packets[idx])
+
+        history_fixture.history.extend(
+            {name: source._column_array(name) for name in HxtleakHistory.FIELD_NAMES}
+        )
+        assert history_fixture.history.count == history_fixture.capacity
+        assert history_fixture.history.total == 8
+        assert history_fixture.history.column('board_temp') == [3.0, 4.0, 5.0, 6.0, 7.0]
+        assert history_fixture.history.column('flags') == source.column('flags')
+
+    def test_column_range(self, history_fixture):
+        """Test that ranges of samples spanning the ring wraparound are returned."""
+        history_fixture.fill(7)
+        assert history_fixture.history.column('board_temp', 1, 4) == [3.0, 4.0, 5.0]
+        assert history_fixture.history.column('board_temp', -2) == [5.0, 6.0]
+        assert history_fixture.history.column('board_temp', 4, 2) == []
+
+    def test_flags(self, history_fixture):
+        """Test that the packet flags are packed into the flags channel."""
+        history_fixture.fill(2)
+        flags = history_fixture.history.column('flags')
+        assert flags[0] == HxtleakHistoryFlags.LEAK_CONTINUITY
+        assert flags[1] == HxtleakHistoryFlags.LEAK_CONTINUITY | HxtleakHistoryFlags.WARNING
+
+    def test_recent(self, history_fixture):
+        """Test that the recent parameter returns the most recent window of samples."""
+        history_fixture.fill(6)
+        tree = history_fixture.history.tree()
+        recent = tree['recent'][0]()
+        assert set(recent) == set(HxtleakHistory.FIELD_NAMES)
+        assert recent['board_temp'] == [3.0, 4.0, 5.0]
+
+        tree['window'][1](10)
+        assert tree['recent'][0]()['board_temp'] == [1.0, 2.0, 3.0, 4.0, 5.0]
+
+    def test_unknown_field(self, history_fixture):
+        """Test that requesting an unknown channel raises an error."""
+        with pytest.raises(HxtleakError, match="Unknown history field"):
+            history_fixture.history.column('missing')
+
+    def test_memory_size(self, history_fixture):
+        """Test that the memory size reflects the preallocated channel arrays."""
+        assert history_fixture.history.memory_size() == history_fixture.capacity * (8 + 8 * 4 + 2)
+
+    def test_query_raw(self, history_fixture):
+        """Test that a query not exceeding the point count returns unreduced samples."""
+        history_fixture.fill(5)
+        result = history_fixture.history.query(1001.0, 1003.0, ['board_temp'], points=10)
+        assert result['method'] == 'raw'
+        assert result['count'] == 3
+        assert result['timestamp'] == [1001.0, 1002.0, 1003.0]
+        assert result['fields'] == {'board_temp': [1.0, 2.0, 3.0]}
+
+    def test_query_minmax(self, history_fixture):
+        """Test that a minmax query reduces samples to the aggregates of time buckets."""
+        history = HxtleakHistory(100)
+        for idx in range(100):
+            history.append(float(idx), history_fixture.packets[idx % 8])
+
+        result = history.query(fields=['board_temp', 'flags'], points=4)
+        assert result['method'] == 'minmax'
+        assert result['count'] == 100
+        assert len(result['timestamp']) == 4
+        assert result['timestamp'][0] == 0.0
+        assert result['fields']['board_temp']['min'] == [0.0] * 4
+        assert result['fields']['board_temp']['max'] == [7.0] * 4
+        assert result['fields']['flags'] == [
+            HxtleakHistoryFlags.LEAK_CONTINUITY | HxtleakHistoryFlags.WARNING
+        ] * 4
+
+    def test_query_lttb(self, history_fixture):
+        """Test that an LTTB query selects the requested number of samples, keeping peaks."""
+        history = HxtleakHistory(100)
+        for idx in range(100):
+            history.append(float(idx), history_fixture.packets[7 if idx == 50 else 0])
+
+        result = history.query(fields=['board_temp'], points=10, method='lttb')
+        selected = result['fields']['board_temp']
+        assert len(selected['value']) == 10
+        assert selected['timestamp'][0] == 0.0
+        assert selected['timestamp'][-1] == 99.0
+        assert 50.0 in selected['timestamp']
+        assert max(selected['value']) == 7.0
+
+    def test_query_threads(self, history_fixture):
+        """Test that queries from another thread see consistent samples while appending."""
+        history = HxtleakHistory(50)
+        packets = history_fixture.packets
+
+        def append():
+            for idx in range(20000):
+                history.append(float(idx % 8), packets[idx % 8])
+
+        thread = threading.Thread(target=append)
+        thread.start()
+        while thread.is_alive():
+            result = history.query(fields=['board_temp'], method='raw')
+            assert result['fields']['board_temp'] == result['timestamp']
+        thread.join()
+
+    def test_query_errors(self, history_fixture):
+        """Test that invalid queries raise errors."""
+        with pytest.raises(HxtleakError, match="Unknown history field"):
+            history_fixture.history.query(fields=['missing'])
+        with pytest.raises(HxtleakError, match="Unknown history query method"):
+            history_fixture.history.query(method='missing')
+        with pytest.raises(HxtleakError, match="at least 3 points"):
+            history_fixture.history.query(points=2)
+
+    def test_export(self, history_fixture):
+        """Test that a time range of the history is exported in chunks."""
+        history_fixture.fill(7)
+        chunks = list(history_fixture.history.export(1003.0, 1005.0, ['board_temp'], 2))
+        assert chunks == [
+            {'timestamp': [1003.0, 1004.0], 'board_temp': [3.0, 4.0]},
+            {'timestamp': [1005.0], 'board_temp': [5.0]},
+        ]
+
+    def test_export_overwritten(self, history_fixture):
+        """Test that samples overwritten during an export are skipped."""
+        history_fixture.fill(5)
+        chunks = history_fixture.history.export(fields=['board_temp'], chunk_records=2)
+        assert next(chunks)['board_temp'] == [0.0, 1.0]
+        for idx in range(5, 8):
+            history_fixture.history.append(1000.0 + idx, history_fixture.packets[idx])
+        assert [chunk['board_temp'] for chunk in chunks] == [[3.0, 4.0]]
+
+    def test_export_threads(self, history_fixture):
+        """Test that exported chunks are consistent while appending from another thread."""
+        history = HxtleakHistory(50)
+        packets = history_fixture.packets
+
+        def append():
+            for idx in range(20000):
+                history.append(float(idx % 8), packets[idx % 8])
+
+        thread = threading.Thread(target=append)
+        thread.start()
+        while thread.is_alive():
+            for chunk in history.export(fields=['board_temp'], chunk_records=10):
+                assert chunk['board_temp'] == chunk['timestamp']
+        thread.join()
+
+    def test_export_unknown_field(self, history_fixture):
+        """Test that exporting an unknown field raises an error."""
+        with pytest.raises(HxtleakError, match="Unknown history field"):
+            history_fixture.history.export(fields=['missing'])
@@ -0,0 +1,60 @@
+"""Test latency histogram class.
+
+Tim Nicholls, STFC Detector Systems Software Group
+"""
+import pytest
+
+from hxtleak.latency import HxtleakLatencyHistogram
+
+
+class LatencyHistogramTestFixture(object):
+    """Container class used in the creation of a latency histogram fixture."""
+
+    def __init__(self):
+        """Initialise the latency histogram."""
+        self.histogram = HxtleakLatencyHistogram(
+            min_latency=1e-6, max_latency=1e-3, buckets_per_decade=1
+        )
+
+
+@pytest.fixture()
+def histogram_fixture():
+    """Test fixture used in the testing of latency histogram behaviour."""
+    histogram_fixture = LatencyHistogramTestFixture()
+    yield histogram_fixture
+
+
+class TestLatencyHistogram():
+    """Class to test the latency histogram behaviour."""
+
+    def test_bounds(self, histogram_fixture):
+        """Test that the bucket bounds are spaced logarithmically in microseconds."""
+        assert histogram_fixture.histogram.bounds == [1.0, 10.0, 100.0, 1000.0]
+        assert len(histogram_fixture.histogram.counts) == 5
+
+    def test_record(self, histogram_fixture):
+        """Test that recorded latencies are counted in the correct buckets."""
+        histogram = histogram_fixture.histogram
+        for latency in (0.5e-6, 5e-6, 50e-6, 10e-6, 2.0):
+            histogram.record(latency)
+
+        assert histogram.counts == [1, 2, 1, 0, 1]
+        assert histogram.count == 5
+        assert histogram.min == pytest.approx(0.5)
+        assert histogram.max == pytest.approx(2e6)
+        assert histogram.last == pytest.approx(2e6)
+        assert histogram.mean() == pytest.approx((0.5 + 5 + 50 + 10 + 2e6) / 5)
+
+    def test_empty(self, histogram_fixture):
+        """Test that an empty histogram reports no latencies."""
+        assert histogram_fixture.histogram.count == 0
+        assert histogram_fixture.histogram.mean() is None
+        assert histogram_fixture.histogram.min is None
+
+    def test_reset(self, histogram_fixture):
+        """Test that the histogram can be reset via its tree setter."""
+        histogram = histogram_fixture.histogram
+        histogram.record(1e-5)
+        histogram.tree()['reset'][1](True)
+        assert histogram.count == 0
+        assert sum(histogram.counts) == 0
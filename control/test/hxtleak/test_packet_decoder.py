@@ -3,7 +3,7 @@
 James Foster
 """
 import pytest
-from hxtleak.packet_decoder import HxtleakPacketDecoder
+from hxtleak.packet_decoder import HxtleakPacketDecoder, HxtleakPacket
 import struct
 
 
@@ -13,10 +13,19 @@ class DecoderTestFixture(object):
     def __init__(self):
         """Initialise the packet decoder and test packets."""
         self.good_packet = struct.pack('<HH?BH', 1, 2, 0, 3, 42405)
-        self.bad_checksum = struct.pack('<HH?BH', 1, 2, 0, 0, 42405)
         self.bad_eop = struct.pack('<HH?BH', 1, 2, 0, 3, 0)
         self.bad_large_packet = struct.pack('<HH?BHH', 1, 2, 0, 3, 4, 42405)
 
+        payload = struct.pack(
+            '<ffffffff????B', 30.0, 50.0, 25.0, 25.0, 21.5, 40.0, 18.0, 18.0,
+            False, True, False, True, 0x10
+        )
+        checksum = 0
+        for byte in payload:
+            checksum ^= byte
+        self.data_packet = payload + struct.pack('<BH', checksum, 42405)
+        self.bad_data_packet = payload + struct.pack('<BH', checksum ^ 0xff, 42405)
+
         self.decoder = HxtleakPacketDecoder()
 
 
@@ -31,10 +40,16 @@ class TestPacketDecoder():
     """Class to test the packet decoder behaviour."""
 
     def test_unpack(self, decoder_fixture):
-        """Test that a packet is unpacked correctly."""
-        decoder_fixture.decoder.unpack(decoder_fixture.good_packet)
-        assert decoder_fixture.decoder.t1 == 1
-        assert decoder_fixture.decoder.t2 == 2
+        """Test that a packet is decoded into a snapshot of the unpacked values."""
+        packet = decoder_fixture.decoder.decode(decoder_fixture.data_packet)
+        assert isinstance(packet, HxtleakPacket)
+        assert packet.board_temp_threshold == 30.0
+        assert packet.board_humidity_threshold == 50.0
+        assert packet.board_temp == 21.5
+        assert packet.probe_temp_1 == 18.0
+        assert not packet.leak_detected
+        assert packet.sensor_status == 0x10
+        assert packet.eop == 42405
 
     def test_packet_complete(self, decoder_fixture):
         """Test that an appropriate packet meets the requirements of a completed packet."""
@@ -50,32 +65,97 @@ class TestPacketDecoder():
 
     def test_checksum(self, decoder_fixture):
         """Test that the checksum validation method validates an appropriate packet."""
-        decoder_fixture.decoder.unpack(decoder_fixture.good_packet)
-        decoder_fixture.decoder.checkSumCheck(decoder_fixture.good_packet)
-        assert decoder_fixture.decoder.csumValid
+        decoder = decoder_fixture.decoder
+        packet = decoder_fixture.data_packet
+        assert decoder.calc_checksum(packet) == packet[decoder.size - 3]
+        assert decoder.verify_checksum(packet)
+
+        buffer = b'noise' + packet
+        assert decoder.calc_checksum(buffer, 5) == packet[decoder.size - 3]
+        assert decoder.verify_checksum(buffer, 5)
 
     def test_checksum_bad(self, decoder_fixture):
         """Test that the checksum validation method does not validate an inappropriate packet."""
-        decoder_fixture.decoder.unpack(decoder_fixture.bad_checksum)
-        decoder_fixture.decoder.checkSumCheck(decoder_fixture.bad_checksum)
-        assert not decoder_fixture.decoder.csumValid
+        decoder = decoder_fixture.decoder
+        packet = decoder_fixture.bad_data_packet
+        assert decoder.calc_checksum(packet) != packet[decoder.size - 3]
+        assert not decoder.verify_checksum(packet)
 
     def test_make_dict(self, decoder_fixture):
-        """Test that an unpacked packet is returned as a dictionary using the method."""
-        decoder_fixture.decoder.unpack(decoder_fixture.good_packet)
-        decoder_dict = decoder_fixture.decoder.make_dict()
+        """Test that a decoded packet is returned as a dictionary."""
+        packet_dict = decoder_fixture.decoder.decode(decoder_fixture.data_packet).as_dict()
 
-        assert decoder_dict["t1"] == 1
-        assert decoder_dict["t2"] == 2
+        assert packet_dict["board_temp"] == 21.5
+        assert packet_dict["cont"]
+        assert packet_dict["warning"]
+        assert packet_dict["sensor_status"] == 0x10
+        assert packet_dict["eop"] == "0xa5a5"
 
     def test_string_format(self, decoder_fixture):
-        """Test that an unpacked packet is returned as a string."""
-        decoder_fixture.decoder.unpack(decoder_fixture.good_packet)
-        decoder_string = str(decoder_fixture.decoder)
+        """Test that a decoded packet is returned as a string."""
+        packet_string = str(decoder_fixture.decoder.decode(decoder_fixture.data_packet))
 
-        assert decoder_string == "t1=1 t2=2 fault=False checksum=3 eop=0xa5a5"
+        assert "board_temp=21.50 board_humidity=40.00" in packet_string
+        assert "leak_detected=False leak_continuity=True fault=False warning=True" in packet_string
+        assert "eop=0xa5a5" in packet_string
 
     def test_large_packet_size(self, decoder_fixture):
         """Test that a packet which is too large raises an error."""
         with pytest.raises(struct.error):
             decoder_fixture.decoder.unpack(decoder_fixture.bad_large_packet)
+
+    def test_decode(self, decoder_fixture):
+        """Test that a packet is decoded into a snapshot with the correct values."""
+        packet = decoder_fixture.decoder.decode(decoder_fixture.data_packet, timestamp=1.0)
+        assert isinstance(packet, HxtleakPacket)
+        assert packet.board_temp == 21.5
+        assert packet.leak_continuity
+        assert packet.warning
+        assert packet.checksum_valid
+        assert packet.raw == decoder_fixture.data_packet
+        assert packet.timestamp == 1.0
+        assert packet.as_dict()["eop"] == "0xa5a5"
+
+    def test_decode_bad_checksum(self, decoder_fixture):
+        """Test that a decoded packet with a bad checksum is marked as invalid."""
+        packet = decoder_fixture.decoder.decode(decoder_fixture.bad_data_packet)
+        assert not packet.checksum_valid
+
+    def test_decode_sequence(self, decoder_fixture):
+        """Test that decoded packets are assigned increasing sequence numbers."""
+        first = decoder_fixture.decoder.decode(decoder_fixture.data_packet)
+        second = decoder_fixture.decoder.decode(decoder_fixture.data_packet)
+        assert second.seq == first.seq + 1
+
+    def test_decode_status_bits(self, decoder_fixture):
+        """Test that the sensor status bits of a decoded packet can be tested."""
+        packet = decoder_fixture.decoder.decode(decoder_fixture.data_packet)
+        assert packet.status_board_temperature_warning()
+        assert not packet.status_board_humidity_warning()
+
+    def test_packet_immutable(self, decoder_fixture):
+        """Test that a decoded packet snapshot cannot be modified."""
+        packet = decoder_fixture.decoder.decode(decoder_fixture.data_packet)
+        with pytest.raises(AttributeError):
+            packet.board_temp = 0.0
+
+    def test_decode_offset(self, decoder_fixture):
+        """Test that a packet is decoded from an offset in a larger buffer."""
+        buffer = bytearray(b'noise') + decoder_fixture.data_packet
+        packet = decoder_fixture.decoder.decode(buffer, 5)
+        assert packet.board_temp == 21.5
+        assert packet.checksum_valid
+        assert packet.raw == decoder_fixture.data_packet
+
+    def test_verify_checksums_contiguous(self, decoder_fixture):
+        """Test that checksums of a contiguous batch of packets are verified."""
+        buffer = decoder_fixture.data_packet * 2 + decoder_fixture.bad_data_packet
+        results = decoder_fixture.decoder.verify_checksums(buffer)
+        assert results == [True, True, False]
+
+    def test_verify_checksums_offsets(self, decoder_fixture):
+        """Test that checksums of a batch of packets at specified offsets are verified."""
+        buffer = b'x' + decoder_fixture.bad_data_packet + b'xx' + decoder_fixture.data_packet
+        offsets = [1, 3 + decoder_fixture.decoder.size]
+        results = decoder_fixture.decoder.verify_checksums(buffer, offsets)
+        assert results == [False, True]
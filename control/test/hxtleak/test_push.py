@@ -0,0 +1,111 @@
+"""Test state update push publisher class.
+
+Tim Nicholls, STFC Detector Systems Software Group
+"""
+import asyncio
+import threading
+
+import pytest
+from tornado.ioloop import IOLoop
+
+from hxtleak.push import HxtleakPushPublisher
+
+
+class DummySubscriber(object):
+    """Dummy subscriber recording the messages written to it."""
+
+    def __init__(self, closed=False):
+        """Initialise the subscriber."""
+        self.messages = []
+        self.closed = closed
+
+    def write_message(self, message):
+        """Record a message written to the subscriber, raising an error if closed."""
+        if self.closed:
+            raise RuntimeError("Subscriber closed")
+        self.messages.append(message)
+
+
+class PushPublisherTestFixture(object):
+    """Container class used in the creation of a push publisher fixture."""
+
+    def __init__(self):
+        """Initialise the publisher with a topic counting the messages built."""
+        self.builds = 0
+        self.publisher = HxtleakPushPublisher(IOLoop.current())
+        self.publisher.add_topic('state', self.build)
+
+    def build(self):
+        """Build a message for the state topic."""
+        self.builds += 1
+        return 'state {}'.format(self.builds)
+
+    def run_callbacks(self):
+        """Run the IOLoop until the scheduled callbacks, and those they schedule, have been run."""
+        async def wait():
+            for _ in range(3):
+                await asyncio.sleep(0)
+
+        IOLoop.current().run_sync(wait)
+
+
+@pytest.fixture()
+def push_fixture():
+    """Test fixture used in testing push publisher behaviour."""
+    push_fixture = PushPublisherTestFixture()
+    yield push_fixture
+
+
+class TestPushPublisher():
+    """Class to test the push publisher behaviour."""
+
+    def test_no_subscribers(self, push_fixture):
+        """Test that no messages are built while there are no subscribers."""
+        push_fixture.publisher.notify('state')
+        push_fixture.run_callbacks()
+        assert push_fixture.builds == 0
+
+    def test_coalesced(self, push_fixture):
+        """Test that notifications are coalesced into a single message sent to all subscribers."""
+        subscribers = [DummySubscriber(), DummySubscriber()]
+        for subscriber in subscribers:
+            push_fixture.publisher.subscribe(subscriber)
+
+        for _ in range(3):
+            push_fixture.publisher.notify('state')
+        push_fixture.run_callbacks()
+
+        assert push_fixture.builds == 1
+        assert [subscriber.messages for subscriber in subscribers] == [['state 1'], ['state 1']]
+        assert push_fixture.publisher.messages_sent == 2
+
+        push_fixture.publisher.notify('state')
+        push_fixture.run_callbacks()
+        assert subscribers[0].messages == ['state 1', 'state 2']
+
+    def test_notify_threads(self, push_fixture):
+        """Test that notifications from other threads are coalesced on the IOLoop."""
+        subscriber = DummySubscriber()
+        push_fixture.publisher.subscribe(subscriber)
+
+        def notify():
+            for _ in range(100):
+                push_fixture.publisher.notify('state')
+
+        threads = [threading.Thread(target=notify) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        push_fixture.run_callbacks()
+
+        assert push_fixture.builds == 1
+        assert subscriber.messages == ['state 1']
+
+    def test_failed_subscriber(self, push_fixture):
+        """Test that a subscriber which fails to be sent a message is unsubscribed."""
+        subscriber = DummySubscriber(closed=True)
+        push_fixture.publisher.subscribe(subscriber)
+        push_fixture.publisher.notify('state')
+        push_fixture.run_callbacks()
+        assert subscriber not in push_fixture.publisher.subscribers
@@ -0,0 +1,207 @@
+"""Test rollup tier classes.
+
+Tim Nicholls, STFC Detector Systems Software Group
+"""
+import pytest
+import os
+
+from hxtleak.emulator import HxtleakEmulator
+from hxtleak.history import HxtleakHistory, HxtleakHistoryFlags
+from hxtleak.packet_decoder import HxtleakPacketDecoder
+from hxtleak.rollup import HxtleakRollups
+from hxtleak.util import HxtleakError
+
+
+class RollupTestFixture(object):
+    """Container class used in the creation of a rollup fixture."""
+
+    def __init__(self):
+        """Initialise the rollups and test packets."""
+        self.rollups = HxtleakRollups(tiers=(('10s', 10, 4), ('1s', 1, 8)))
+        self.decoder = HxtleakPacketDecoder()
+        self.emulator = HxtleakEmulator(seed=1)
+
+    def packet(self, board_temp, **kwargs):
+        """Return a decoded packet with the specified board temperature and values."""
+        return self.decoder.decode(self.emulator.encode_packet(board_temp=board_temp, **kwargs))
+
+    def fill(self, num_samples, interval=0.5):
+        """Append samples with board temperature equal to their timestamp."""
+        for idx in range(num_samples):
+            timestamp = idx * interval
+            self.rollups.append(timestamp, self.packet(float(timestamp)))
+
+
+@pytest.fixture()
+def rollup_fixture():
+    """Test fixture used in the testing of rollup behaviour."""
+    rollup_fixture = RollupTestFixture()
+    yield rollup_fixture
+
+
+class TestRollups():
+    """Class to test the rollup tier behaviour."""
+
+    def test_tiers_sorted(self, rollup_fixture):
+        """Test that tiers are ordered by increasing interval."""
+        assert [tier.name for tier in rollup_fixture.rollups.tiers] == ['1s', '10s']
+
+    def test_bucket_aggregates(self, rollup_fixture):
+        """Test that samples are aggregated into buckets of the tier interval."""
+        rollup_fixture.fill(4)
+        tier = rollup_fixture.rollups.tiers[0]
+        assert tier.count == 2
+        assert tier._range(tier.starts).tolist() == [0.0, 1.0]
+        assert tier._range(tier.counts).tolist() == [2, 2]
+        assert tier._range(tier.mins[0]).tolist() == [0.0, 1.0]
+        assert tier._range(tier.maxs[0]).tolist() == [0.5, 1.5]
+        assert tier._range(tier.sums[0]).tolist() == [0.5, 2.5]
+        assert tier._range(tier.sumsqs[0]).tolist() == [0.25, 3.25]
+
+    def test_wraparound(self, rollup_fixture):
+        """Test that the oldest buckets are overwritten once a tier is full."""
+        rollup_fixture.fill(24)
+        tier = rollup_fixture.rollups.tiers[0]
+        assert tier.count == 8
+        assert tier.first_timestamp() == 4.0
+        assert rollup_fixture.rollups.tiers[1].count == 2
+
+    def test_bit_fields(self, rollup_fixture):
+        """Test that bit-valued channels are aggregated by bitwise OR."""
+        rollups = rollup_fixture.rollups
+        rollups.append(0.0, rollup_fixture.packet(20.0))
+        rollups.append(0.5, rollup_fixture.packet(20.0, leak_detected=True, sensor_status=0x40))
+        rollups.append(1.0, rollup_fixture.packet(20.0))
+
+        result = rollups.tiers[0].query(0.0, 2.0, ['flags', 'sensor_status'], 2)
+        assert result['fields']['flags'] == [
+            HxtleakHistoryFlags.LEAK_CONTINUITY | HxtleakHistoryFlags.LEAK_DETECTED,
+            HxtleakHistoryFlags.LEAK_CONTINUITY,
+        ]
+        assert result['fields']['sensor_status'] == [0x40, 0]
+
+    def test_threshold_fields(self, rollup_fixture):
+        """Test that the threshold channels are aggregated along with the sensor channels."""
+        rollup_fixture.fill(2)
+        result = rollup_fixture.rollups.query(0.0, 1.0, ['probe_temp_2_threshold'], 1)
+        assert result['fields']['probe_temp_2_threshold']['min'] == [
+            HxtleakEmulator.PROBE_TEMP_THRESHOLD
+        ]
+        assert result['fields']['probe_temp_2_threshold']['mean'] == [
+            HxtleakEmulator.PROBE_TEMP_THRESHOLD
+        ]
+
+    def test_save_load(self, rollup_fixture, tmp_path):
+        """Test that the tiers are restored from a saved file, skipping samples already held."""
+        file_name = str(tmp_path / HxtleakRollups.FILE_NAME)
+        rollup_fixture.fill(24)
+        rollup_fixture.rollups.save(file_name)
+        assert not os.path.exists(file_name + '.tmp')
+
+        rollups = HxtleakRollups(tiers=(('10s', 10, 4), ('1s', 1, 8)))
+        assert rollups.load(file_name) == 2
+        assert rollups.last_timestamp() == 11.5
+        for (tier, expected) in zip(rollups.tiers, rollup_fixture.rollups.tiers):
+            assert tier.count == expected.count
+            assert tier.query(0.0, 12.0, ['board_temp'], 12) == expected.query(
+                0.0, 12.0, ['board_temp'], 12
+            )
+
+        # Samples already aggregated before the tiers were saved are not merged again
+        history = HxtleakHistory(8)
+        for idx in range(20, 28):
+            history.append(idx * 0.5, rollup_fixture.packet(idx * 0.5))
+            if idx >= 24:
+                rollup_fixture.rollups.append(idx * 0.5, rollup_fixture.packet(idx * 0.5))
+        rollups.extend({name: history._column_array(name) for name in HxtleakHistory.FIELD_NAMES})
+        assert rollups.tiers[1].query(0.0, 14.0, ['board_temp'], 2) == (
+            rollup_fixture.rollups.tiers[1].query(0.0, 14.0, ['board_temp'], 2)
+        )
+
+    def test_load_mismatched_tier(self, rollup_fixture, tmp_path):
+        """Test that only saved tiers matching a tier's interval and capacity are restored."""
+        file_name = str(tmp_path / HxtleakRollups.FILE_NAME)
+        rollup_fixture.fill(24)
+        rollup_fixture.rollups.save(file_name)
+
+        rollups = HxtleakRollups(tiers=(('10s', 10, 4), ('1s', 1, 16)))
+        assert rollups.load(file_name) == 1
+        assert rollups.tiers[0].count == 0
+        assert rollups.tiers[1].count == 2
+        assert rollups.last_timestamp() is None
+
+    def test_load_missing(self, rollup_fixture, tmp_path):
+        """Test that loading a missing file restores no tiers."""
+        assert rollup_fixture.rollups.load(str(tmp_path / HxtleakRollups.FILE_NAME)) == 0
+
+    def test_load_invalid(self, rollup_fixture, tmp_path):
+        """Test that loading an invalid or truncated file raises an error."""
+        file_name = str(tmp_path / HxtleakRollups.FILE_NAME)
+        with open(file_name, 'wb') as rollup_file:
+            rollup_file.write(b'invalid')
+        with pytest.raises(HxtleakError, match="not a valid rollup file"):
+            rollup_fixture.rollups.load(file_name)
+
+        rollup_fixture.fill(4)
+        rollup_fixture.rollups.save(file_name)
+        with open(file_name, 'r+b') as rollup_file:
+            rollup_file.truncate(100)
+        with pytest.raises(HxtleakError, match="truncated"):
+            rollup_fixture.rollups.load(file_name)
+
+    def test_extend(self, rollup_fixture):
+        """Test that extending the tiers from columns matches appending the samples."""
+        history = HxtleakHistory(24)
+        for idx in range(24):
+            timestamp = idx * 0.5
+            packet = rollup_fixture.packet(float(idx % 7), leak_detected=(idx == 5))
+            history.append(timestamp, packet)
+            rollup_fixture.rollups.append(timestamp, packet)
+
+        rollups = HxtleakRollups(tiers=(('10s', 10, 4), ('1s', 1, 8)))
+        rollups.extend({name: history._column_array(name) for name in HxtleakHistory.FIELD_NAMES})
+        fields = rollups.FIELDS + rollups.BIT_FIELDS
+        for (tier, expected) in zip(rollups.tiers, rollup_fixture.rollups.tiers):
+            assert tier.query(0.0, 12.0, fields, 12) == expected.query(0.0, 12.0, fields, 12)
+
+    def test_query_merges_buckets(self, rollup_fixture):
+        """Test that a query merges buckets into the requested number of points."""
+        rollup_fixture.fill(8)
+        result = rollup_fixture.rollups.tiers[0].query(0.0, 3.5, ['board_temp'], 2)
+        assert result['count'] == 8
+        assert result['tier'] == '1s'
+        assert result['timestamp'] == [0.0, 1.5]
+        assert result['fields']['board_temp']['min'] == [0.0, 2.0]
+        assert result['fields']['board_temp']['max'] == [1.5, 3.5]
+        assert result['fields']['board_temp']['mean'] == pytest.approx([0.75, 2.75])
+        assert result['fields']['board_temp']['std'][0] == pytest.approx(0.3125 ** 0.5)
+
+    def test_query_tier_selection(self, rollup_fixture):
+        """Test that the coarsest tier not exceeding the point spacing is queried."""
+        rollup_fixture.fill(80)
+        rollups = rollup_fixture.rollups
+        assert rollups.query(0.0, 40.0, ['board_temp'], 2)['tier'] == '10s'
+        assert rollups.query(32.0, 40.0, ['board_temp'], 4)['tier'] == '1s'
+        assert rollups.query(32.0, 40.0, ['board_temp'], 100) is None
+        assert rollups.query(0.0, 40.0, ['unknown'], 2) is None
+
+    def test_query_before_retention(self, rollup_fixture):
+        """Test that a tier is not queried from before the start of the buckets it retains."""
+        rollup_fixture.fill(80)
+        rollups = rollup_fixture.rollups
+        assert rollups.tiers[0].first_timestamp() == 32.0
+
+        # The 1s tier matches the point spacing but no longer retains the start of the range
+        assert rollups.query(0.0, 40.0, ['board_temp'], 10) is None
+
+        # A coarser tier is queried instead if it holds samples older than the specified time
+        result = rollups.query(0.0, 40.0, ['board_temp'], 10, older_than=30.0)
+        assert result['tier'] == '10s'
+        assert result['count'] == 80
+        assert result['timestamp'][0] == 0.0
+        assert rollups.query(0.0, 40.0, ['board_temp'], 10, older_than=5.0) is None
+
+    def test_default_memory(self):
+        """Test that the default tiers fit in bounded memory."""
+        rollups = HxtleakRollups()
+        assert sum(tier.memory_size() for tier in rollups.tiers) < 12 * 1024 * 1024
@@ -0,0 +1,200 @@
+"""Test persistent history store class.
+
+Tim Nicholls, STFC Detector Systems Software Group
+"""
+import pytest
+import os
+import time
+
+from hxtleak.emulator import HxtleakEmulator
+from hxtleak.history import HxtleakHistory
+from hxtleak.packet_decoder import HxtleakPacketDecoder
+from hxtleak.store import HxtleakHistoryStore, HxtleakStoreFormat, store_files
+from hxtleak.util import HxtleakError
+
+
+class StoreTestFixture(object):
+    """Container class used in the creation of a history store fixture."""
+
+    def __init__(self, path):
+        """Initialise the history store and test packets."""
+        self.path = str(path)
+        self.decoder = HxtleakPacketDecoder()
+        emulator = HxtleakEmulator(seed=1)
+        self.packets = [
+            emulator.encode_packet(board_temp=float(idx)) for idx in range(10)
+        ]
+        self.store = self.create_store()
+        self.start = float(int(time.time()))
+
+    def create_store(self, **kwargs):
+        """Create a history store in the fixture path."""
+        options = {'segment_records': 4, 'flush_interval': 0.01, 'max_query_records': 8}
+        options.update(kwargs)
+        return HxtleakHistoryStore(self.path, self.decoder, **options)
+
+    def fill(self, num_packets, start=None):
+        """Record packets in the store, timestamped by index, and wait for them to be written."""
+        start = self.start if start is None else start
+        self.store.set_enabled(True)
+        for idx in range(num_packets):
+            self.store.record(start + idx, self.packets[idx])
+        self.store.set_enabled(False)
+
+
+@pytest.fixture()
+def store_fixture(tmp_path):
+    """Test fixture used in the testing of history store behaviour."""
+    store_fixture = StoreTestFixture(tmp_path)
+    yield store_fixture
+    store_fixture.store.set_enabled(False)
+
+
+class TestHistoryStore():
+    """Class to test the history store behaviour."""
+
+    def test_record_disabled(self, store_fixture):
+        """Test that packets are not recorded when the store is disabled."""
+        t0 = store_fixture.start
+        store_fixture.store.record(t0, store_fixture.packets[0])
+        assert len(store_fixture.store._records) == 0
+
+    def test_read(self, store_fixture):
+        """Test that recorded packets are read back decoded in order."""
+        t0 = store_fixture.start
+        store_fixture.fill(3)
+        records = list(store_fixture.store.read())
+        assert [timestamp for (timestamp, _) in records] == [t0, t0 + 1.0, t0 + 2.0]
+        assert [packet.board_temp for (_, packet) in records] == [0.0, 1.0, 2.0]
+        assert all(packet.checksum_valid for (_, packet) in records)
+
+    def test_segment_rotation(self, store_fixture):
+        """Test that segments are rotated when full and the header count is written."""
+        store_fixture.fill(10)
+        file_names = store_files(store_fixture.path)
+        assert len(file_names) == 3
+
+        with open(file_names[-1], 'rb') as segment_file:
+            (magic, record_size, capacity, count) = HxtleakStoreFormat.HEADER.unpack(
+                segment_file.read(HxtleakStoreFormat.HEADER.size)
+            )
+        assert magic == HxtleakStoreFormat.MAGIC
+        assert record_size == 8 + store_fixture.decoder.size
+        assert (capacity, count) == (4, 2)
+        assert os.path.getsize(file_names[0]) == HxtleakStoreFormat.HEADER.size + 4 * record_size
+
+    def test_read_range(self, store_fixture):
+        """Test that a time range spanning segments is located by binary search."""
+        t0 = store_fixture.start
+        store_fixture.fill(10)
+        timestamps = [
+            timestamp for (timestamp, _) in store_fixture.store.read(t0 + 2.0, t0 + 6.5)
+        ]
+        assert timestamps == [t0 + 2.0, t0 + 3.0, t0 + 4.0, t0 + 5.0, t0 + 6.0]
+        assert store_fixture.store.count(t0 + 2.5, t0 + 7.0) == 5
+        assert store_fixture.store.count(t0 + 1000.0) == 0
+
+    def test_read_last(self, store_fixture):
+        """Test that the most recent packets can be read across segments."""
+        t0 = store_fixture.start
+        store_fixture.fill(10)
+        timestamps = [timestamp for (timestamp, _) in store_fixture.store.read(last=7)]
+        assert timestamps == [t0 + 3.0 + idx for idx in range(7)]
+
+    def test_reopen(self, store_fixture):
+        """Test that stored packets are indexed when the store is reopened."""
+        t0 = store_fixture.start
+        store_fixture.fill(6)
+        store = store_fixture.create_store()
+        assert len(store.segments) == 2
+        assert store.first_timestamp() == t0
+        assert [packet.board_temp for (_, packet) in store.read(last=2)] == [4.0, 5.0]
+
+    def test_retention(self, store_fixture):
+        """Test that segments older than the retention period are deleted on rotation."""
+        store_fixture.fill(6, start=time.time() - 100.0)
+        store_fixture.store = store_fixture.create_store(retention=50.0)
+        store_fixture.store.set_enabled(True)
+        for idx in range(5):
+            store_fixture.store.record(time.time(), store_fixture.packets[idx])
+        store_fixture.store.set_enabled(False)
+
+        assert len(store_files(store_fixture.path)) == 2
+        assert store_fixture.store.count() == 5
+
+    def test_retention_active_segment(self, store_fixture):
+        """Test that segments expire while records are written to the active segment."""
+        now = time.time()
+        store = store_fixture.store
+        store.set_enabled(True)
+        for idx in range(5):
+            store.record(now - 100.0 + 10.0 * idx, store_fixture.packets[idx])
+        while store.records_written < 5:
+            time.sleep(0.01)
+        assert len(store_files(store_fixture.path)) == 2
+
+        store.retention = 50.0
+        store.record(now, store_fixture.packets[5])
+        store.set_enabled(False)
+        assert len(store_files(store_fixture.path)) == 1
+        assert store.count() == 2
+
+    def test_query(self, store_fixture):
+        """Test that the store can be queried as for the in-memory history."""
+        t0 = store_fixture.start
+        store_fixture.fill(10)
+        result = store_fixture.store.query(t0 + 1.0, t0 + 3.0, ['board_temp'])
+        assert result['fields'] == {'board_temp': [1.0, 2.0, 3.0]}
+
+        with pytest.raises(HxtleakError, match="too many records"):
+            store_fixture.store.query(points=3)
+
+    def test_query_columns(self, store_fixture):
+        """Test that all channels unpacked from the store match those of the in-memory history."""
+        t0 = store_fixture.start
+        emulator = HxtleakEmulator(seed=2)
+        store_fixture.packets = [
+            emulator.encode_packet(
+                board_temp=float(idx), leak_detected=bool(idx & 1), leak_continuity=bool(idx & 2),
+                fault=bool(idx & 4), warning=bool(idx & 8)
+            ) for idx in range(8)
+        ]
+        store_fixture.fill(8)
+
+        history = HxtleakHistory(8)
+        for (idx, raw) in enumerate(store_fixture.packets):
+            history.append(t0 + idx, store_fixture.decoder.decode(raw))
+
+        fields = [name for (name, _) in HxtleakHistory.FIELDS[1:]]
+        result = store_fixture.store.query(fields=fields, method='raw')
+        assert result == history.query(fields=fields, method='raw')
+        assert result['fields']['flags'] == list(range(8))
+
+    def test_read_columns(self, store_fixture):
+        """Test that the most recent records are read as columns without decoding."""
+        t0 = store_fixture.start
+        store_fixture.fill(10)
+        columns = store_fixture.store.read_columns(last=5, fields=['board_temp', 'flags'])
+        assert sorted(columns) == ['board_temp', 'flags', 'timestamp']
+        assert columns['timestamp'].tolist() == [t0 + idx for idx in range(5, 10)]
+        assert columns['board_temp'].tolist() == [5.0, 6.0, 7.0, 8.0, 9.0]
+
+    def test_query_deleted_segment(self, store_fixture, monkeypatch):
+        """Test that a segment deleted after being located is reported as a store error."""
+        store_fixture.fill(6)
+        ranges = store_fixture.store._locate()
+        os.remove(ranges[0][0].file_name)
+        monkeypatch.setattr(store_fixture.store, '_locate', lambda *args: ranges)
+
+        with pytest.raises(HxtleakError, match="Failed to read history segment"):
+            store_fixture.store.query(method='raw')
+
+    def test_export(self, store_fixture):
+        """Test that a time range of the store is exported in chunks."""
+        t0 = store_fixture.start
+        store_fixture.fill(10)
+        chunks = list(store_fixture.store.export(t0 + 2, t0 + 8, ['board_temp'], 3))
+        assert [chunk['board_temp'] for chunk in chunks] == [
+            [2.0, 3.0, 4.0], [5.0, 6.0, 7.0], [8.0]
+        ]
+        assert chunks[0]['timestamp'] == [t0 + 2, t0 + 3, t0 + 4]
@@ -0,0 +1,228 @@
+"""Test streaming HTTP server classes.
+
+Tim Nicholls, STFC Detector Systems Software Group
+"""
+import asyncio
+import gzip
+import json
+import socket
+
+import pytest
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.ioloop import IOLoop
+from tornado.websocket import websocket_connect
+
+from hxtleak.controller import HxtleakController
+from hxtleak.emulator import HxtleakEmulator
+from hxtleak.packet_decoder import HxtleakPacketDecoder
+from hxtleak.stream import HxtleakStreamServer
+
+
+class StreamServerTestFixture(object):
+    """Container class used in the creation of a streaming server fixture."""
+
+    def __init__(self):
+        """Initialise the controller, streaming server and test history."""
+        self.emulator = HxtleakEmulator(seed=1)
+        self.controller = HxtleakController(self.emulator.open())
+
+        # Find an unused port for the server to listen on
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+        self.server = HxtleakStreamServer(self.controller, self.port, '127.0.0.1')
+
+        decoder = HxtleakPacketDecoder()
+        for idx in range(5):
+            self.controller.history.append(1000.0 + idx, decoder.decode(
+                self.emulator.encode_packet(board_temp=20.0 + idx / 4)
+            ))
+
+    def fetch(self, path, **kwargs):
+        """Fetch a path from the streaming server, returning the response."""
+        async def fetch():
+            return await AsyncHTTPClient().fetch(
+                'http://127.0.0.1:{}{}'.format(self.port, path), **kwargs
+            )
+
+        return IOLoop.current().run_sync(fetch, timeout=5.0)
+
+    async def open_events(self, headers=''):
+        """Open an event stream connection, returning the stream reader and writer."""
+        (reader, writer) = await asyncio.open_connection('127.0.0.1', self.port)
+        writer.write('GET /events HTTP/1.1\r\nHost: localhost\r\n{}\r\n'.format(headers).encode())
+        return (reader, writer)
+
+    @staticmethod
+    async def read_until(reader, data, received=b''):
+        """Read from a stream until the specified data has been received."""
+        while data not in received:
+            received += await reader.read(4096)
+        return received
+
+    def run(self, coroutine):
+        """Run a coroutine function on the IOLoop, returning its result."""
+        return IOLoop.current().run_sync(coroutine, timeout=5.0)
+
+
+@pytest.fixture()
+def stream_fixture():
+    """Test fixture used in testing streaming server behaviour."""
+    stream_fixture = StreamServerTestFixture()
+    yield stream_fixture
+    stream_fixture.server.stop()
+    stream_fixture.controller.cleanup()
+    stream_fixture.emulator.close()
+
+
+class TestStreamServer():
+    """Class to test the streaming server behaviour."""
+
+    def test_export_csv(self, stream_fixture):
+        """Test that the history is exported as CSV."""
+        response = stream_fixture.fetch(
+            '/export?start=1001&end=1003&fields=board_temp,flags', decompress_response=False
+        )
+        assert response.headers['Content-Type'] == 'text/csv'
+        assert 'Content-Encoding' not in response.headers
+        assert response.body.decode().splitlines() == [
+            'timestamp,board_temp,flags',
+            '1001.000000,20.25,2',
+            '1002.000000,20.5,2',
+            '1003.000000,20.75,2',
+        ]
+
+    def test_export_ndjson_gzip(self, stream_fixture):
+        """Test that the history is exported as gzip-compressed NDJSON if accepted."""
+        response = stream_fixture.fetch(
+            '/export?format=ndjson&fields=board_temp', decompress_response=False,
+            headers={'Accept-Encoding': 'gzip'}
+        )
+        assert response.headers['Content-Type'] == 'application/x-ndjson'
+        assert response.headers['Content-Encoding'] == 'gzip'
+        records = [json.loads(line) for line in gzip.decompress(response.body).splitlines()]
+        assert len(records) == 5
+        assert records[4] == {'timestamp': 1004.0, 'board_temp': 21.0}
+
+    def test_export_bad_args(self, stream_fixture):
+        """Test that an export with bad arguments returns an error."""
+        for path in ('/export?format=xml', '/export?fields=missing', '/export?start=x'):
+            with pytest.raises(HTTPClientError) as excinfo:
+                stream_fixture.fetch(path)
+            assert excinfo.value.code == 400
+
+    def test_state_socket(self, stream_fixture):
+        """Test that the state socket pushes the system state and events as they change."""
+        controller = stream_fixture.controller
+        url = 'ws://127.0.0.1:{}/ws'.format(stream_fixture.port)
+
+        async def connect():
+            connection = await websocket_connect(url)
+            messages = [json.loads(await connection.read_message()) for _ in range(2)]
+            return (connection, messages)
+
+        (connection, messages) = stream_fixture.run(connect)
+        assert [message['type'] for message in messages] == ['system', 'events']
+        assert 'system' in messages[0]['data']
+        assert messages[1]['data']['cursor'] == controller.logger.last_seq()
+        assert controller.push.subscribers
+
+        async def log_event():
+            controller.logger.warning("Pushed event 1")
+            controller.logger.warning("Pushed event 2")
+            return json.loads(await connection.read_message())
+
+        message = stream_fixture.run(log_event)
+        assert message['type'] == 'events'
+        assert [event['message'] for event in message['data']['events']] == [
+            "Pushed event 1", "Pushed event 2"
+        ]
+
+        async def disconnect():
+            connection.close()
+            while controller.push.subscribers:
+                await gen.sleep(0.01)
+
+        stream_fixture.run(disconnect)
+
+    def test_event_stream(self, stream_fixture):
+        """Test that log events and heartbeats are streamed as server-sent events."""
+        controller = stream_fixture.controller
+        last_seq = controller.logger.last_seq()
+
+        async def stream_events():
+            (reader, writer) = await stream_fixture.open_events()
+            received = await stream_fixture.read_until(reader, b'retry: ')
+            assert b'Content-Type: text/event-stream' in received
+
+            controller.logger.warning("Streamed event")
+            received = await stream_fixture.read_until(reader, b'Streamed event', received)
+            assert 'id: {}\nevent: log\n'.format(last_seq + 1).encode() in received
+
+            controller.sse.notify('heartbeat')
+            await stream_fixture.read_until(reader, b': heartbeat\n\n', received)
+            writer.close()
+
+        stream_fixture.run(stream_events)
+
+    def test_event_stream_resume(self, stream_fixture):
+        """Test that an event stream resumes after the Last-Event-ID."""
+        controller = stream_fixture.controller
+        for idx in range(3):
+            controller.logger.warning("Resumed event %d", idx)
+        last_seq = controller.logger.last_seq()
+
+        async def resume_events():
+            (reader, writer) = await stream_fixture.open_events(
+                'Last-Event-ID: {}\r\n'.format(last_seq - 2)
+            )
+            received = await stream_fixture.read_until(reader, b'Resumed event 2')
+            writer.close()
+            return received
+
+        received = stream_fixture.run(resume_events)
+        assert b'Resumed event 0' not in received
+        assert b'Resumed event 1' in received
+        assert 'id: {}\n'.format(last_seq).encode() in received
+
+    def test_system_poll(self, stream_fixture):
+        """Test that a system poll is answered immediately if the state has changed."""
+        controller = stream_fixture.controller
+        response = json.loads(stream_fixture.fetch('/system').body)
+        assert response['version'] == controller.versions['system']
+        assert response['system']['status'] == 'unknown'
+
+        response = json.loads(stream_fixture.fetch('/system?version=-2&timeout=10').body)
+        assert 'system' in response
+
+    def test_system_poll_wait(self, stream_fixture):
+        """Test that a system poll waits for the next change of the state."""
+        controller = stream_fixture.controller
+        version = controller.versions['system']
+
+        async def poll():
+            response = AsyncHTTPClient().fetch('http://127.0.0.1:{}/system?version={}'.format(
+                stream_fixture.port, version
+            ))
+            while not controller.long_poll.subscribers:
+                await gen.sleep(0.01)
+            controller.set('system/outlets/chiller/state', True)
+            return json.loads((await response).body)
+
+        response = stream_fixture.run(poll)
+        assert response['version'] == version + 1
+        assert response['system']['outlets']['chiller']['state']
+        assert not controller.long_poll.subscribers
+
+    def test_system_poll_timeout(self, stream_fixture):
+        """Test that a system poll is answered without the state if unchanged at the timeout."""
+        controller = stream_fixture.controller
+        version = controller.versions['system']
+        response = stream_fixture.fetch('/system?version={}&timeout=0.1'.format(version))
+        assert json.loads(response.body) == {'version': version}
+        assert not controller.long_poll.subscribers
+
+        with pytest.raises(HTTPClientError) as excinfo:
+            stream_fixture.fetch('/system?version=x')
+        assert excinfo.value.code == 400